@@ -306,7 +306,7 @@ def update_index():
     require('srvr', 'path', 'within_virtualenv', provided_by=env.servers)
 
     with cd(env.path), prefix(env.within_virtualenv):
-        run('./manage.py update_index')
+        run('./manage.py art index_articles')
 
 
 @task
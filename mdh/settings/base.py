@@ -281,3 +281,14 @@ AUTH_LDAP_REQUIRE_GROUP = (
 )
 
 MDH_SOURCE_PATH = 'research_data'
+# Local file caching the list of files under MDH_SOURCE_PATH
+# (see art --catalog). None: walk the source folders on every run.
+MDH_CATALOG_PATH = None
+# Local file of the Term autocomplete index, written by art
+# (build_term_index) and reloaded by the web workers when it changes.
+# None: each worker reads the index from the database once.
+MDH_TERM_INDEX_PATH = None
+# Elasticsearch index of the articles and their trigrams
+# (see art index_articles)
+MDH_ELASTICSEARCH_HOSTS = ['localhost:9200']
+MDH_ELASTICSEARCH_INDEX = 'mdh_articles'
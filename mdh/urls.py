@@ -10,6 +10,7 @@ admin.autodiscover()
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('api/', include('mdh_corpus.urls')),
 
 
 
@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mdh.settings")
 
 application = get_wsgi_application()
+
+# load the term autocomplete index file before the first request
+from mdh_corpus.terms import preload_term_index  # noqa: E402
+preload_term_index()
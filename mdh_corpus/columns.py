@@ -0,0 +1,211 @@
+'''
+Columnar copy of the Article3Term table for offline analysis.
+Created by the export_columns action of the art command:
+
+    python manage.py art export_columns <folder>
+
+The folder contains one .npy file per column, memory-mapped on load,
+so it can be analysed on any machine, without Django or PostgreSQL.
+
+    article_id.npy, term1.npy, term2.npy, term3.npy: int32
+    freq.npy: uint16
+    articles_id.npy, articles_journal.npy: int32, sorted by article id
+    articles_year.npy: int16
+    terms.csv: id<tab>label of all the Term records
+    columns.json: number of rows and date of the export
+
+Example:
+
+    from mdh_corpus.columns import TrigramColumns
+    columns = TrigramColumns('/path/to/folder')
+    mask = columns.match('digital', 'humanities')
+    years, freqs = columns.group_sum('year', mask)
+'''
+
+import csv
+import json
+import os
+import numpy as np
+
+# (name, numpy type) of the columns with one value per trigram record
+TRIGRAM_COLUMNS = [
+    ('article_id', 'int32'),
+    ('term1', 'int32'),
+    ('term2', 'int32'),
+    ('term3', 'int32'),
+    ('freq', 'uint16'),
+]
+
+# (name, numpy type) of the columns with one value per article
+ARTICLE_COLUMNS = [
+    ('articles_id', 'int32'),
+    ('articles_journal', 'int32'),
+    ('articles_year', 'int16'),
+]
+
+# article attributes which can be used like trigram columns
+ARTICLE_ATTRIBUTES = {
+    'journal': 'articles_journal',
+    'year': 'articles_year',
+}
+
+MANIFEST_FILE = 'columns.json'
+TERMS_FILE = 'terms.csv'
+
+
+class TrigramColumns(object):
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, MANIFEST_FILE), 'rt') as f:
+            self.manifest = json.load(f)
+        self.columns = {}
+        self.term_ids = None
+
+    def __len__(self):
+        return self.manifest['rows']
+
+    def __getitem__(self, name):
+        '''Returns a column (memory-mapped numpy array) by name.
+        'journal' and 'year' return the attribute of the article
+        of each trigram record.'''
+        if name in ARTICLE_ATTRIBUTES:
+            return self.get_article_values(ARTICLE_ATTRIBUTES[name])
+
+        ret = self.columns.get(name)
+        if ret is None:
+            ret = np.load(
+                os.path.join(self.path, name + '.npy'), mmap_mode='r'
+            )
+            self.columns[name] = ret
+
+        return ret
+
+    def get_article_values(self, name, mask=None):
+        '''Returns the values of the article column <name>
+        for each trigram record (or those selected by <mask>).'''
+        article_ids = self['article_id']
+        if mask is not None:
+            article_ids = article_ids[mask]
+        positions = np.searchsorted(self['articles_id'], article_ids)
+
+        return self[name][positions]
+
+    # ----------------------------------------------------------------
+    # Terms
+
+    def get_term_ids(self):
+        '''Returns a dictionary label -> term id'''
+        if self.term_ids is None:
+            with open(
+                os.path.join(self.path, TERMS_FILE), 'rt', encoding='utf-8',
+                newline=''
+            ) as f:
+                self.term_ids = {
+                    label: int(term_id)
+                    for term_id, label in csv.reader(f, delimiter='\t')
+                }
+
+        return self.term_ids
+
+    def get_term_id(self, term):
+        '''Returns the id of a term given as a label or an id.
+        -1 if the label is unknown (matches nothing).'''
+        if isinstance(term, str):
+            return self.get_term_ids().get(term, -1)
+
+        return int(term)
+
+    def get_labels(self, term_ids):
+        '''Returns the labels of a sequence of term ids'''
+        labels = {v: k for k, v in self.get_term_ids().items()}
+
+        return [labels.get(int(term_id)) for term_id in term_ids]
+
+    # ----------------------------------------------------------------
+    # Filters
+
+    def match(self, term1=None, term2=None, term3=None, articles=None,
+              mask=None):
+        '''Returns a boolean mask of the trigram records
+        matching all the criteria.
+        Each term is a label, an id or a list of them; None for any term.
+        articles: list of article ids.
+        mask: only keep the records already selected by that mask.'''
+        ret = mask
+        for name, value in [
+            ('term1', term1), ('term2', term2), ('term3', term3),
+            ('article_id', articles),
+        ]:
+            if value is None:
+                continue
+            if name == 'article_id':
+                values = np.asarray(value, dtype='int32')
+            elif isinstance(value, (list, tuple, set)):
+                values = [self.get_term_id(v) for v in value]
+            else:
+                values = self.get_term_id(value)
+
+            if np.ndim(values):
+                selected = np.isin(self[name], values)
+            else:
+                selected = self[name] == values
+
+            ret = selected if ret is None else (ret & selected)
+
+        if ret is None:
+            ret = np.ones(len(self), dtype=bool)
+
+        return ret
+
+    # ----------------------------------------------------------------
+    # Aggregations
+
+    def group_sum(self, by, mask=None, weights='freq'):
+        '''Sums <weights> (a column name or None to count records)
+        of the records selected by <mask>, grouped by <by>.
+        <by> is a column name or a list of column names,
+        'journal' and 'year' included.
+        Returns (keys, sums), keys is a 2D array if <by> is a list.'''
+        names = by if isinstance(by, (list, tuple)) else [by]
+
+        keys = []
+        for name in names:
+            if name in ARTICLE_ATTRIBUTES:
+                values = self.get_article_values(
+                    ARTICLE_ATTRIBUTES[name], mask
+                )
+            else:
+                values = self[name]
+                if mask is not None:
+                    values = values[mask]
+            keys.append(values)
+
+        values = None
+        if weights:
+            values = self[weights]
+            if mask is not None:
+                values = values[mask]
+
+        if len(keys) == 1:
+            groups, inverse = np.unique(keys[0], return_inverse=True)
+        else:
+            groups, inverse = np.unique(
+                np.stack(keys, axis=1), axis=0, return_inverse=True
+            )
+
+        sums = np.bincount(
+            inverse.reshape(-1), weights=values, minlength=len(groups)
+        )
+        if weights:
+            sums = sums.astype('int64')
+
+        return groups, sums
+
+    def top(self, by, mask=None, limit=10, weights='freq'):
+        '''Returns the <limit> groups with the highest sums,
+        see group_sum(). Returns (keys, sums), highest first.'''
+        groups, sums = self.group_sum(by, mask, weights)
+        order = np.argsort(sums)[::-1][:limit]
+
+        return groups[order], sums[order]
@@ -0,0 +1,236 @@
+'''
+Maintenance of the trigram aggregate tables:
+TrigramYear, TrigramJournal, TrigramDomain and TrigramTotal.
+
+AggregatedArticle is the ledger of the articles counted in the
+aggregates. Their contribution is always computed from their current
+trigrams and metadata, so an article must be subtracted before its
+trigrams, year, journal or domains are modified and added again
+afterwards. Adding an article already in the ledger, or without any
+trigram, does nothing.
+
+All changes are set-based: a few statements for any number of articles.
+'''
+
+from django.db import connection, transaction
+from mdh_corpus.models import (
+    Article, Article3Term, AggregatedArticle,
+    TrigramYear, TrigramJournal, TrigramDomain, TrigramTotal
+)
+
+# temporary tables
+ARTICLES_TABLE = 'mdh_tmp_aggregated_articles'
+DELTA_TABLE = 'mdh_tmp_aggregate_delta'
+
+
+class TrigramAggregates(object):
+
+    def get_aggregates(self):
+        '''Returns [(model, key column, key expression, join), ...]
+        Expressions and joins can refer to the article (a).'''
+        return [
+            (
+                TrigramYear, 'year',
+                'EXTRACT(year FROM a.pub_date)::smallint', ''
+            ),
+            (
+                TrigramJournal, 'journal_id', 'a.journal_id', ''
+            ),
+            (
+                TrigramDomain, 'domain_id', 'd.domain_id',
+                'JOIN %s d ON d.article_id = a.id'
+                % Article.domains.through._meta.db_table
+            ),
+        ]
+
+    def add(self, article_ids=None):
+        '''Adds the trigrams of the articles to the aggregates.
+        article_ids: list of article ids, None for all the articles.
+        Returns the number of articles added.'''
+        with transaction.atomic(), connection.cursor() as c:
+            c.execute('''
+                CREATE TEMPORARY TABLE {articles} ON COMMIT DROP AS
+                SELECT t.article_id, SUM(t.freq) AS freq,
+                COUNT(*) AS trigrams
+                FROM {table} t
+                WHERE {condition}
+                AND NOT EXISTS (
+                    SELECT 1 FROM {ledger} l
+                    WHERE l.article_id = t.article_id
+                )
+                GROUP BY t.article_id
+            '''.format(
+                articles=ARTICLES_TABLE,
+                table=Article3Term._meta.db_table,
+                ledger=AggregatedArticle._meta.db_table,
+                condition='TRUE' if article_ids is None
+                else 't.article_id = ANY(%(article_ids)s)'
+            ), {'article_ids': list(article_ids or [])})
+            c.execute('''
+                INSERT INTO {ledger} (article_id, freq, trigrams)
+                SELECT article_id, freq, trigrams FROM {articles}
+            '''.format(
+                articles=ARTICLES_TABLE,
+                ledger=AggregatedArticle._meta.db_table,
+            ))
+            ret = c.rowcount
+
+            if ret:
+                # no statistics otherwise, the planner would assume
+                # a large table and scan all the trigrams
+                c.execute('ANALYZE %s' % ARTICLES_TABLE)
+                self._apply_delta(c, 1)
+                self._apply_totals(c, 1)
+
+            c.execute('DROP TABLE %s' % ARTICLES_TABLE)
+
+        return ret
+
+    def subtract(self, article_ids=None):
+        '''Removes the trigrams of the articles from the aggregates.
+        article_ids: list of article ids, None for all the articles.
+        Returns the number of articles subtracted.'''
+        with transaction.atomic(), connection.cursor() as c:
+            c.execute('''
+                CREATE TEMPORARY TABLE {articles}
+                (article_id integer, freq bigint) ON COMMIT DROP
+            '''.format(articles=ARTICLES_TABLE))
+            c.execute('''
+                WITH deleted AS (
+                    DELETE FROM {ledger}
+                    WHERE {condition}
+                    RETURNING article_id, freq
+                )
+                INSERT INTO {articles} SELECT article_id, freq FROM deleted
+            '''.format(
+                articles=ARTICLES_TABLE,
+                ledger=AggregatedArticle._meta.db_table,
+                condition='TRUE' if article_ids is None
+                else 'article_id = ANY(%(article_ids)s)'
+            ), {'article_ids': list(article_ids or [])})
+            ret = c.rowcount
+
+            if ret:
+                c.execute('ANALYZE %s' % ARTICLES_TABLE)
+                self._apply_delta(c, -1)
+                self._apply_totals(c, -1)
+
+            c.execute('DROP TABLE %s' % ARTICLES_TABLE)
+
+        return ret
+
+    def reset(self):
+        '''Empties the aggregates and the ledger'''
+        with connection.cursor() as c:
+            c.execute('TRUNCATE %s' % ', '.join([
+                model._meta.db_table for model
+                in [AggregatedArticle, TrigramTotal] + [
+                    aggregate[0] for aggregate in self.get_aggregates()
+                ]
+            ]))
+
+    def rebuild(self):
+        '''Recomputes all the aggregates from scratch.
+        Returns the number of articles.'''
+        with transaction.atomic():
+            self.reset()
+            ret = self.add()
+
+        return ret
+
+    def _apply_delta(self, cursor, sign):
+        # Adds (sign=1) or subtracts (sign=-1) the trigrams
+        # of the articles in ARTICLES_TABLE to each aggregate.
+        for model, column, expression, join in self.get_aggregates():
+            table = model._meta.db_table
+            cursor.execute('''
+                CREATE TEMPORARY TABLE {delta} ON COMMIT DROP AS
+                SELECT t.term1_id, t.term2_id, t.term3_id,
+                {expression} AS {column},
+                SUM(t.freq) AS freq, COUNT(*) AS articles
+                FROM {articles} x
+                JOIN {trigrams} t ON t.article_id = x.article_id
+                JOIN {article} a ON a.id = t.article_id
+                {join}
+                GROUP BY 1, 2, 3, 4
+            '''.format(
+                delta=DELTA_TABLE,
+                expression=expression,
+                column=column,
+                articles=ARTICLES_TABLE,
+                trigrams=Article3Term._meta.db_table,
+                article=Article._meta.db_table,
+                join=join,
+            ))
+            cursor.execute('ANALYZE %s' % DELTA_TABLE)
+
+            keys = '''
+                g.term1_id = d.term1_id AND g.term2_id = d.term2_id
+                AND g.term3_id = d.term3_id AND g.{column} = d.{column}
+            '''.format(column=column)
+
+            # the rows are locked in the order of the key, so concurrent
+            # transactions (e.g. art --workers) wait instead of deadlocking
+            cursor.execute('''
+                INSERT INTO {table} AS g
+                (term1_id, term2_id, term3_id, {column}, freq, articles)
+                SELECT term1_id, term2_id, term3_id, {column},
+                {sign} * freq, {sign} * articles
+                FROM {delta}
+                ORDER BY 1, 2, 3, 4
+                ON CONFLICT (term1_id, term2_id, term3_id, {column})
+                DO UPDATE SET
+                freq = g.freq + EXCLUDED.freq,
+                articles = g.articles + EXCLUDED.articles
+            '''.format(
+                table=table, column=column, delta=DELTA_TABLE, sign=int(sign)
+            ))
+            if sign < 0:
+                cursor.execute('''
+                    DELETE FROM {table} g
+                    USING {delta} d
+                    WHERE {keys}
+                    AND g.articles <= 0
+                '''.format(table=table, delta=DELTA_TABLE, keys=keys))
+
+            cursor.execute('DROP TABLE %s' % DELTA_TABLE)
+
+    def _apply_totals(self, cursor, sign):
+        # Adds (sign=1) or subtracts (sign=-1) the articles
+        # in ARTICLES_TABLE to the rows of TrigramTotal they count in.
+        # Relative updates, so concurrent transactions don't overwrite
+        # each other's totals.
+        table = TrigramTotal._meta.db_table
+        cursor.execute('''
+            INSERT INTO {totals} AS g (dimension, value, freq, articles)
+            SELECT 'corpus', 0, {sign} * SUM(x.freq), {sign} * COUNT(*)
+            FROM {articles} x
+            HAVING COUNT(*) > 0
+            UNION ALL
+            SELECT 'year', EXTRACT(year FROM a.pub_date),
+            {sign} * SUM(x.freq), {sign} * COUNT(*)
+            FROM {articles} x JOIN {article} a ON a.id = x.article_id
+            GROUP BY 2
+            UNION ALL
+            SELECT 'journal', a.journal_id,
+            {sign} * SUM(x.freq), {sign} * COUNT(*)
+            FROM {articles} x JOIN {article} a ON a.id = x.article_id
+            GROUP BY 2
+            UNION ALL
+            SELECT 'domain', d.domain_id,
+            {sign} * SUM(x.freq), {sign} * COUNT(*)
+            FROM {articles} x JOIN {domains} d ON d.article_id = x.article_id
+            GROUP BY 2
+            ORDER BY 1, 2
+            ON CONFLICT (dimension, value) DO UPDATE SET
+            freq = g.freq + EXCLUDED.freq,
+            articles = g.articles + EXCLUDED.articles
+        '''.format(
+            totals=table,
+            sign=int(sign),
+            articles=ARTICLES_TABLE,
+            article=Article._meta.db_table,
+            domains=Article.domains.through._meta.db_table,
+        ))
+        if sign < 0:
+            cursor.execute('DELETE FROM %s WHERE articles <= 0' % table)
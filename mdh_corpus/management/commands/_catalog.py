@@ -0,0 +1,168 @@
+'''
+Catalog of the source files, saved in a local file
+so the art command doesn't have to walk the whole source tree
+(potentially on a network drive) on every run.
+
+For each folder the catalog keeps its mtime, its sub-folders and
+its files: (name, kind, fileid, size, mtime).
+A folder is only listed again if its mtime has changed,
+i.e. a file has been added, removed or renamed in it.
+Note that modifying a file in place doesn't change its folder's mtime,
+use refresh(rescan=True) to update the size and mtime of all files.
+The art command reads the kind and fileid of the files from the
+catalog. To find the files modified since their ingestion, it still
+stats them (see select_changed_files).
+'''
+
+from bisect import bisect_left
+import gzip
+import json
+import os
+import re
+
+CATALOG_VERSION = 1
+
+
+class FileCatalog(object):
+
+    def __init__(self, path, root):
+        self.path = path
+        self.source_root = root
+        self.root = os.path.abspath(root)
+        # relative dir path -> [mtime, [subdirs], [files]]
+        self.dirs = {}
+
+    def load(self):
+        '''Load the catalog from its file.
+        Returns False if the file doesn't exist or is for another root.'''
+        self.dirs = {}
+
+        if not os.path.exists(self.path):
+            return False
+
+        with gzip.open(self.path, 'rt', encoding='utf-8') as f:
+            content = json.load(f)
+
+        if content.get('version') != CATALOG_VERSION or \
+                content.get('root') != self.root:
+            return False
+
+        self.dirs = content['dirs']
+
+        return True
+
+    def save(self):
+        path = self.path + '.tmp'
+        with gzip.open(path, 'wt', encoding='utf-8') as f:
+            json.dump({
+                'version': CATALOG_VERSION,
+                'root': self.root,
+                'dirs': self.dirs,
+            }, f)
+        os.replace(path, self.path)
+
+    def refresh(self, rescan=False):
+        '''Updates the catalog from the file system.
+        Returns (number of folders listed, number of folders reused).'''
+        listed = 0
+        reused = 0
+        dirs = {}
+
+        stack = ['']
+        while stack:
+            rel_path = stack.pop()
+            path = os.path.join(self.root, rel_path)
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+
+            entry = self.dirs.get(rel_path)
+            if rescan or entry is None or entry[0] != mtime:
+                entry = self._scan_dir(path, mtime)
+                listed += 1
+            else:
+                reused += 1
+
+            dirs[rel_path] = entry
+            stack.extend(
+                os.path.join(rel_path, name) for name in reversed(entry[1])
+            )
+
+        self.dirs = dirs
+
+        return listed, reused
+
+    def _scan_dir(self, path, mtime):
+        subdirs = []
+        files = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                # same as os.walk(): symlinks to folders are not followed
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        subdirs.append(entry.name)
+                    continue
+                try:
+                    stat = entry.stat()
+                    size, file_mtime = stat.st_size, stat.st_mtime
+                except OSError:
+                    size, file_mtime = 0, 0
+                files.append([
+                    entry.name,
+                    get_file_kind(entry.name),
+                    get_fileid(entry.name),
+                    size,
+                    file_mtime
+                ])
+
+        subdirs.sort()
+        files.sort()
+
+        return [mtime, subdirs, files]
+
+    def iter_files(self):
+        '''Yields (path, kind, fileid, size, mtime) for all the files'''
+        for dirpath, files in self._iter_dir_entries():
+            for name, kind, fileid, size, mtime in files:
+                yield os.path.join(dirpath, name), kind, fileid, size, mtime
+
+    def get_file(self, path):
+        '''Returns (kind, fileid, size, mtime) of the file at <path>
+        (as yielded by iter_files()), None if it is not in the catalog'''
+        dirpath, name = os.path.split(path)
+        rel_path = os.path.relpath(dirpath, self.source_root)
+        entry = self.dirs.get('' if rel_path == '.' else rel_path)
+        if entry is None:
+            return None
+
+        files = entry[2]
+        i = bisect_left(files, [name])
+        if i == len(files) or files[i][0] != name:
+            return None
+
+        return tuple(files[i][1:])
+
+    def _iter_dir_entries(self):
+        # paths start with the root as it was given, like os.walk()
+        for rel_path in sorted(self.dirs.keys()):
+            dirpath = self.source_root
+            if rel_path:
+                dirpath = os.path.join(dirpath, rel_path)
+            yield dirpath, self.dirs[rel_path][2]
+
+
+def get_file_kind(name):
+    ret = ''
+    if name.endswith('.xml'):
+        ret = 'meta'
+    else:
+        match = re.search(r'-(ngram\d+)\.txt$', name)
+        if match:
+            ret = match.group(1)
+
+    return ret
+
+
+def get_fileid(name):
+    return re.sub(r'(-ngram\d+)?\.[^.]*$', '', name)
@@ -0,0 +1,85 @@
+'''
+Writes the output of a PostgreSQL binary COPY TO STDOUT
+into .npy column files, see mdh_corpus.columns.
+
+The binary format of COPY is a header then, for each record,
+the number of fields (int16) and for each field its length (int32)
+followed by its value, all big-endian. Our columns are never NULL and
+have a fixed size so each record is parsed with the same numpy type.
+'''
+
+import numpy as np
+
+COPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+# signature + flags (int32) + header extension length (int32)
+COPY_HEADER_SIZE = len(COPY_SIGNATURE) + 8
+
+
+class BinaryCopyColumns(object):
+
+    def __init__(self, paths, sizes, dtypes, rows):
+        '''paths: list of .npy files to write, one per field
+        sizes: size in bytes of each field in postgresql (2, 4, 8)
+        dtypes: numpy type of each column
+        rows: exact number of records to be copied'''
+        self.rows = rows
+        self.written = 0
+        self.buffer = b''
+        self.header = True
+
+        fields = [('count', '>i2')]
+        for i, size in enumerate(sizes):
+            fields.append(('length%s' % i, '>i4'))
+            fields.append(('f%s' % i, '>i%s' % size))
+        self.record = np.dtype(fields)
+
+        self.columns = [
+            np.lib.format.open_memmap(
+                path, mode='w+', dtype=dtype, shape=(rows,)
+            )
+            for path, dtype in zip(paths, dtypes)
+        ]
+
+    def write(self, data):
+        '''Called by cursor.copy_expert() with the next block of data'''
+        buffer = self.buffer + data
+
+        start = 0
+        if self.header:
+            if len(buffer) < COPY_HEADER_SIZE:
+                self.buffer = buffer
+                return
+            if not buffer.startswith(COPY_SIGNATURE):
+                raise ValueError('Not a binary COPY stream')
+            extension = int.from_bytes(
+                buffer[COPY_HEADER_SIZE - 4:COPY_HEADER_SIZE], 'big'
+            )
+            start = COPY_HEADER_SIZE + extension
+            if len(buffer) < start:
+                self.buffer = buffer
+                return
+            self.header = False
+
+        # the stream ends with a field count of -1 (2 bytes)
+        count = (len(buffer) - start) // self.record.itemsize
+        count = min(count, self.rows - self.written)
+        if count:
+            records = np.frombuffer(
+                buffer, dtype=self.record, count=count, offset=start
+            )
+            end = self.written + count
+            for i, column in enumerate(self.columns):
+                column[self.written:end] = records['f%s' % i]
+            self.written = end
+            start += count * self.record.itemsize
+
+        self.buffer = buffer[start:]
+
+    def close(self):
+        for column in self.columns:
+            column.flush()
+        if self.written != self.rows or self.buffer != b'\xff\xff':
+            raise ValueError(
+                'Unexpected end of COPY stream, %s/%s records'
+                % (self.written, self.rows)
+            )
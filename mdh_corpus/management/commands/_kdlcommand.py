@@ -8,6 +8,11 @@ from django.core.management.base import BaseCommand
 import os
 import re
 from django.db import transaction
+from django.db.utils import IntegrityError, OperationalError
+from ._stats import RunStats
+
+# max number of times a single item is retried after a transient error
+COMMIT_RETRIES = 3
 
 
 class DryRunRollBackException(Exception):
@@ -17,6 +22,11 @@ class DryRunRollBackException(Exception):
 class KDLCommand(BaseCommand):
     help = 'Import wordpress xml dump into wagtail'
 
+    def __init__(self, *args, **kwargs):
+        super(KDLCommand, self).__init__(*args, **kwargs)
+        # per-phase timers and counters of the action, see _stats.py
+        self.stats = RunStats()
+
     def add_arguments(self, parser):
         parser.add_argument('action', nargs=1, type=str)
         parser.add_argument('aargs', nargs='*', type=str)
@@ -24,12 +34,34 @@ class KDLCommand(BaseCommand):
             '-n', '--dry-run', action='store_true', dest='dry_run',
             help="Do everything except modify the database.",
         )
+        parser.add_argument(
+            '--commit-every', action='store', dest='commit_every',
+            type=int,
+            help="Number of items (e.g. files) written per transaction.",
+        )
+        parser.add_argument(
+            '--commit-rows', action='store', dest='commit_rows',
+            type=int,
+            help="Commit once that many rows have been written.",
+        )
+        parser.add_argument(
+            '--stats', action='store', dest='stats',
+            help="Write the timers and counters of the run to that file "
+            "(.csv or .json).",
+        )
+        parser.add_argument(
+            '--stats-every', action='store', dest='stats_every',
+            type=int, default=60,
+            help="Print a summary of the timers and counters "
+            "every that many seconds (0: only at the end).",
+        )
 
     def run_action(self, action_method):
         import time
         t0 = time.time()
         action_method()
         d = time.time() - t0
+        self.print_stats(d)
         print(
             'END of command "{}" ({:.2f} s.)'.format(
                 self.action, d
@@ -67,9 +99,110 @@ class KDLCommand(BaseCommand):
             )
             self.show_help()
 
+    def print_stats(self, duration):
+        '''Prints the summary of the timers and counters of the action
+        and writes them to the --stats file'''
+        if self.stats:
+            print('Stats: %s' % self.stats.get_summary())
+
+        path = self.options.get('stats')
+        if path:
+            self.stats.export(
+                path, command=self.__module__.split('.')[-1],
+                action=self.action, duration=duration,
+            )
+            print('Stats written to %s' % path)
+
+    def print_stats_if_due(self):
+        '''Prints the summary of the timers and counters
+        once every --stats-every seconds'''
+        if self.stats.is_due(self.options.get('stats_every')):
+            from tqdm import tqdm
+            tqdm.write('Stats: %s' % self.stats.get_summary())
+
     def is_dry_run(self):
         return self.options.get('dry_run', False)
 
+    def commit_in_batches(self, items, process, flush=None, commit_every=1):
+        '''
+        Calls process(item) for each item in <items>.
+        Groups the calls in transactions of --commit-every items
+        (default: <commit_every>) or, with --commit-rows, closes the
+        transaction when the numbers returned by process() reach it.
+        flush(), if provided, is called at the end of each transaction.
+
+        A failed transaction is split in two halves which are retried
+        separately, until the failing item is isolated.
+        The stats counters of a failed transaction are discarded,
+        so they only count the items committed.
+        '''
+        size = self.options.get('commit_every')
+        max_rows = self.options.get('commit_rows')
+        if not size and not max_rows:
+            size = commit_every
+
+        iterator = iter(items)
+        done = False
+        while not done:
+            done = True
+            batch = []
+            counters = self.stats.get_counters()
+            try:
+                with transaction.atomic():
+                    rows = 0
+                    for item in iterator:
+                        batch.append(item)
+                        rows += process(item) or 0
+                        if (size and len(batch) >= size) or \
+                                (max_rows and rows >= max_rows):
+                            done = False
+                            break
+                    if flush:
+                        flush()
+            except Exception as e:
+                # the batch may have stopped before its end,
+                # the remaining items go into the next batches
+                done = False
+                self.stats.set_counters(counters)
+                self._recover_batch(batch, process, flush, e)
+
+    def _commit_batch(self, batch, process, flush, attempt=0):
+        counters = self.stats.get_counters()
+        try:
+            with transaction.atomic():
+                for item in batch:
+                    process(item)
+                if flush:
+                    flush()
+        except Exception as e:
+            self.stats.set_counters(counters)
+            self._recover_batch(batch, process, flush, e, attempt)
+
+    def _recover_batch(self, batch, process, flush, error, attempt=0):
+        self.on_rollback()
+        if len(batch) > 1:
+            self.stats.count('retries')
+            print(
+                'WARNING: transaction of %s items rolled back, '
+                'retry in smaller batches (%s)' % (len(batch), error)
+            )
+            middle = len(batch) // 2
+            self._commit_batch(batch[:middle], process, flush)
+            self._commit_batch(batch[middle:], process, flush)
+        elif attempt < COMMIT_RETRIES and \
+                isinstance(error, (IntegrityError, OperationalError)):
+            # e.g. deadlock or race condition with another process
+            self.stats.count('retries')
+            print('WARNING: transaction rolled back, retry... (%s)' % error)
+            self._commit_batch(batch, process, flush, attempt + 1)
+        else:
+            raise error
+
+    def on_rollback(self):
+        '''Called after commit_in_batches() rolled back a transaction.
+        Override to reset any state which refers to rolled back data.'''
+        pass
+
     def _fetch_url(self, url):
         ret = None
 
@@ -0,0 +1,285 @@
+'''
+Query benchmark: loads a synthetic corpus (see _synthetic.py) directly
+into the database and times a fixed workload of mdh_corpus.queries.
+Used by the queries action of the bench command.
+
+The dataset grows by scale factor (number of articles) and the same
+query parameters are used at all scales, so the results are comparable.
+The parameters are trigrams drawn from the text of the first articles:
+frequent trigrams are drawn more often, as in real queries.
+'''
+
+from io import StringIO
+import json
+import random
+import re
+import time
+import numpy as np
+from django.db import connection, transaction
+from mdh_corpus import queries
+from mdh_corpus.models import (
+    Article, Article3Term, Domain, Journal, Language, Term
+)
+from ._aggregates import TrigramAggregates
+from ._synthetic import count_trigrams
+
+# number of articles whose tokens are kept to draw the query parameters
+SAMPLE_ARTICLES = 50
+# number of articles written to the database at once
+LOAD_BATCH_SIZE = 200
+PERCENTILES = [50, 90, 99]
+
+
+class QueryDataset(object):
+    '''Writes the articles of a SyntheticCorpus into the database'''
+
+    def __init__(self, corpus):
+        self.corpus = corpus
+        self.articles = corpus.iter_articles()
+        self.loaded = 0
+        self.samples = []
+        self.term_ids = {}
+        self.journal_ids = []
+        self.domain_ids = {}
+        self.language_id = None
+
+    def setup(self):
+        '''Creates the terms, journals, domains and languages'''
+        corpus = self.corpus
+        self._copy(Term._meta.db_table, ['label'], (
+            (label,) for label in corpus.get_labels()
+        ))
+        self.term_ids = dict(Term.objects.values_list('label', 'id'))
+
+        Journal.objects.bulk_create([
+            Journal(label='Synthetic Journal %s' % i)
+            for i in range(corpus.journals)
+        ])
+        self.journal_ids = list(
+            Journal.objects.values_list('id', flat=True).order_by('label')
+        )
+        Domain.objects.bulk_create([
+            Domain(label='domain%s' % i) for i in range(corpus.domains)
+        ])
+        self.domain_ids = dict(Domain.objects.values_list('label', 'id'))
+        self.language_id = Language.objects.create(label='eng').id
+
+    def load(self, count):
+        '''Adds articles until <count> articles have been loaded.
+        Returns the number of articles added.'''
+        ret = 0
+        while self.loaded < count:
+            batch = []
+            for article in self.articles:
+                batch.append(article)
+                if len(batch) >= min(LOAD_BATCH_SIZE, count - self.loaded):
+                    break
+            if not batch:
+                break
+            with transaction.atomic():
+                self._load_batch(batch)
+            self.loaded += len(batch)
+            ret += len(batch)
+
+        return ret
+
+    def _load_batch(self, batch):
+        from datetime import date
+
+        for article in batch:
+            if len(self.samples) < SAMPLE_ARTICLES and article['english']:
+                self.samples.append(article)
+
+        articles = Article.objects.bulk_create([
+            Article(
+                fileid=article['fileid'],
+                journal_id=self.journal_ids[article['journal']],
+                label=article['title'],
+                lang_id=self.language_id if article['english'] else None,
+                pub_date=date(article['year'], article['month'], 1),
+            )
+            for article in batch
+        ])
+        Article.domains.through.objects.bulk_create([
+            Article.domains.through(
+                article_id=record.id,
+                domain_id=self.domain_ids[article['domain'].lower()],
+            )
+            for record, article in zip(articles, batch)
+        ])
+
+        term_ids = self.term_ids
+        self._copy(
+            Article3Term._meta.db_table,
+            ['article_id', 'term1_id', 'term2_id', 'term3_id', 'journal_id',
+             'freq'],
+            (
+                [
+                    record.id, *[term_ids[t] for t in trigram.split(' ')],
+                    record.journal_id, freq
+                ]
+                for record, article in zip(articles, batch)
+                if article['english']
+                for trigram, freq
+                in count_trigrams(article['tokens']).items()
+            )
+        )
+
+        TrigramAggregates().add([record.id for record in articles])
+
+    def _copy(self, table, columns, rows):
+        data = StringIO()
+        for row in rows:
+            data.write('\t'.join(str(value) for value in row))
+            data.write('\n')
+        data.seek(0)
+        with connection.cursor() as c:
+            c.copy_expert(
+                'COPY %s (%s) FROM STDIN' % (table, ', '.join(columns)), data
+            )
+
+    def analyze(self):
+        '''Updates the statistics and the visibility map
+        (needed for the index-only scans)'''
+        with connection.cursor() as c:
+            c.execute('VACUUM ANALYZE')
+
+
+class QueryWorkload(object):
+    '''A fixed list of queries with their parameters'''
+
+    def __init__(self, dataset, repeat=50, seed=1):
+        rnd = random.Random(seed)
+        samples = dataset.samples
+        domains = sorted(dataset.domain_ids.keys())
+
+        self.params = []
+        for _ in range(repeat):
+            tokens = rnd.choice(samples)['tokens']
+            i = rnd.randrange(len(tokens) - 2)
+            self.params.append({
+                'trigram': tokens[i:i + 3],
+                'journal_id': rnd.choice(dataset.journal_ids),
+                'domain': rnd.choice(domains),
+            })
+
+    def get_queries(self):
+        '''Returns [(name, function(params)), ...]'''
+        def pattern(trigram, fixed):
+            return [
+                label if i in fixed else None
+                for i, label in enumerate(trigram)
+            ]
+
+        return [
+            ('exact', lambda p: queries.get_trigram_articles(p['trigram'])),
+            ('exact_journal', lambda p: queries.get_trigram_articles(
+                p['trigram'], journal_id=p['journal_id']
+            )),
+            ('exact_domain', lambda p: queries.get_trigram_articles(
+                p['trigram'], domain=p['domain']
+            )),
+            ('wildcard_t1_t2', lambda p: queries.get_wildcard_trigrams(
+                pattern(p['trigram'], [0, 1])
+            )),
+            ('wildcard_t1_t3', lambda p: queries.get_wildcard_trigrams(
+                pattern(p['trigram'], [0, 2])
+            )),
+            ('wildcard_t2', lambda p: queries.get_wildcard_trigrams(
+                pattern(p['trigram'], [1])
+            )),
+            ('series_year', lambda p: queries.get_trigram_series(
+                [p['trigram']]
+            )),
+            ('series_month', lambda p: queries.get_trigram_series(
+                [p['trigram']], period='month'
+            )),
+            ('series_journal', lambda p: queries.get_trigram_series(
+                [p['trigram']], journal_id=p['journal_id']
+            )),
+            ('series_domain', lambda p: queries.get_trigram_series(
+                [p['trigram']], domain=p['domain']
+            )),
+        ]
+
+    def run(self, explain=True):
+        '''Runs each query with all the parameters, after a warm-up run.
+        Returns a list of dictionaries: name, count, p50, p90, p99, max
+        (latencies in ms) and plan (summary of the query plans).'''
+        ret = []
+        for name, query in self.get_queries():
+            for params in self.params:
+                query(params)
+
+            durations = []
+            for params in self.params:
+                t0 = time.perf_counter()
+                query(params)
+                durations.append((time.perf_counter() - t0) * 1000)
+
+            result = {
+                'query': name,
+                'count': len(durations),
+                'max': max(durations),
+            }
+            for percentile, value in zip(
+                PERCENTILES, np.percentile(durations, PERCENTILES)
+            ):
+                result['p%s' % percentile] = float(value)
+            if explain:
+                result['plan'] = self.explain(query, self.params[0])
+            ret.append(result)
+
+        return ret
+
+    def explain(self, query, params):
+        '''Returns a summary of the plans of the statements
+        executed by query(params)'''
+        statements = []
+
+        def capture(execute, sql, sql_params, many, context):
+            if sql.lstrip().upper().startswith('SELECT'):
+                statements.append((sql, sql_params))
+            return execute(sql, sql_params, many, context)
+
+        with connection.execute_wrapper(capture):
+            query(params)
+
+        ret = []
+        with connection.cursor() as c:
+            for sql, sql_params in statements:
+                c.execute(
+                    'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + sql,
+                    sql_params
+                )
+                plan = c.fetchone()[0]
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                ret.append(summarize_plan(plan[0]))
+
+        return ' | '.join(ret)
+
+
+def summarize_plan(plan):
+    '''Returns a one line summary of an EXPLAIN (FORMAT JSON) plan:
+    the scans, the number of blocks read and the execution time.'''
+    scans = []
+    nodes = [plan['Plan']]
+    while nodes:
+        node = nodes.pop(0)
+        nodes.extend(node.get('Plans', []))
+        if 'Scan' not in node['Node Type']:
+            continue
+        target = node.get('Index Name') or node.get('Relation Name') or ''
+        # same index or table on all the partitions
+        target = re.sub(r'_j\d+(_|$)', r'\1', target)
+        scan = '%s %s' % (node['Node Type'], target)
+        if scan not in scans:
+            scans.append(scan)
+
+    top = plan['Plan']
+    blocks = top.get('Shared Hit Blocks', 0) + top.get('Shared Read Blocks', 0)
+
+    return '%s; %s blocks; %.2f ms' % (
+        ', '.join(scans), blocks, plan.get('Execution Time', 0)
+    )
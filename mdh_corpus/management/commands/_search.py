@@ -0,0 +1,211 @@
+'''
+Indexing of the articles, with their metadata and trigrams,
+in Elasticsearch. See the index_articles action of the art command.
+
+One document per article, its id is the Article id.
+The documents are streamed from the database in batches and sent
+by parallel bulk requests.
+
+A change mark of the last run is saved in the _meta of the mapping,
+the next run only reindexes the articles with a file ingested since
+(IngestedFile.xid) and deletes the documents of the articles
+which no longer exist.
+The mark is a transaction id rather than a time: an ingestion
+which commits after the start of the run but began before it
+(its IngestedFile.ingested is older) is still picked up next time.
+'''
+
+import threading
+from django.db import connection
+from mdh_corpus.models import Article, Article3Term, IngestedFile, Term
+
+DOC_TYPE = 'article'
+
+MAPPING = {
+    'properties': {
+        'fileid': {'type': 'keyword'},
+        'title': {'type': 'text'},
+        'journal': {'type': 'keyword'},
+        'journal_id': {'type': 'integer'},
+        'pub_date': {'type': 'date'},
+        'year': {'type': 'short'},
+        'lang': {'type': 'keyword'},
+        'domains': {'type': 'keyword'},
+        # 'term1 term2 term3', most frequent first
+        'trigrams': {'type': 'keyword'},
+    },
+}
+
+
+class ArticleIndexer(object):
+
+    def __init__(self, hosts, index, chunk_size=500, workers=4):
+        '''chunk_size: number of documents per bulk request,
+        also the number of articles read from the database at once
+        workers: number of concurrent bulk requests'''
+        from elasticsearch import Elasticsearch
+
+        self.client = Elasticsearch(hosts)
+        self.index = index
+        self.chunk_size = chunk_size
+        self.workers = workers
+
+    def create_index(self):
+        '''Creates the index if it doesn't exist.
+        Returns True if it has been created.'''
+        if self.client.indices.exists(index=self.index):
+            return False
+
+        self.client.indices.create(index=self.index, body={
+            'mappings': {DOC_TYPE: MAPPING},
+        })
+
+        return True
+
+    def delete_index(self):
+        self.client.indices.delete(index=self.index, ignore=[404])
+
+    def get_last_indexed(self):
+        '''Returns the change mark of the last run
+        (see get_change_mark()), None if unknown'''
+        mapping = self.client.indices.get_mapping(
+            index=self.index, doc_type=DOC_TYPE
+        )
+        for index in mapping.values():
+            meta = index['mappings'].get(DOC_TYPE, {}).get('_meta', {})
+            # None for the indices marked with a time by older versions
+            return meta.get('indexed_xid')
+
+        return None
+
+    def set_last_indexed(self, value):
+        self.client.indices.put_mapping(
+            index=self.index, doc_type=DOC_TYPE,
+            body={'_meta': {'indexed_xid': value}}
+        )
+
+    def get_change_mark(self):
+        '''Returns the id of the oldest transaction still running.
+        Any file recorded by a transaction which isn't visible yet
+        has an IngestedFile.xid greater or equal.'''
+        with connection.cursor() as c:
+            c.execute('SELECT txid_snapshot_xmin(txid_current_snapshot())')
+            ret = c.fetchone()[0]
+
+        return ret
+
+    def get_changed_article_ids(self, since):
+        '''Returns the ids of the articles with a file
+        (metadata or ngrams) ingested since the change mark <since>'''
+        return list(
+            Article.objects.filter(
+                fileid__in=IngestedFile.objects.filter(
+                    xid__gte=since
+                ).values('fileid')
+            ).values_list('id', flat=True).order_by('id')
+        )
+
+    def get_indexed_ids(self):
+        '''Returns the set of the ids of the indexed articles'''
+        from elasticsearch.helpers import scan
+
+        return set(
+            int(hit['_id']) for hit in scan(
+                self.client, index=self.index, doc_type=DOC_TYPE,
+                query={'query': {'match_all': {}}, '_source': False},
+                size=self.chunk_size * 10,
+            )
+        )
+
+    def delete(self, article_ids):
+        '''Removes the documents of the articles from the index.
+        Returns the number of documents deleted.'''
+        return sum(1 for _ in self._bulk(
+            (
+                {
+                    '_op_type': 'delete',
+                    '_index': self.index,
+                    '_type': DOC_TYPE,
+                    '_id': article_id,
+                }
+                for article_id in article_ids
+            ),
+            # deleting a missing document is not an error
+            ignore=[404]
+        ))
+
+    def index_articles(self, article_ids):
+        '''(Re)indexes the articles. Yields the id of each article
+        once its document has been indexed.'''
+        for info in self._bulk(self.iter_actions(article_ids)):
+            yield int(info['index']['_id'])
+
+    def _bulk(self, actions, **kwargs):
+        # Yields the result of each action, raises BulkIndexError
+        # if any action fails.
+        from elasticsearch.helpers import parallel_bulk
+
+        for ok, info in parallel_bulk(
+            self.client, actions,
+            thread_count=self.workers, chunk_size=self.chunk_size, **kwargs
+        ):
+            yield info
+
+    def iter_actions(self, article_ids):
+        '''Yields the bulk index actions of the articles.
+        Note that parallel_bulk() consumes this generator
+        in one of its own threads.'''
+        try:
+            for i in range(0, len(article_ids), self.chunk_size):
+                for article_id, doc in self.get_documents(
+                    article_ids[i:i + self.chunk_size]
+                ):
+                    yield {
+                        '_index': self.index,
+                        '_type': DOC_TYPE,
+                        '_id': article_id,
+                        '_source': doc,
+                    }
+        finally:
+            if threading.current_thread() is not threading.main_thread():
+                connection.close()
+
+    def get_documents(self, article_ids):
+        '''Returns [(article id, document), ...] for a batch of articles,
+        with two queries.'''
+        articles = Article.objects.filter(id__in=article_ids).select_related(
+            'journal', 'lang'
+        ).prefetch_related('domains').order_by('id')
+
+        with connection.cursor() as c:
+            c.execute('''
+                SELECT t.article_id, array_agg(
+                    t1.label || ' ' || t2.label || ' ' || t3.label
+                    ORDER BY t.freq DESC, t1.label, t2.label, t3.label
+                )
+                FROM {trigrams} t
+                JOIN {term} t1 ON t1.id = t.term1_id
+                JOIN {term} t2 ON t2.id = t.term2_id
+                JOIN {term} t3 ON t3.id = t.term3_id
+                WHERE t.article_id = ANY(%s)
+                GROUP BY t.article_id
+            '''.format(
+                trigrams=Article3Term._meta.db_table,
+                term=Term._meta.db_table,
+            ), [list(article_ids)])
+            trigrams = dict(c.fetchall())
+
+        return [
+            (article.id, {
+                'fileid': article.fileid,
+                'title': article.label,
+                'journal': article.journal.label,
+                'journal_id': article.journal_id,
+                'pub_date': article.pub_date.isoformat(),
+                'year': article.pub_date.year,
+                'lang': article.lang.label if article.lang else None,
+                'domains': [domain.label for domain in article.domains.all()],
+                'trigrams': trigrams.get(article.id, []),
+            })
+            for article in articles
+        ]
@@ -0,0 +1,127 @@
+'''
+Timers and counters of a command run, see KDLCommand.stats.
+
+A timer accumulates the duration and number of calls of a phase
+(e.g. 'parse', 'terms', 'load'), a counter any quantity
+(e.g. 'rows', 'bytes', 'retries').
+The stats of worker processes are sent back with to_dict()
+and added to those of the main process with merge().
+In that case the durations are summed over all the processes.
+The counters of a rolled back transaction are discarded
+(see KDLCommand.commit_in_batches()), the timers are not.
+'''
+
+from contextlib import contextmanager
+import csv
+import json
+import time
+
+
+class RunStats(object):
+
+    def __init__(self):
+        # phase -> [seconds, calls]
+        self.timers = {}
+        # name -> value
+        self.counters = {}
+        self.last_summary = time.time()
+
+    def __bool__(self):
+        return bool(self.timers or self.counters)
+
+    @contextmanager
+    def timer(self, phase):
+        '''Context manager adding the time spent in the block to <phase>'''
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.perf_counter() - t0)
+
+    def add_time(self, phase, seconds, calls=1):
+        timer = self.timers.setdefault(phase, [0.0, 0])
+        timer[0] += seconds
+        timer[1] += calls
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def get(self, name):
+        '''Returns the value of a counter'''
+        return self.counters.get(name, 0)
+
+    def get_counters(self):
+        '''Returns a copy of the counters, see set_counters()'''
+        return dict(self.counters)
+
+    def set_counters(self, counters):
+        '''Resets the counters to a copy returned by get_counters()'''
+        self.counters = dict(counters)
+
+    def get_time(self, phase):
+        '''Returns the number of seconds spent in a phase'''
+        return self.timers.get(phase, [0.0, 0])[0]
+
+    def to_dict(self):
+        return {
+            'timers': {
+                phase: {'seconds': seconds, 'calls': calls}
+                for phase, (seconds, calls) in self.timers.items()
+            },
+            'counters': dict(self.counters),
+        }
+
+    def merge(self, data):
+        '''Adds the timers and counters returned by to_dict()'''
+        for phase, timer in data['timers'].items():
+            self.add_time(phase, timer['seconds'], timer['calls'])
+        for name, value in data['counters'].items():
+            self.count(name, value)
+
+    def is_due(self, interval):
+        '''Returns True once every <interval> seconds,
+        to print periodic summaries. Never if interval is 0.'''
+        now = time.time()
+        if not interval or now - self.last_summary < interval:
+            return False
+        self.last_summary = now
+
+        return True
+
+    def get_summary(self):
+        '''Returns a one line summary: time and share of each phase,
+        then the counters'''
+        total = sum(seconds for seconds, calls in self.timers.values())
+        parts = [
+            '%s %.2f s. (%.0f%%)' % (
+                phase, seconds, 100.0 * seconds / (total or 1)
+            )
+            for phase, (seconds, calls) in sorted(
+                self.timers.items(), key=lambda item: -item[1][0]
+            )
+        ]
+        parts.extend(
+            '%s: %s' % (name, value)
+            for name, value in sorted(self.counters.items())
+        )
+
+        return '; '.join(parts)
+
+    def export(self, path, **info):
+        '''Writes the stats to a .csv file or otherwise a JSON file.
+        info: other values to include (e.g. action, duration)'''
+        if path.endswith('.csv'):
+            with open(path, 'wt', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['kind', 'name', 'value', 'calls'])
+                for name, value in sorted(info.items()):
+                    writer.writerow(['info', name, value, ''])
+                for phase, (seconds, calls) in sorted(self.timers.items()):
+                    writer.writerow(['timer', phase, seconds, calls])
+                for name, value in sorted(self.counters.items()):
+                    writer.writerow(['counter', name, value, ''])
+        else:
+            data = dict(info)
+            data.update(self.to_dict())
+            with open(path, 'wt') as f:
+                json.dump(data, f, indent=2, sort_keys=True)
@@ -0,0 +1,236 @@
+'''
+Synthetic corpus with the same layout and formats as the research data
+under MDH_SOURCE_PATH, to benchmark the ingestion (see the bench command).
+
+    <Domain> Corpus/<Journal> <year>/metadata/<fileid>.xml
+    <Domain> Corpus/<Journal> <year>/ngram3/<fileid>-ngram3.txt
+
+The metadata files are JATS XML with a body of a realistic size.
+The text of each article is a sequence of tokens drawn from a Zipfian
+distribution over a fixed vocabulary (rank r has a frequency
+proportional to 1/r^ZIPF_EXPONENT), with some numbers and alphanumeric
+garbage. Article lengths follow a log-normal distribution.
+The ngram3 file lists the distinct trigrams of that text with their
+frequencies: mostly 1, a few very frequent ones, as in the real data.
+
+The same seed always produces the same corpus.
+'''
+
+from bisect import bisect
+import math
+import os
+import random
+from itertools import accumulate
+from xml.sax.saxutils import escape
+
+ZIPF_EXPONENT = 1.07
+# median and spread of the number of tokens in an article
+ARTICLE_TOKENS_MEDIAN = 4000
+ARTICLE_TOKENS_SIGMA = 0.8
+ARTICLE_TOKENS_MAX = 60000
+# proportion of non-english articles (not ingested by add_ngram3)
+OTHER_LANGUAGES = 0.05
+# proportion of number and alphanumeric tokens
+GARBAGE_TOKENS = 0.03
+# garbage tokens: numbers below GARBAGE_NUMBERS and syllables followed by
+# a number below GARBAGE_SUFFIXES
+GARBAGE_NUMBERS = 3000
+GARBAGE_SUFFIXES = 100
+
+SYLLABLES = [
+    'a', 'an', 'ar', 'be', 'ca', 'co', 'de', 'di', 'e', 'el', 'en', 'er',
+    'fa', 'ge', 'hi', 'i', 'in', 'is', 'ka', 'la', 'li', 'lo', 'ma', 'me',
+    'mo', 'na', 'ne', 'o', 'on', 'or', 'pa', 'pe', 'ra', 're', 'ri', 'ro',
+    'sa', 'se', 'si', 'ta', 'te', 'ti', 'to', 'u', 'un', 've', 'za',
+]
+MONTHS = [
+    'January', 'February', 'March', 'April', 'May', 'June', 'July',
+    'August', 'September', 'October', 'November', 'December',
+]
+
+
+class SyntheticCorpus(object):
+
+    def __init__(self, root, articles=1000, journals=10, domains=3,
+                 vocabulary=50000, seed=1):
+        self.root = root
+        self.articles = articles
+        self.journals = journals
+        self.domains = domains
+        self.vocabulary = vocabulary
+        self.random = random.Random(seed)
+        self.words = self._get_words()
+        self.cum_weights = list(accumulate(
+            1.0 / (rank ** ZIPF_EXPONENT)
+            for rank in range(1, len(self.words) + 1)
+        ))
+
+    def generate(self):
+        '''Writes all the files.
+        Yields (metadata path, ngram3 path or None) for each article.'''
+        for article in self.iter_articles():
+            folder = os.path.join(
+                self.root, '%s Corpus' % article['domain'],
+                'Journal%s %s' % (article['journal'], article['year'])
+            )
+            fileid = article['fileid']
+
+            meta_path = self._write(
+                os.path.join(folder, 'metadata', fileid + '.xml'),
+                self.get_metadata(article)
+            )
+            ngram_path = None
+            if article['english']:
+                ngram_path = self._write(
+                    os.path.join(folder, 'ngram3', fileid + '-ngram3.txt'),
+                    self.get_ngrams(article['tokens'])
+                )
+
+            yield meta_path, ngram_path
+
+    def iter_articles(self):
+        '''Yields a dictionary for each article: fileid, journal (index),
+        domain (label), year, month, english, title and tokens'''
+        rnd = self.random
+        for i in range(self.articles):
+            journal = i % self.journals
+            domain = 'Domain%s' % (journal % self.domains)
+            yield {
+                'fileid': '%s-j%s-a%s' % (domain, journal, i),
+                'journal': journal,
+                'domain': domain,
+                'year': 1980 + rnd.randrange(40),
+                'month': rnd.randrange(12) + 1,
+                'english': rnd.random() >= OTHER_LANGUAGES,
+                'title': ' '.join(rnd.sample(self.words[:2000], 6)),
+                'tokens': self.get_tokens(),
+            }
+
+    def get_labels(self):
+        '''Returns all the tokens which can appear in the articles'''
+        return self.words + [
+            str(number) for number in range(1, GARBAGE_NUMBERS)
+        ] + [
+            '%s%s' % (syllable, number)
+            for syllable in SYLLABLES for number in range(GARBAGE_SUFFIXES)
+        ]
+
+    def get_tokens(self):
+        '''Returns the tokens of a random article'''
+        rnd = self.random
+        count = int(rnd.lognormvariate(
+            math.log(ARTICLE_TOKENS_MEDIAN), ARTICLE_TOKENS_SIGMA
+        ))
+        count = max(3, min(count, ARTICLE_TOKENS_MAX))
+        words = self.words
+        cum_weights = self.cum_weights
+        total = cum_weights[-1]
+        ret = [
+            words[bisect(cum_weights, rnd.random() * total)]
+            for _ in range(count)
+        ]
+        for _ in range(int(count * GARBAGE_TOKENS)):
+            ret[rnd.randrange(count)] = self._get_garbage_token()
+
+        return ret
+
+    def get_ngrams(self, tokens):
+        '''Returns the content of the ngram3 file of the tokens'''
+        return ''.join(
+            '%s\t%s\n' % (trigram, freq)
+            for trigram, freq in sorted(
+                count_trigrams(tokens).items(), key=lambda item: -item[1]
+            )
+        )
+
+    def get_metadata(self, article):
+        '''Returns the content of the JATS metadata file'''
+        tokens = article['tokens']
+        # paragraphs of 100 tokens
+        body = ''.join(
+            '<p>%s</p>\n' % escape(' '.join(tokens[i:i + 100]))
+            for i in range(0, len(tokens), 100)
+        )
+
+        return '''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE article PUBLIC "-//NLM//DTD JATS (Z39.96) Journal Archiving and \
+Interchange DTD v1.0 20120330//EN" "JATS-archivearticle1.dtd">
+<article xmlns:xlink="http://www.w3.org/1999/xlink" \
+article-type="research-article">
+<front>
+<journal-meta>
+<journal-id journal-id-type="publisher-id">j{journal}</journal-id>
+<journal-title-group>
+<journal-title>Synthetic Journal {journal}</journal-title>
+</journal-title-group>
+<issn pub-type="ppub">{journal:04d}-0001</issn>
+<issn pub-type="epub">{journal:04d}-0002</issn>
+</journal-meta>
+<article-meta>
+<article-id pub-id-type="doi">10.0000/{fileid}</article-id>
+<title-group><article-title>{title}</article-title></title-group>
+<pub-date pub-type="ppub"><month>{month}</month><year>{year}</year>\
+</pub-date>
+<custom-meta-group><custom-meta><meta-name>lang</meta-name>\
+<meta-value>{lang}</meta-value></custom-meta></custom-meta-group>
+</article-meta>
+</front>
+<body>
+{body}</body>
+</article>
+'''.format(
+            journal=article['journal'],
+            fileid=article['fileid'],
+            title=escape(article['title'].capitalize()),
+            month=MONTHS[article['month'] - 1],
+            year=article['year'],
+            lang='eng' if article['english'] else 'fre',
+            body=body,
+        )
+
+    def _get_words(self):
+        # distinct pseudo-words, the short ones are the most frequent
+        rnd = self.random
+        ret = []
+        seen = set()
+        length = 1
+        while len(ret) < self.vocabulary:
+            for _ in range(self.vocabulary * 2):
+                word = ''.join(
+                    rnd.choice(SYLLABLES)
+                    for _ in range(rnd.randint(1, length))
+                )
+                if word not in seen:
+                    seen.add(word)
+                    ret.append(word)
+                    if len(ret) == self.vocabulary:
+                        break
+            length += 1
+
+        return ret
+
+    def _get_garbage_token(self):
+        rnd = self.random
+        if rnd.random() < 0.7:
+            return str(rnd.randrange(1, GARBAGE_NUMBERS))
+
+        return '%s%s' % (
+            rnd.choice(SYLLABLES), rnd.randrange(GARBAGE_SUFFIXES)
+        )
+
+    def _write(self, path, content):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wt', encoding='utf-8') as f:
+            f.write(content)
+
+        return path
+
+
+def count_trigrams(tokens):
+    '''Returns a dictionary 'term1 term2 term3' -> frequency'''
+    ret = {}
+    for i in range(len(tokens) - 2):
+        trigram = ' '.join(tokens[i:i + 3])
+        ret[trigram] = ret.get(trigram, 0) + 1
+
+    return ret
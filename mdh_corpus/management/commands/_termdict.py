@@ -0,0 +1,122 @@
+'''
+Compact label -> id dictionary of all the Term records,
+saved in a local file so ingestion can resolve tokens
+without querying the database.
+
+File format:
+    header line: 'mdh-terms <count> <max_id>'
+    <count> ids, 4 bytes each (array 'I')
+    <count> labels, utf-8, separated by new lines
+'''
+
+from array import array
+import os
+from django.db.models import Count, Max
+from mdh_corpus.models import Term
+
+FILE_SIGNATURE = 'mdh-terms'
+
+
+class TermDictionary(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.terms = {}
+        self.max_id = 0
+
+    def __len__(self):
+        return len(self.terms)
+
+    def load(self):
+        '''Load the dictionary from its file.
+        Returns False if the file doesn't exist or is not valid.'''
+        self.terms = {}
+        self.max_id = 0
+
+        if not os.path.exists(self.path):
+            return False
+
+        with open(self.path, 'rb') as f:
+            header = f.readline().decode('ascii').split()
+            if len(header) != 3 or header[0] != FILE_SIGNATURE:
+                return False
+            count, max_id = int(header[1]), int(header[2])
+
+            ids = array('I')
+            ids.fromfile(f, count)
+            labels = f.read().decode('utf-8').split('\n') if count else []
+
+        if len(labels) != count:
+            return False
+
+        self.terms = dict(zip(labels, ids))
+        self.max_id = max_id
+
+        return True
+
+    def save(self):
+        labels = list(self.terms.keys())
+        ids = array('I', self.terms.values())
+
+        # write to a temporary file first so a concurrent load()
+        # never reads a partial file
+        path = self.path + '.tmp'
+        with open(path, 'wb') as f:
+            f.write((
+                '%s %s %s\n' % (FILE_SIGNATURE, len(labels), self.max_id)
+            ).encode('ascii'))
+            ids.tofile(f)
+            f.write('\n'.join(labels).encode('utf-8'))
+        os.replace(path, self.path)
+
+    def sync(self):
+        '''Bring the dictionary up to date with the Term table.
+        Terms are only ever appended to the table, so it is normally
+        enough to read the records with an id above our max_id.
+        If the table has been reset or the counts still differ
+        (e.g. ids committed out of order) the dictionary is rebuilt.
+        Returns the number of labels read from the database.'''
+        ret = 0
+
+        stats = Term.objects.aggregate(count=Count('id'), max_id=Max('id'))
+        db_count, db_max_id = stats['count'], stats['max_id'] or 0
+
+        if db_max_id > self.max_id:
+            ret += self._read_terms(self.max_id)
+
+        if db_max_id < self.max_id or db_count != len(self.terms):
+            self.terms = {}
+            self.max_id = 0
+            ret = self._read_terms(0)
+
+        return ret
+
+    def _read_terms(self, after_id):
+        ret = 0
+        qs = Term.objects.filter(id__gt=after_id).values_list('label', 'id')
+        for label, term_id in qs.order_by().iterator():
+            self.terms[label] = term_id
+            if term_id > self.max_id:
+                self.max_id = term_id
+            ret += 1
+
+        return ret
+
+    def resolve(self, tokens):
+        '''Returns a dictionary of label -> id for the tokens
+        found in the dictionary and the list of the other tokens.'''
+        found = {}
+        missing = []
+        terms = self.terms
+        for token in tokens:
+            term_id = terms.get(token)
+            if term_id is None:
+                missing.append(token)
+            else:
+                found[token] = term_id
+
+        return found, missing
+
+    def update(self, terms):
+        '''Add label -> id pairs read from the Term table.'''
+        self.terms.update(terms)
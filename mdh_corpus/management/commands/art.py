@@ -8,21 +8,41 @@ from mdh_corpus.models import (
     Language,
     Article, Journal,
     Term, Article3Term,
-    Domain, TERM_MAX_LEN
+    Domain, TERM_MAX_LEN,
+    IngestedFile
 )
 from django.db import transaction
 import logging
 from ._kdlcommand import KDLCommand
+from ._termdict import TermDictionary
+from ._catalog import FileCatalog, get_file_kind, get_fileid
+from ._aggregates import TrigramAggregates
+from ._stats import RunStats
+import itertools
 import os
 import re
 from django.conf import settings
 from datetime import date
 from tqdm import tqdm
-import csv
-from django.db.utils import IntegrityError, OperationalError, ProgrammingError
+from django.db.utils import ProgrammingError
 
 logger = logging.getLogger('mdh')
 
+# max number of Article3Term rows written by a single statement
+LOADER_CHUNK_SIZE = 10000
+
+# max value of Article3Term.freq (smallint)
+MAX_FREQ = 32767
+
+# kind of source file -> name of the folders they are found in
+KIND_FOLDERS = {
+    'meta': 'metadata',
+}
+
+# temporary table where the rows of a file are staged before being
+# merged into the trigram table
+STAGING_TABLE = 'mdh_tmp_article3term'
+
 ns_meta = {
     'xlink': "http://www.w3.org/1999/xlink",
     'mml': "http://www.w3.org/1998/Math/MathML",
@@ -35,6 +55,21 @@ class Command(KDLCommand):
 
     def __init__(self, *args, **kwargs):
         super(Command, self).__init__(*args, **kwargs)
+        self.reset_cache()
+        self.term_dict = None
+        self.terms_connection = None
+        self.catalog = None
+        self.meta_buffer = []
+        # ids of the articles to add to the aggregates at the end
+        # of the transaction, see add_ngramn_files()
+        self.aggregate_buffer = []
+        # journal id -> name of the table its trigrams are written to
+        self.ngram_tables = {}
+        self.aggregates = TrigramAggregates()
+        # True in the processes of add_ngramn_files_parallel()
+        self.is_worker = False
+
+    def reset_cache(self):
         self.cache = {
             'domain': {},
             'journal': {},
@@ -42,6 +77,12 @@ class Command(KDLCommand):
             'language': {},
         }
 
+    def on_rollback(self):
+        # cached records may have been created by the failed transaction
+        self.reset_cache()
+        self.meta_buffer = []
+        self.aggregate_buffer = []
+
     def add_arguments(self, parser):
         ret = super(Command, self).add_arguments(parser)
         parser.add_argument(
@@ -52,11 +93,78 @@ class Command(KDLCommand):
             '--reverse', action='store_true', dest='reverse',
             help="reverse processing.",
         )
+        parser.add_argument(
+            '--loader', action='store', dest='loader',
+            choices=['insert', 'copy'], default='insert',
+            help="How to write the Article3Term rows of a file to the "
+            "staging table: INSERT statements or COPY FROM STDIN. "
+            "The staged rows are then merged into Article3Term "
+            "the same way with both loaders.",
+        )
+        parser.add_argument(
+            '-w', '--workers', action='store', dest='workers',
+            type=int, default=1,
+            help="Number of processes used to ingest the files.",
+        )
+        parser.add_argument(
+            '--label-cache-size', action='store', dest='label_cache_size',
+            type=int, default=500000,
+            help="Max number of token labels memoized by each process.",
+        )
+        parser.add_argument(
+            '--term-dict', action='store', dest='term_dict',
+            help="Path to a local file caching all Term labels and ids.",
+        )
+        parser.add_argument(
+            '--term-index', action='store', dest='term_index',
+            default=settings.MDH_TERM_INDEX_PATH,
+            help="Path to the Term autocomplete index file "
+            "rebuilt after ingestion.",
+        )
+        parser.add_argument(
+            '--ignore-manifest', action='store_true', dest='ignore_manifest',
+            help="Process all the files, even those ingested already.",
+        )
+        parser.add_argument(
+            '--full-xml', action='store_true', dest='full_xml',
+            help="Parse the whole XML files rather than the front matter.",
+        )
+        parser.add_argument(
+            '--batch-size', action='store', dest='batch_size',
+            type=int, default=500,
+            help="Number of metadata files written to the DB per transaction "
+            "(unless --commit-every is set).",
+        )
+        parser.add_argument(
+            '--chunk-size', action='store', dest='chunk_size',
+            type=int, default=500,
+            help="Number of articles per Elasticsearch bulk request.",
+        )
+        parser.add_argument(
+            '--journal', action='store', dest='journal',
+            help="Only reset the articles of that journal (label or id).",
+        )
+        parser.add_argument(
+            '--domain', action='store', dest='domain',
+            help="Only reset the articles of that domain (label).",
+        )
+        parser.add_argument(
+            '--catalog', action='store', dest='catalog',
+            default=settings.MDH_CATALOG_PATH,
+            help="Path to a local file caching the list of source files.",
+        )
+        parser.add_argument(
+            '--rescan', action='store_true', dest='rescan',
+            help="List all the source folders again to refresh the catalog.",
+        )
 
         return ret
 
-    def get_files(self, dirname='metadata', ext='.xml'):
+    def get_files(self, kind='meta'):
+        '''Yields the paths of the source files of that kind
+        (e.g. meta, ngram3) which match --filter'''
         source_path = settings.MDH_SOURCE_PATH
+        folder = KIND_FOLDERS.get(kind, kind)
 
         filter = self.options['filter']
         if filter:
@@ -68,24 +176,646 @@ class Command(KDLCommand):
             filter_re = '.*'
         filter_re = '(?ui)' + filter_re
 
-        for p, d, f in os.walk(source_path):
-            if dirname in p:
-                for file in f:
-                    path = os.path.join(p, file)
-                    if ext in path and re.search(filter_re, path):
-                        yield path
+        for path, file_kind in self._iter_files(source_path):
+            if file_kind == kind and folder in os.path.dirname(path) and \
+                    re.search(filter_re, path):
+                yield path
+
+    def _iter_files(self, source_path):
+        '''Yields (path, kind) for all the files under source_path.
+        From the file catalog if --catalog is set.'''
+        if not self.options['catalog']:
+            for p, d, f in os.walk(source_path):
+                for name in f:
+                    yield os.path.join(p, name), get_file_kind(name)
+            return
+
+        if self.catalog is None:
+            self.catalog = self.get_catalog(source_path)
+
+        for path, kind, fileid, size, mtime in self.catalog.iter_files():
+            yield path, kind
+
+    def get_fileid(self, path):
+        '''Returns the fileid of a source file (name without
+        the -ngramN suffix and the extension)'''
+        entry = self.catalog.get_file(path) if self.catalog else None
+        if entry is not None:
+            return entry[1]
+
+        return get_fileid(os.path.basename(path))
+
+    def get_catalog(self, source_path):
+        '''Returns the file catalog, refreshed and saved'''
+        import time
+        t0 = time.time()
+
+        ret = FileCatalog(self.options['catalog'], source_path)
+        ret.load()
+        listed, reused = ret.refresh(rescan=self.options['rescan'])
+        ret.save()
+
+        print(
+            'Catalog: %s folders listed, %s unchanged (%.2f s.)'
+            % (listed, reused, time.time() - t0)
+        )
+
+        return ret
+
+    def select_changed_files(self, paths, kind, update=False):
+        '''Returns the paths which need ingesting according to the
+        ingestion manifest (IngestedFile).
+        Without update: only the files not in the manifest.
+        With update: also the files with a different content.
+        The files in the manifest are stat'ed, not looked up in the
+        catalog, which doesn't see the files modified in place.
+        '''
+        if self.options['ignore_manifest']:
+            return paths
+
+        manifest = {
+            r[0]: r[1:]
+            for r
+            in IngestedFile.objects.filter(kind=kind).values_list(
+                'path', 'size', 'mtime', 'sha1'
+            ).order_by().iterator()
+        }
+
+        ret = []
+        for path in paths:
+            source_path = self._get_source_path(path)
+            entry = manifest.get(source_path)
+            if entry is None:
+                ret.append(path)
+            elif update:
+                size, mtime, sha1 = entry
+                stat = os.stat(path)
+                file_size, file_mtime = stat.st_size, stat.st_mtime
+                if file_size != size or file_mtime != mtime:
+                    if self._hash_file(path) != sha1:
+                        ret.append(path)
+                    else:
+                        # touched but same content
+                        IngestedFile.objects.filter(
+                            path=source_path
+                        ).update(mtime=file_mtime)
+
+        print(
+            '%s files unchanged since their last ingestion.'
+            % (len(paths) - len(ret))
+        )
+
+        return ret
+
+    def record_ingested_file(self, path, kind, fileid):
+        '''Add or update the file in the ingestion manifest'''
+        self.record_ingested_files([(path, kind, fileid)])
+
+    def record_ingested_files(self, files):
+        '''Add or update a list of (path, kind, fileid)
+        in the ingestion manifest'''
+        from django.db import connection
+
+        if not files:
+            return
+
+        params = []
+        for path, kind, fileid in files:
+            stat = os.stat(path)
+            params.extend([
+                self._get_source_path(path), kind, fileid,
+                stat.st_size, stat.st_mtime, self._hash_file(path)
+            ])
+
+        with connection.cursor() as c:
+            c.execute('''
+                INSERT INTO mdh_corpus_ingestedfile
+                (path, kind, fileid, size, mtime, sha1, ingested, xid)
+                VALUES %s
+                ON CONFLICT (path) DO UPDATE SET
+                kind = EXCLUDED.kind, fileid = EXCLUDED.fileid,
+                size = EXCLUDED.size, mtime = EXCLUDED.mtime,
+                sha1 = EXCLUDED.sha1, ingested = EXCLUDED.ingested,
+                xid = EXCLUDED.xid
+            ''' % ', '.join([
+                '(%s, %s, %s, %s, %s, %s, now(), txid_current())'
+            ] * len(files)), params)
+
+    def _get_source_path(self, path):
+        return os.path.relpath(path, settings.MDH_SOURCE_PATH)
+
+    def _hash_file(self, path):
+        import hashlib
+        ret = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                ret.update(block)
+
+        return ret.hexdigest()
 
     def log(self, msg):
         # logger.debug(msg)
         pass
 
     def action_clear_journals(self):
-        [r.delete() for r in Journal.objects.all()]
-        [r.delete() for r in Article.objects.all()]
+        return self.action_reset_journals()
 
     def action_clear_ngrams(self):
-        Article3Term.objects.all().delete()
-        Term.objects.all().delete()
+        return self.action_reset_ngrams()
+
+    def action_reset_journals(self):
+        '''Removes the journals, articles and their trigrams.
+        With --journal or --domain only the matching articles are removed.
+        Note that an article is removed entirely even if
+        it belongs to other domains than the selected one.'''
+        articles = self.get_selected_articles()
+        if articles is None:
+            self._truncate(
+                Journal, Article, Article.domains.through, Article3Term,
+                IngestedFile
+            )
+            for name in self.get_partitions():
+                self._drop_partition(name)
+            self.aggregates.reset()
+            print('All journals and articles removed.')
+            return
+
+        # --domain selects the articles through their domain links,
+        # resolve the ids before anything is deleted
+        article_ids = list(articles.values_list('id', flat=True))
+        articles = Article.objects.filter(id__in=article_ids)
+
+        # the foreign keys are only checked at commit
+        with transaction.atomic():
+            self.aggregates.subtract(article_ids)
+            self._delete_ngram_rows(articles, drop=True)
+
+            files = IngestedFile.objects.filter(
+                fileid__in=articles.values('fileid')
+            ).delete()[0]
+            deleted = self._delete_articles_rows(Article, 'id', articles)
+            links = Article.domains.through.objects.filter(
+                article_id__in=article_ids
+            ).delete()[0]
+
+            journals = 0
+            if self.options['journal'] and not self.options['domain']:
+                journals = self.get_selected_journals().delete()[0]
+
+        print(
+            '%s article domains, %s ingested files, '
+            '%s articles and %s journals removed.'
+            % (links, files, deleted, journals)
+        )
+
+    def action_reset_ngrams(self):
+        '''Removes the trigrams and terms.
+        With --journal or --domain only the trigrams of the matching
+        articles are removed, the terms are kept.'''
+        articles = self.get_selected_articles()
+        if articles is None:
+            self._truncate(Article3Term, Term)
+            IngestedFile.objects.filter(kind='ngram3').delete()
+            self.aggregates.reset()
+            self.reset_term_dict()
+            self.save_term_index()
+            self.reset_search_index()
+            print('All trigrams and terms removed.')
+            return
+
+        article_ids = list(articles.values_list('id', flat=True))
+        self.aggregates.subtract(article_ids)
+        self._delete_ngram_rows(articles)
+        self.save_term_index()
+        self.reset_search_index(article_ids)
+
+        print('%s ingested files removed.' % IngestedFile.objects.filter(
+            kind='ngram3', fileid__in=articles.values('fileid')
+        ).delete()[0])
+
+    def _delete_ngram_rows(self, articles, drop=False):
+        '''Deletes the trigrams of the <articles>.
+        If the trigram table is partitioned and the articles are only
+        selected by journal, the whole partition is truncated instead,
+        or dropped if <drop> is True.'''
+        if not self.options['domain'] and self.is_ngram_table_partitioned():
+            partitions = self.get_partitions()
+            for journal in self.get_selected_journals():
+                name = self.get_partition_name(journal.id)
+                if name not in partitions:
+                    continue
+                if drop:
+                    self._drop_partition(name)
+                    print('Partition %s dropped.' % name)
+                else:
+                    self._truncate_table(name)
+                    print('Partition %s truncated.' % name)
+            return
+
+        print('%s trigrams removed.' % self._delete_articles_rows(
+            Article3Term, 'article_id', articles
+        ))
+
+    def get_selected_journals(self):
+        journal = self.options['journal']
+        if journal.isdigit():
+            ret = Journal.objects.filter(id=int(journal))
+        else:
+            ret = Journal.objects.filter(label=journal)
+
+        return ret
+
+    def get_selected_articles(self):
+        '''Returns a queryset of the articles selected by
+        --journal and --domain or None if none of them is set.'''
+        journal = self.options['journal']
+        domain = self.options['domain']
+        if not journal and not domain:
+            return None
+
+        ret = Article.objects.all()
+        if journal:
+            ret = ret.filter(journal__in=self.get_selected_journals())
+        if domain:
+            ret = ret.filter(domains__label=domain)
+
+        return ret
+
+    def _truncate(self, *models):
+        '''TRUNCATE the tables of the models and reset their sequences.
+        Also empties the tables which reference them (CASCADE).'''
+        self._truncate_table(*[model._meta.db_table for model in models])
+
+    def _truncate_table(self, *tables):
+        from django.db import connection
+        with connection.cursor() as c:
+            c.execute(
+                'TRUNCATE %s RESTART IDENTITY CASCADE' % ', '.join(tables)
+            )
+
+    # ----------------------------------------------------------------
+    # Article3Term partitions
+    #
+    # Once converted by partition_ngrams, the trigram table is
+    # partitioned by journal (LIST on journal_id), one partition per
+    # journal named <table>_j<journal id>. Requires PostgreSQL 11+.
+    # The loaders write directly to the partitions and queries
+    # filtered by journal_id only scan the partitions they need.
+
+    def action_partition_ngrams(self):
+        '''Converts the trigram table into a table partitioned by journal.
+        All the rows are copied, in a single transaction.'''
+        from django.db import connection
+
+        table = Article3Term._meta.db_table
+        if self.is_ngram_table_partitioned():
+            print('The trigram table is already partitioned.')
+            return
+
+        new_table = table + '_partitioned'
+        with transaction.atomic(), connection.cursor() as c:
+            c.execute('LOCK TABLE %s IN ACCESS EXCLUSIVE MODE' % table)
+            c.execute('''
+                CREATE TABLE {new_table}
+                (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)
+                PARTITION BY LIST (journal_id)
+            '''.format(new_table=new_table, table=table))
+            journal_ids = Journal.objects.values_list('id', flat=True)
+            for journal_id in journal_ids.order_by('id'):
+                self._create_partition(c, new_table, journal_id)
+
+            c.execute('''
+                INSERT INTO {new_table}
+                SELECT * FROM {table}
+            '''.format(new_table=new_table, table=table))
+            rows = c.rowcount
+
+            # the same indexes as the original table
+            c.execute(
+                'SELECT indexdef FROM pg_indexes '
+                'WHERE tablename = %s AND indexname <> %s',
+                [table, table + '_pkey']
+            )
+            indexes = [r[0] for r in c.fetchall()]
+
+            c.execute('DROP TABLE %s' % table)
+            c.execute('ALTER TABLE %s RENAME TO %s' % (new_table, table))
+
+            # created on the parent table, inherited by all partitions.
+            # The partition key has to be part of the primary key.
+            c.execute(
+                'ALTER TABLE %s ADD PRIMARY KEY '
+                '(article_id, term1_id, term2_id, term3_id, journal_id)'
+                % table
+            )
+            for index in indexes:
+                c.execute(index)
+            for column, model in [
+                ('article_id', Article),
+                ('term1_id', Term),
+                ('term2_id', Term),
+                ('term3_id', Term),
+            ]:
+                c.execute('''
+                    ALTER TABLE {table} ADD FOREIGN KEY ({column})
+                    REFERENCES {target} (id) DEFERRABLE INITIALLY DEFERRED
+                '''.format(
+                    table=table, column=column,
+                    target=model._meta.db_table
+                ))
+
+        print(
+            'Trigram table partitioned: %s partitions, %s rows.'
+            % (len(journal_ids), rows)
+        )
+
+    def action_partition_detach(self):
+        '''Detaches the partition of a journal (--journal).
+        Its table is kept, its trigrams are no longer queried.'''
+        journal = self.get_partition_journal()
+        if journal is None:
+            return
+
+        name = self.get_partition_name(journal.id)
+        if name not in self.get_partitions():
+            self.print_error('%s is not attached' % name)
+            return
+
+        with transaction.atomic():
+            self.aggregates.subtract(self.get_journal_article_ids(journal))
+            self._execute_sql('ALTER TABLE %s DETACH PARTITION %s' % (
+                Article3Term._meta.db_table, name
+            ))
+        print('Partition %s detached.' % name)
+
+    def action_partition_attach(self):
+        '''Attaches the table of a journal (--journal)
+        previously detached with partition_detach.'''
+        journal = self.get_partition_journal()
+        if journal is None:
+            return
+
+        name = self.get_partition_name(journal.id)
+        if name in self.get_partitions():
+            self.print_error('%s is already attached' % name)
+            return
+
+        with transaction.atomic():
+            self._execute_sql(
+                'ALTER TABLE %s ATTACH PARTITION %s FOR VALUES IN (%s)' % (
+                    Article3Term._meta.db_table, name, journal.id
+                )
+            )
+            self.aggregates.add(self.get_journal_article_ids(journal))
+        print('Partition %s attached.' % name)
+
+    def action_partition_rebuild(self):
+        '''Reloads all the trigrams of a journal (--journal)
+        from the ngram files, without touching the other journals.
+        The files are loaded into a new table which then replaces the
+        partition of the journal in a short transaction.
+        Ignores --filter and the ingestion manifest.'''
+        from django.db import connection
+
+        journal = self.get_partition_journal()
+        if journal is None:
+            return
+
+        table = Article3Term._meta.db_table
+        name = self.get_partition_name(journal.id)
+        rebuilt = name + '_rebuild'
+
+        with connection.cursor() as c:
+            c.execute('DROP TABLE IF EXISTS %s' % rebuilt)
+            c.execute('''
+                CREATE TABLE {rebuilt}
+                (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)
+            '''.format(rebuilt=rebuilt, table=table))
+            # lets ATTACH PARTITION skip the scan of the table
+            c.execute(
+                'ALTER TABLE %s ADD CHECK (journal_id = %s)'
+                % (rebuilt, journal.id)
+            )
+
+        self.options['filter'] = None
+        self.options['ignore_manifest'] = True
+        self.ngram_tables = {journal.id: rebuilt}
+        self.action_add_ngramn('3', journal_ids=[journal.id])
+
+        article_ids = self.get_journal_article_ids(journal)
+        with transaction.atomic(), connection.cursor() as c:
+            self.aggregates.subtract(article_ids)
+            if name in self.get_partitions():
+                self._drop_partition(name)
+            c.execute('ALTER TABLE %s RENAME TO %s' % (rebuilt, name))
+            c.execute(
+                'ALTER TABLE %s ATTACH PARTITION %s FOR VALUES IN (%s)'
+                % (table, name, journal.id)
+            )
+            self.aggregates.add(article_ids)
+
+        print('Partition %s rebuilt.' % name)
+
+    def get_journal_article_ids(self, journal):
+        return list(
+            Article.objects.filter(journal=journal)
+            .values_list('id', flat=True).order_by()
+        )
+
+    def get_partition_journal(self):
+        '''Returns the journal selected with --journal
+        or None (and prints an error) if the partition actions
+        can't be used.'''
+        if not self.is_ngram_table_partitioned():
+            self.print_error(
+                'the trigram table is not partitioned, see partition_ngrams'
+            )
+            return None
+
+        if not self.options['journal']:
+            self.print_error('please select a journal with --journal')
+            return None
+
+        ret = self.get_selected_journals().first()
+        if ret is None:
+            self.print_error('journal not found')
+
+        return ret
+
+    def is_ngram_table_partitioned(self):
+        from django.db import connection
+        with connection.cursor() as c:
+            c.execute(
+                'SELECT relkind FROM pg_class WHERE oid = %s::regclass',
+                [Article3Term._meta.db_table]
+            )
+            ret = c.fetchone()[0] == 'p'
+
+        return ret
+
+    def get_partitions(self):
+        '''Returns the set of names of the attached partitions'''
+        from django.db import connection
+        with connection.cursor() as c:
+            c.execute('''
+                SELECT c.relname FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = %s::regclass
+            ''', [Article3Term._meta.db_table])
+            ret = set(r[0] for r in c.fetchall())
+
+        return ret
+
+    def get_partition_name(self, journal_id):
+        return '%s_j%s' % (Article3Term._meta.db_table, journal_id)
+
+    def get_ngram_table(self, NgramnArticle, journal_id):
+        '''Returns the name of the table the trigrams
+        of the journal are written to.'''
+        return self.ngram_tables.get(journal_id, NgramnArticle._meta.db_table)
+
+    def create_partitions(self, journal_ids):
+        '''Creates the missing partitions for the journals.
+        Returns a dictionary journal id -> partition name,
+        empty if the trigram table is not partitioned.'''
+        from django.db import connection
+
+        ret = {}
+        if not journal_ids or not self.is_ngram_table_partitioned():
+            return ret
+
+        partitions = self.get_partitions()
+        with connection.cursor() as c:
+            for journal_id in sorted(journal_ids):
+                name = self.get_partition_name(journal_id)
+                if name not in partitions:
+                    self._create_partition(
+                        c, Article3Term._meta.db_table, journal_id
+                    )
+                    print('Partition %s created.' % name)
+                ret[journal_id] = name
+
+        return ret
+
+    def _create_partition(self, cursor, table, journal_id):
+        cursor.execute(
+            'CREATE TABLE %s PARTITION OF %s FOR VALUES IN (%s)' % (
+                self.get_partition_name(journal_id), table, journal_id
+            )
+        )
+
+    def _drop_partition(self, name):
+        self._execute_sql('ALTER TABLE %s DETACH PARTITION %s' % (
+            Article3Term._meta.db_table, name
+        ))
+        self._execute_sql('DROP TABLE %s' % name)
+
+    def _execute_sql(self, statement):
+        from django.db import connection
+        with connection.cursor() as c:
+            c.execute(statement)
+
+    def action_export_columns(self):
+        '''Exports the trigrams to memory-mapped numpy column files
+        for offline analysis, see mdh_corpus.columns.
+        The output folder is the first argument, e.g.
+        art export_columns /data/mdh-columns'''
+        import json
+        import time
+        from django.db import connection
+        from django.utils import timezone
+        from mdh_corpus import columns
+
+        if not self.aargs:
+            self.print_error('please provide the path of the output folder')
+            return
+
+        path = self.aargs[0]
+        os.makedirs(path, exist_ok=True)
+        # the export is only valid once the manifest is written
+        manifest_path = os.path.join(path, columns.MANIFEST_FILE)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+
+        t0 = time.time()
+
+        outermost = not connection.in_atomic_block
+        with transaction.atomic(), connection.cursor() as c:
+            # all the files from the same snapshot
+            if outermost:
+                c.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+
+            rows = self._export_columns(
+                c, path, columns.TRIGRAM_COLUMNS, [4, 4, 4, 4, 2], '''
+                    SELECT article_id, term1_id, term2_id, term3_id, freq
+                    FROM {}
+                '''.format(Article3Term._meta.db_table)
+            )
+            articles = self._export_columns(
+                c, path, columns.ARTICLE_COLUMNS, [4, 4, 2], '''
+                    SELECT id, journal_id,
+                    EXTRACT(year FROM pub_date)::smallint
+                    FROM {} ORDER BY id
+                '''.format(Article._meta.db_table)
+            )
+            with open(os.path.join(path, columns.TERMS_FILE), 'wb') as f:
+                c.copy_expert('''
+                    COPY (SELECT id, label FROM {} ORDER BY id) TO STDOUT
+                    WITH (FORMAT csv, DELIMITER E'\\t')
+                '''.format(Term._meta.db_table), f)
+                terms = c.rowcount
+
+        with open(manifest_path, 'wt') as f:
+            json.dump({
+                'rows': rows,
+                'articles': articles,
+                'terms': terms,
+                'exported': timezone.now().isoformat(),
+            }, f, indent=2)
+
+        print(
+            'Exported %s trigrams, %s articles and %s terms to %s (%.2f s.)'
+            % (rows, articles, terms, path, time.time() - t0)
+        )
+
+    def _export_columns(self, cursor, path, columns, sizes, query):
+        '''Writes the fields returned by <query> into one .npy file per
+        column. sizes: size in bytes of each field in postgresql.
+        Returns the number of rows.'''
+        from ._columns import BinaryCopyColumns
+
+        cursor.execute('SELECT COUNT(*) FROM (%s) AS q' % query)
+        ret = cursor.fetchone()[0]
+
+        writer = BinaryCopyColumns(
+            [os.path.join(path, name + '.npy') for name, dtype in columns],
+            sizes,
+            [dtype for name, dtype in columns],
+            ret
+        )
+        cursor.copy_expert(
+            'COPY (%s) TO STDOUT WITH (FORMAT binary)' % query, writer
+        )
+        writer.close()
+
+        return ret
+
+    def _delete_articles_rows(self, model, column, articles):
+        '''Deletes all the records of model where <column> is the id
+        of one of the <articles>, with a single statement.
+        Returns the number of records deleted.'''
+        from django.db import connection
+        sql, params = articles.values('id').query.sql_with_params()
+        with connection.cursor() as c:
+            c.execute(
+                'DELETE FROM {} WHERE {} IN ({})'.format(
+                    model._meta.db_table, column, sql
+                ),
+                params
+            )
+            ret = c.rowcount
+
+        return ret
 
     def action_locate(self):
         c = 0
@@ -95,19 +825,286 @@ class Command(KDLCommand):
 
         print('Found %s files.' % c)
 
+    def action_refresh_aggregates(self):
+        '''Adds all the articles missing from the trigram aggregates'''
+        print('Aggregates: %s articles added.' % self.aggregates.add())
+        self.save_term_index()
+
+    def action_rebuild_aggregates(self):
+        '''Recomputes the trigram aggregates from scratch'''
+        print('Aggregates: %s articles.' % self.aggregates.rebuild())
+        self.save_term_index()
+
+    def action_build_term_index(self):
+        '''Writes the Term autocomplete index file (--term-index)'''
+        if not self.options['term_index']:
+            self.print_error(
+                'please set MDH_TERM_INDEX_PATH or --term-index'
+            )
+            return
+
+        self.save_term_index()
+
+    def action_index_articles(self):
+        '''Indexes the articles, their metadata and trigrams
+        in Elasticsearch, using --workers parallel bulk requests.
+        Only the articles with files ingested since the last run,
+        all of them with --ignore-manifest.'''
+        indexer = self.get_article_indexer()
+
+        since = None
+        if not indexer.create_index() and \
+                not self.options['ignore_manifest']:
+            since = indexer.get_last_indexed()
+
+        # before reading anything, see get_change_mark()
+        started = indexer.get_change_mark()
+
+        article_ids = set(Article.objects.values_list('id', flat=True))
+        deleted = indexer.get_indexed_ids() - article_ids
+        if since:
+            print('Articles ingested since transaction %s' % since)
+            article_ids = indexer.get_changed_article_ids(since)
+        else:
+            article_ids = sorted(article_ids)
+
+        print(
+            '%s articles to index, %s to delete.'
+            % (len(article_ids), len(deleted))
+        )
+        if self.is_dry_run():
+            return
+
+        indexed = 0
+        for _ in tqdm(
+            indexer.index_articles(article_ids), total=len(article_ids)
+        ):
+            indexed += 1
+        deleted = indexer.delete(deleted)
+        indexer.set_last_indexed(started)
+
+        print('Index: %s articles indexed, %s deleted.' % (indexed, deleted))
+
+    def get_article_indexer(self):
+        from ._search import ArticleIndexer
+
+        return ArticleIndexer(
+            settings.MDH_ELASTICSEARCH_HOSTS,
+            settings.MDH_ELASTICSEARCH_INDEX,
+            chunk_size=self.options['chunk_size'],
+            workers=self.options['workers'],
+        )
+
+    def reset_search_index(self, article_ids=None):
+        '''Once committed, reindexes the articles after their trigrams
+        have been removed, or deletes the whole Elasticsearch index
+        if article_ids is None (the next index_articles rebuilds it).'''
+        if not settings.MDH_ELASTICSEARCH_HOSTS or self.is_dry_run():
+            return
+
+        def reset():
+            from elasticsearch.exceptions import ElasticsearchException
+
+            indexer = self.get_article_indexer()
+            try:
+                if not indexer.client.indices.exists(index=indexer.index):
+                    return
+                if article_ids is None:
+                    indexer.delete_index()
+                    print('Index: %s deleted.' % indexer.index)
+                else:
+                    print('Index: %s articles reindexed.' % sum(
+                        1 for _ in indexer.index_articles(article_ids)
+                    ))
+            except ElasticsearchException as e:
+                print(
+                    'WARNING: the search index could not be updated, '
+                    'run index_articles --ignore-manifest (%s)' % e
+                )
+
+        transaction.on_commit(reset)
+
     def action_update_ngram3(self):
         return self.action_add_ngramn('3', update=True)
 
     def action_add_ngram3(self):
         return self.action_add_ngramn('3')
 
-    def action_add_ngramn(self, n, update=False):
-        c = 0
-        nf = 0
-
+    def action_add_ngramn(self, n, update=False, journal_ids=None):
+        '''Adds the trigrams from the ngram files.
+        journal_ids: only the articles of those journals if provided.'''
         assert(n == '3')
 
+        print('locate ngram files')
+        paths = list(self.get_files('ngram%s' % n))
+        if self.options['reverse']:
+            paths = paths[::-1]
+
+        paths = self.select_changed_files(paths, 'ngram' + n, update)
+
+        # resolve all the article ids now, one query for the whole run
+        article_ids = self.get_english_article_ids()
+        articles = []
+        skipped = 0
+        for path in paths:
+            ids = article_ids.get(self.get_fileid(path))
+            if ids is None:
+                continue
+            if journal_ids is not None and ids[1] not in journal_ids:
+                skipped += 1
+                continue
+            articles.append((ids[0], ids[1], path))
+
+        print(
+            'Found %s files. %s missing from DB.'
+            % (len(paths), len(paths) - skipped - len(articles))
+        )
+        if skipped:
+            print('%s files from other journals skipped.' % skipped)
+
+        # create the missing partitions before writing in parallel
+        self.ngram_tables.update(self.create_partitions(
+            set(a[1] for a in articles) - set(self.ngram_tables.keys())
+        ))
+
+        workers = self.options['workers']
+        if workers > 1 and self.is_dry_run():
+            print('WARNING: --workers ignored in dry run mode')
+            workers = 1
+
         self._init_garbage_regs()
+        self.load_term_dict()
+
+        try:
+            if workers > 1:
+                self.add_ngramn_files_parallel(articles, n, update, workers)
+            else:
+                self.add_ngramn_files(tqdm(articles), n, update)
+        finally:
+            self.close_terms_connection()
+
+        print('Aggregates: %s articles added.' % self.stats.get('aggregated'))
+
+        self.print_loader_stats()
+        self.print_label_cache_stats()
+
+        self.save_term_dict()
+        self.save_term_index()
+
+    def print_label_cache_stats(self):
+        hits = self.stats.get('label_cache_hits')
+        misses = self.stats.get('label_cache_misses')
+        print(
+            'Label cache: %s hits; %s misses (%.1f%% hits).' % (
+                hits, misses, 100.0 * hits / ((hits + misses) or 1)
+            )
+        )
+
+    def get_english_article_ids(self):
+        '''Returns a dictionary fileid -> (id, journal_id)
+        of all english articles'''
+        lang_ids = list(
+            Language.objects.filter(
+                label__in=['en', 'EN', 'eng', 'ENG']
+            ).values_list('id', flat=True)
+        )
+
+        return {
+            fileid: (article_id, journal_id)
+            for fileid, article_id, journal_id
+            in Article.objects.filter(
+                lang_id__in=lang_ids
+            ).values_list('fileid', 'id', 'journal_id').order_by().iterator()
+        }
+
+    def load_term_dict(self):
+        path = self.options['term_dict']
+        if not path:
+            return
+
+        self.term_dict = TermDictionary(path)
+        if not self.term_dict.load():
+            print('Term dictionary: building %s' % path)
+        read = self.term_dict.sync()
+        print(
+            'Term dictionary: %s terms, %s read from DB.'
+            % (len(self.term_dict), read)
+        )
+
+    def reset_term_dict(self):
+        '''Deletes the term dictionary file as the Term ids
+        will be reassigned from 1'''
+        path = self.options['term_dict']
+        if not path or self.is_dry_run():
+            return
+
+        def delete():
+            if os.path.exists(path):
+                os.remove(path)
+                print('Term dictionary: %s deleted' % path)
+
+        transaction.on_commit(delete)
+
+    def save_term_dict(self):
+        if self.term_dict is None or self.is_dry_run():
+            return
+
+        # also picks up the terms created by the other workers
+        self.term_dict.sync()
+        self.term_dict.save()
+        print(
+            'Term dictionary: %s terms saved, %s tokens not in dictionary.'
+            % (len(self.term_dict), self.stats.get('term_dict_missed'))
+        )
+
+    def save_term_index(self):
+        '''Rebuilds the Term autocomplete index file from the terms and
+        aggregates once committed. The web workers reload it.'''
+        path = self.options['term_index']
+        if not path or self.is_dry_run():
+            return
+
+        def save():
+            from mdh_corpus.terms import TermPrefixIndex
+            index = TermPrefixIndex.from_database()
+            index.save(path)
+            print('Term index: %s terms saved in %s' % (len(index), path))
+
+        transaction.on_commit(save)
+
+    def add_ngramn_files_parallel(self, articles, n, update, workers):
+        # Each worker process runs add_ngramn_files() on small chunks
+        # of the (article id, path) list. Concurrent creation of the same
+        # Term labels is resolved by _get_or_create_terms().
+        from multiprocessing import Pool
+        from django import db
+
+        chunk_size = max(20, self.options['commit_every'] or 1)
+        chunks = [
+            (articles[i:i + chunk_size], n, update)
+            for i in range(0, len(articles), chunk_size)
+        ]
+
+        # connections must not be shared with the forked processes
+        db.connections.close_all()
+        self.close_terms_connection()
+
+        with Pool(
+            workers, initializer=_init_worker,
+            initargs=(self.options, self.term_dict, self.ngram_tables)
+        ) as pool:
+            progress = tqdm(total=len(articles))
+            for c, stats in pool.imap_unordered(
+                _add_ngramn_files_worker, chunks
+            ):
+                # the durations are summed over the workers
+                self.stats.merge(stats)
+                progress.update(c)
+                self.print_stats_if_due()
+            progress.close()
+
+    def add_ngramn_files(self, articles, n, update=False):
+        c = 0
 
 #         Ngramn = globals()['Ngram%s' % n]
 #         NgramnArticle = globals()['Ngram%sArticle' % n]
@@ -116,41 +1113,55 @@ class Command(KDLCommand):
 
         # self.preload_ngrams(Ngramn)
 
-        csv_pattern = re.compile(r'^.*/(.*?)-ngram' + n + r'\.txt$')
+        # The aggregates are computed from the current trigrams.
+        # In the same transaction as the trigrams, an article is
+        # subtracted before they change and the articles are added
+        # back when the transaction ends.
 
-        print('locate ngram files')
-        paths = list(self.get_files('ngram%s' % n, '.txt'))
-        if self.options['reverse']:
-            paths = paths[::-1]
-        for path in tqdm(paths):
+        def process(item):
+            nonlocal c
             c += 1
-            fileid = csv_pattern.sub(r'\1', path)
-
-            article_ids = Article.objects.filter(
-                fileid=fileid,
-                lang__label__in=['en', 'EN', 'eng', 'ENG']
-            ).values_list('id', flat=True)
-
-            if not article_ids:
-                nf += 1
-            else:
-                while True:
-                    try:
-                        self.add_ngramn(
-                            article_ids[0], path,
-                            Ngramn, NgramnArticle, n, update=update
-                        )
-                        break
-                    except IntegrityError as e:
-                        print(
-                            'Race condition (duplicate key), retry... (%s)'
-                            % str(e))
-                    except OperationalError as e:
-                        print(
-                            'Race condition (operational error), retry... (%s)'
-                            % str(e))
-
-        print('Found %s files. %s missing from DB.' % (c, nf))
+            article_id, journal_id, path = item
+            if update:
+                with self.stats.timer('aggregates'):
+                    self.aggregates.subtract([article_id])
+            self.aggregate_buffer.append(article_id)
+            ret = self.add_ngramn(
+                article_id, journal_id, path,
+                Ngramn, NgramnArticle, n, update=update
+            )
+            if not self.is_worker:
+                self.print_stats_if_due()
+            return ret
+
+        def flush():
+            with self.stats.timer('aggregates'):
+                self.stats.count('aggregated', self.aggregates.add(
+                    self.aggregate_buffer
+                ))
+            self.aggregate_buffer = []
+
+        self.aggregate_buffer = []
+        self.commit_in_batches(articles, process, flush)
+
+        return c
+
+    def print_loader_stats(self):
+        '''Prints the throughput of the staging (--loader)
+        and of the whole load, staging and merge (or diff).'''
+        rows = self.stats.get('rows')
+        staging = self.stats.get_time('load')
+        total = sum(
+            self.stats.get_time(phase) for phase in ['load', 'merge', 'diff']
+        )
+        print(
+            'Loader: %s; rows: %s; staging: %.2f s., %.0f rows/s.; '
+            'with merge: %.2f s., %.0f rows/s.' % (
+                self.options['loader'], rows,
+                staging, rows / (staging or 1),
+                total, rows / (total or 1),
+            )
+        )
 
     def preload_ngrams(self, Ngramn):
         print('preload ngrams')
@@ -163,10 +1174,41 @@ class Command(KDLCommand):
         }
 
     def _init_garbage_regs(self):
+        import functools
+
         self.reg_alphanum = re.compile(r'\d\D|\D\d')
         self.reg_repetition = re.compile(r'(.)\1\1\1')
 
+        # The same tokens occur in most files, memoize their labels.
+        # Shadows the get_garbage_label() method for this instance.
+        self.get_garbage_label = functools.lru_cache(
+            maxsize=self.options['label_cache_size']
+        )(self._get_garbage_label)
+
     def get_garbage_label(self, string):
+        return self._get_garbage_label(string)
+
+    def get_garbage_labels(self, tokens):
+        '''Returns a dictionary token -> label
+        for all the distinct tokens in <tokens>'''
+        get_garbage_label = self.get_garbage_label
+        hits, misses = self.get_label_cache_stats()
+
+        ret = {token: get_garbage_label(token) for token in tokens}
+
+        new_hits, new_misses = self.get_label_cache_stats()
+        self.stats.count('label_cache_hits', new_hits - hits)
+        self.stats.count('label_cache_misses', new_misses - misses)
+
+        return ret
+
+    def get_label_cache_stats(self):
+        '''Returns (hits, misses) of the token -> label cache'''
+        info = self.get_garbage_label.cache_info()
+
+        return info.hits, info.misses
+
+    def _get_garbage_label(self, string):
         ret = string
 
         if ret.startswith('0'):
@@ -183,178 +1225,693 @@ class Command(KDLCommand):
 
         return ret
 
-    def _has_ngram_article(self, NgramnArticle, article_id):
+    def _has_ngram_article(self, table, article_id):
         # skip if we already have ngrams for this article
-        return NgramnArticle.objects.filter(
-            article_id=article_id
-        ).exists()
+        from django.db import connection
+        with connection.cursor() as c:
+            c.execute(
+                'SELECT 1 FROM %s WHERE article_id = %%s LIMIT 1' % table,
+                [article_id]
+            )
+            ret = c.fetchone() is not None
 
-    def _read_ngram_csv(self, path, lines, tokens):
-        max_len = TERM_MAX_LEN
+        return ret
 
-        with open(path, newline='') as f:
-            reader = csv.reader(f, delimiter='\t')
-            for row in reader:
-                string = row[0].strip()
-                substrings = string.split(' ')
-                if len(substrings) != 3:
-                    continue
+    def _iter_ngram_rows(self, path):
+        '''Yields (token1, token2, token3, freq) for each trigram
+        in the ngram file at <path>.
+        Tokens are truncated but not normalised, see get_garbage_labels().
+        The file is memory-mapped and read line by line,
+        nothing else is kept in memory.'''
+        import mmap
 
-                tuple = []
-                for token in substrings:
-                    token = self.get_garbage_label(token[:max_len])
+        max_len = TERM_MAX_LEN
 
-                    tuple.append(token)
-                    tokens[token] = 1
+        with open(path, 'rb') as f:
+            # can't mmap an empty file
+            if not os.fstat(f.fileno()).st_size:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for line in iter(data.readline, b''):
+                    string, _, freq = line.partition(b'\t')
+                    substrings = string.strip().decode('utf-8').split(' ')
+                    if len(substrings) != 3:
+                        continue
+
+                    yield (
+                        substrings[0][:max_len],
+                        substrings[1][:max_len],
+                        substrings[2][:max_len],
+                        int(freq)
+                    )
 
-                # TODO: pre-process the tokens
-                lines[string] = {
-                    'freq': row[1].strip(),
-                    'tokens': tuple
-                }
+    def _iter_chunks(self, iterable, size):
+        iterator = iter(iterable)
+        while True:
+            chunk = list(itertools.islice(iterator, size))
+            if not chunk:
+                break
+            yield chunk
 
     def _get_or_create_terms(self, tokens):
+        term_dict = self.term_dict
+        terms = {}
+        if term_dict is not None:
+            terms, tokens = term_dict.resolve(tokens)
+            self.stats.count('term_dict_missed', len(tokens))
+            if not tokens:
+                return terms, 0
+
         # retrieve all existing ngrams
         # From DB.
         # More scalable and allow concurrent executions
         # But less fast.
-        terms = {
-            term[0]: term[1]
-            for term
-            in Term.objects.filter(
+        terms.update(
+            Term.objects.filter(
                 label__in=tokens
             ).values_list('label', 'id').order_by()
-        }
+        )
 
-        # prepare missing terms records
-        terms_missing = []
-        for token in tokens:
-            if token not in terms:
-                terms_missing.append(
-                    Term(label=token)
-                )
+        terms_missing = sorted(
+            token for token in tokens if token not in terms
+        )
 
-        # bulk create the missing terms records
+        # Create the missing terms.
+        # Other processes may be creating the same labels at the same time.
+        # ON CONFLICT lets them wait for each other instead of failing
+        # with a duplicate key, the sorted insertion order avoids deadlocks.
+        created = 0
         if terms_missing:
-            Term.objects.bulk_create(terms_missing)
-            # add that to <terms>
-            for term in terms_missing:
-                terms[term.label] = term.id
+            with self._get_terms_cursor() as c:
+                c.execute('''
+                    INSERT INTO mdh_corpus_term (label)
+                    SELECT unnest(%s::varchar[]) AS label ORDER BY label
+                    ON CONFLICT (label) DO NOTHING
+                    RETURNING label, id
+                ''', [terms_missing])
+                rows = c.fetchall()
+            created = len(rows)
+            terms.update(rows)
+
+            # labels created by another process in the meantime
+            if created < len(terms_missing):
+                terms.update(
+                    Term.objects.filter(
+                        label__in=[t for t in terms_missing if t not in terms]
+                    ).values_list('label', 'id').order_by()
+                )
+
+        if term_dict is not None:
+            # only once we know those ids won't be rolled back
+            new_terms = {t: terms[t] for t in tokens}
+            transaction.on_commit(lambda: term_dict.update(new_terms))
+
+        return terms, created
+
+    def _get_terms_cursor(self):
+        '''Returns the cursor used to create Term records.
+        Except in dry runs, a separate connection commits them straight
+        away. Transactions spanning several files (--commit-every)
+        would otherwise deadlock, waiting for each other's new terms.'''
+        from django.db import connection
+
+        if self.is_dry_run():
+            return connection.cursor()
+
+        if self.terms_connection is None:
+            self.terms_connection = connection.get_new_connection(
+                connection.get_connection_params()
+            )
+            self.terms_connection.autocommit = True
+
+        return self.terms_connection.cursor()
 
-        return terms, len(terms_missing)
+    def close_terms_connection(self):
+        if self.terms_connection is not None:
+            self.terms_connection.close()
+            self.terms_connection = None
 
-    def _add_article_terms(self, lines, terms, NgramnArticle, article_id):
+    def _add_article_terms(self, rows, terms, table, article_id, journal_id):
+        '''Writes the trigrams of an article to <table>.
+        Different tokens can have the same label, their frequencies
+        are summed as (article, term1, term2, term3) is the primary key.
+        Returns the number of records written.'''
+        from django.db import connection
+
+        self._stage_article_terms(rows, terms, article_id, journal_id)
+
+        with self.stats.timer('merge'), connection.cursor() as c:
+            c.execute('''
+                INSERT INTO {table}
+                (article_id, journal_id, term1_id, term2_id, term3_id, freq)
+                SELECT article_id, journal_id, term1_id, term2_id, term3_id,
+                LEAST(SUM(freq), {max_freq})
+                FROM {staging}
+                GROUP BY article_id, journal_id, term1_id, term2_id, term3_id
+            '''.format(
+                table=table, staging=STAGING_TABLE, max_freq=MAX_FREQ
+            ))
+            ret = c.rowcount
+
+        return ret
+
+    def _stage_article_terms(self, rows, terms, article_id, journal_id):
+        '''Streams <rows> to the (emptied) staging table
+        with the --loader, duplicate trigrams included.
+        terms: token -> term id
+        Returns the number of rows staged.'''
+        from django.db import connection
+
+        loader = getattr(
+            self, '_add_article_terms_' + self.options['loader']
+        )
+
+        with connection.cursor() as c:
+            c.execute('''
+                CREATE TEMPORARY TABLE IF NOT EXISTS
+                %s (
+                    article_id integer, journal_id integer,
+                    term1_id integer, term2_id integer, term3_id integer,
+                    freq integer
+                ) ON COMMIT DELETE ROWS
+            ''' % STAGING_TABLE)
+            c.execute('TRUNCATE %s' % STAGING_TABLE)
+
+        # (token1, token2, token3, freq) -> (id1, id2, id3, freq)
+        rows = (
+            (terms[row[0]], terms[row[1]], terms[row[2]], row[3])
+            for row in rows
+        )
+
+        # also times the second pass over the file (rows is a generator)
+        with self.stats.timer('load'):
+            ret = loader(rows, STAGING_TABLE, article_id, journal_id)
+        self.stats.count('rows', ret)
+
+        return ret
+
+    def _add_article_terms_insert(self, rows, table, article_id,
+                                  journal_id):
         # Raw queries here are more than 3 times faster than using ORM
+        from django.db import connection
 
-        if not lines:
-            return 0
+        ret = 0
+        for chunk in self._iter_chunks(rows, LOADER_CHUNK_SIZE):
+            try:
+                with connection.cursor() as c:
+                    statement = '''INSERT INTO ''' + table + '''
+                    (article_id, journal_id, term1_id, term2_id, term3_id,
+                    freq)
+                    VALUES
+                    ''' + ','.join([
+                        '''(%s, %s, %s, %s, %s, %s)''' % (
+                            article_id, journal_id,
+                            row[0], row[1], row[2], row[3]
+                        )
+                        for row in chunk
+                    ])
+
+                    c.execute(statement)
+            except ProgrammingError as e:
+                print(statement)
+                raise e
+            ret += len(chunk)
 
+        return ret
+
+    def _add_article_terms_copy(self, rows, table, article_id, journal_id):
+        # Stream the rows to postgresql with COPY FROM STDIN.
+        # Avoids building and parsing a huge INSERT statement.
+        import io
         from django.db import connection
 
-        try:
+        ret = 0
+        for chunk in self._iter_chunks(rows, LOADER_CHUNK_SIZE):
+            buffer = io.StringIO()
+            for row in chunk:
+                buffer.write('%s\t%s\t%s\t%s\t%s\t%s\n' % (
+                    article_id, journal_id, row[0], row[1], row[2], row[3]
+                ))
+            buffer.seek(0)
+
             with connection.cursor() as c:
-                statement = '''INSERT INTO mdh_corpus_article3term
-                (article_id, term1_id, term2_id, term3_id, freq)
-                VALUES
-                ''' + ','.join([
-                    '''(%s, %s, %s, %s, %s)''' % (
-                        article_id,
-                        terms[line_info['tokens'][0]],
-                        terms[line_info['tokens'][1]],
-                        terms[line_info['tokens'][2]],
-                        line_info['freq']
+                c.copy_from(
+                    buffer, table,
+                    columns=(
+                        'article_id', 'journal_id',
+                        'term1_id', 'term2_id', 'term3_id', 'freq'
                     )
-                    for line_info in lines.values()
-                ])
+                )
+            ret += len(chunk)
+
+        return ret
+
+    def _update_article_terms(self, rows, terms, table, article_id,
+                              journal_id):
+        '''Replaces the trigrams of an article with <rows>.
+        Only the differences are written: the rows are staged in a
+        temporary table then a single statement deletes, updates and
+        inserts the records which have changed.
+        Duplicate trigrams are merged (summing their frequencies).
+        Returns the number of records deleted, updated or inserted.'''
+        from django.db import connection
 
-                c.execute(statement)
-        except ProgrammingError as e:
-            print(statement)
-            raise e
+        self._stage_article_terms(rows, terms, article_id, journal_id)
+
+        with self.stats.timer('diff'), connection.cursor() as c:
+            c.execute('''
+                WITH new AS (
+                    SELECT term1_id, term2_id, term3_id,
+                    LEAST(SUM(freq), {max_freq}) AS freq
+                    FROM {staging}
+                    GROUP BY term1_id, term2_id, term3_id
+                ), old AS (
+                    SELECT ctid, term1_id, term2_id, term3_id, freq,
+                    row_number() OVER (
+                        PARTITION BY term1_id, term2_id, term3_id
+                    ) AS copy
+                    FROM {table}
+                    WHERE article_id = %(article_id)s
+                ), deleted AS (
+                    DELETE FROM {table} t
+                    USING old o
+                    WHERE t.article_id = %(article_id)s
+                    AND t.ctid = o.ctid
+                    AND (o.copy > 1 OR NOT EXISTS (
+                        SELECT 1 FROM new n
+                        WHERE n.term1_id = o.term1_id
+                        AND n.term2_id = o.term2_id
+                        AND n.term3_id = o.term3_id
+                    ))
+                    RETURNING 1
+                ), updated AS (
+                    UPDATE {table} t SET freq = n.freq
+                    FROM old o JOIN new n
+                    ON n.term1_id = o.term1_id
+                    AND n.term2_id = o.term2_id
+                    AND n.term3_id = o.term3_id
+                    WHERE t.article_id = %(article_id)s
+                    AND t.ctid = o.ctid
+                    AND o.copy = 1
+                    AND o.freq <> n.freq
+                    RETURNING 1
+                ), inserted AS (
+                    INSERT INTO {table}
+                    (article_id, journal_id, term1_id, term2_id, term3_id,
+                    freq)
+                    SELECT %(article_id)s, %(journal_id)s,
+                    term1_id, term2_id, term3_id, freq
+                    FROM new n
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM old o
+                        WHERE n.term1_id = o.term1_id
+                        AND n.term2_id = o.term2_id
+                        AND n.term3_id = o.term3_id
+                    )
+                    RETURNING 1
+                )
+                SELECT
+                (SELECT COUNT(*) FROM deleted),
+                (SELECT COUNT(*) FROM updated),
+                (SELECT COUNT(*) FROM inserted)
+            '''.format(
+                staging=STAGING_TABLE,
+                table=table,
+                max_freq=MAX_FREQ
+            ), {'article_id': article_id, 'journal_id': journal_id})
+            deleted, updated, inserted = c.fetchone()
+        self.stats.count('changed', deleted + updated + inserted)
+
+        self.log(
+            'article %s: %s deleted, %s updated, %s inserted'
+            % (article_id, deleted, updated, inserted)
+        )
 
-        return len(lines)
+        return deleted + updated + inserted
 
-    def _add_article_terms_orm(self, lines, terms, NgramnArticle, article_id):
+    def _add_article_terms_orm(self, rows, table, article_id, journal_id):
         assert(0)
         article_nterms = [
-            NgramnArticle(**{
+            Article3Term(**{
                 'article_id': article_id,
-                'term1_id': terms[line_info['tokens'][0]],
-                'term2_id': terms[line_info['tokens'][1]],
-                'term3_id': terms[line_info['tokens'][2]],
-                'freq': line_info['freq']
+                'journal_id': journal_id,
+                'term1_id': row[0],
+                'term2_id': row[1],
+                'term3_id': row[2],
+                'freq': row[3]
             })
-            for line_info in lines.values()
+            for row in rows
         ]
 
         # bulk create the ngram_article records
         if article_nterms:
-            NgramnArticle.objects.bulk_create(article_nterms)
+            Article3Term.objects.bulk_create(article_nterms)
 
         return len(article_nterms)
 
-    @transaction.atomic
-    def add_ngramn(self, article_id, path,
+    def add_ngramn(self, article_id, journal_id, path,
                    Ngramn, NgramnArticle, n, update=False):
+        '''Adds the trigrams of a file to the article.
+        Returns the number of Article3Term records written.'''
 
-        # TODO: check all ngrams are normalised in CSV (e.g. lowercase)
-        if not update and self._has_ngram_article(NgramnArticle, article_id):
-            return
+        fileid = self.get_fileid(path)
 
-        # read all pairs from CSV (ngram, freq)
-        lines = {}
-        tokens = {}
+        table = self.get_ngram_table(NgramnArticle, journal_id)
 
-        self._read_ngram_csv(path, lines, tokens)
+        stats = self.stats
+        stats.count('files')
 
-        terms, new_terms_count = self._get_or_create_terms(tokens)
+        # TODO: check all ngrams are normalised in CSV (e.g. lowercase)
+        if not update and self._has_ngram_article(table, article_id):
+            stats.count('skipped')
+            with stats.timer('manifest'):
+                self.record_ingested_file(path, 'ngram' + n, fileid)
+            return 0
 
-        # prepare all article_nterms
-        article_terms_count = self._add_article_terms(
-            lines, terms, NgramnArticle, article_id
-        )
+        # first pass over the file: collect the distinct tokens
+        lines = 0
+        tokens = set()
+        with stats.timer('parse'):
+            for row in self._iter_ngram_rows(path):
+                lines += 1
+                tokens.add(row[0])
+                tokens.add(row[1])
+                tokens.add(row[2])
+        stats.count('lines', lines)
+        stats.count('bytes', os.path.getsize(path))
+        stats.count('tokens', len(tokens))
+
+        with stats.timer('classify'):
+            labels = self.get_garbage_labels(tokens)
+
+        with stats.timer('terms'):
+            terms, new_terms_count = self._get_or_create_terms(
+                set(labels.values())
+            )
+        stats.count('new_terms', new_terms_count)
 
-        print(
-            'CSV ngrams: %s; found: %s; missing: %s; ngram_articles: %s [%s]'
-            % (
-                len(lines),
-                len(terms),
-                new_terms_count,
-                article_terms_count,
-                path
+        # token -> term id
+        token_ids = {
+            token: terms[label]
+            for token, label in labels.items()
+        }
+
+        # second pass: stream the rows to the table
+        if update:
+            article_terms_count = self._update_article_terms(
+                self._iter_ngram_rows(path), token_ids, table,
+                article_id, journal_id
+            )
+        else:
+            article_terms_count = self._add_article_terms(
+                self._iter_ngram_rows(path), token_ids, table,
+                article_id, journal_id
             )
-        )
+
+        if self.options.get('verbosity', 1) > 1:
+            tqdm.write(
+                'CSV ngrams: %s; found: %s; missing: %s; '
+                'ngram_articles: %s [%s]' % (
+                    lines,
+                    len(terms),
+                    new_terms_count,
+                    article_terms_count,
+                    path
+                )
+            )
+
+        with stats.timer('manifest'):
+            self.record_ingested_file(path, 'ngram' + n, fileid)
+
+        return article_terms_count
 
     def action_update_meta(self):
         return self.action_add_meta(update=True)
 
     def action_add_meta(self, update=False):
-        c = 0
-        for path in tqdm(list(self.get_files())):
-            c += 1
-            self.log(path)
-            # print(path)
-            self.read_and_upload_meta(path, update=update)
+        paths = self.select_changed_files(
+            list(self.get_files()), 'meta', update
+        )
 
-        print('Found %s files.' % c)
+        # no need to read the files of the articles we already have,
+        # they are only recorded in the manifest (with empty data)
+        known_paths = []
+        if not update:
+            fileids = set(
+                Article.objects.values_list('fileid', flat=True)
+                .order_by().iterator()
+            )
+            new_paths = []
+            for path in paths:
+                if self.get_fileid(path) in fileids:
+                    known_paths.append(path)
+                else:
+                    new_paths.append(path)
+            paths = new_paths
+
+        # files are written in bulk at the end of each transaction,
+        # by default one transaction every --batch-size files.
+        # A failed batch is rolled back and retried by
+        # commit_in_batches().
+
+        def process(item):
+            self.meta_buffer.append(item)
+            return 1
+
+        def flush():
+            self.upload_meta_batch(self.meta_buffer, update)
+            self.meta_buffer = []
+
+        pool = self.get_meta_pool(paths)
+        try:
+            items = itertools.chain(
+                ((path, {}) for path in known_paths),
+                self.read_meta_files(paths, pool)
+            )
+            self.meta_buffer = []
+            self.commit_in_batches(
+                tqdm(items, total=len(known_paths) + len(paths)),
+                process, flush, commit_every=self.options['batch_size']
+            )
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+        print('Found %s files.' % (len(known_paths) + len(paths)))
+        if self.stats.get('unreadable'):
+            print('WARNING: %s files could not be parsed.' % (
+                self.stats.get('unreadable')
+            ))
+
+    def get_meta_pool(self, paths):
+        '''Returns the Pool of --workers processes parsing the metadata
+        files, None if they are parsed by this process.
+        Must be called before any transaction is open.'''
+        workers = self.options['workers']
+        if workers < 2 or not paths:
+            return None
+        if self.is_dry_run():
+            print('WARNING: --workers ignored in dry run mode')
+            return None
+
+        from multiprocessing import Pool
+        from django import db
+
+        # connections must not be shared with the forked processes
+        # (the workers don't use the database)
+        db.connections.close_all()
+
+        return Pool(
+            workers, initializer=_init_worker, initargs=(self.options, None)
+        )
+
+    def read_meta_files(self, paths, pool=None):
+        '''Yields (path, data) for each metadata file in <paths>.
+        data is None if the file can't be parsed.
+        The files are parsed by the <pool> processes if provided,
+        see get_meta_pool().'''
+        if pool is not None:
+            items = pool.imap(_read_meta_file_worker, paths, chunksize=20)
+        else:
+            items = (self._read_meta_file(path) for path in paths)
 
-    @transaction.atomic
-    def read_and_upload_meta(self, path, update=False):
+        for path, data in items:
+            if data is None:
+                tqdm.write('WARNING: could not parse %s' % path)
+            yield path, data
 
+    def _read_meta_file(self, path):
         data = {}
-        data['article.fileid'] = re.sub(r'^.*/(.*?).xml$', r'\1', path)
+        data['article.fileid'] = self.get_fileid(path)
+
+        return path, self.read_meta_file(path, data)
+
+    def upload_meta_batch(self, items, update=False):
+        '''Creates (or updates) the articles from a list of
+        (path, data) with bulk queries
+        and records the files in the ingestion manifest.
+        Files without data (None) are not recorded, so they are
+        read again by the next run.'''
+        self.upload_meta_datas([data for path, data in items if data], update)
+
+        self.record_ingested_files([
+            (path, 'meta', self.get_fileid(path))
+            for path, data in items
+            if data is not None
+        ])
+        unreadable = [path for path, data in items if data is None]
+        if unreadable:
+            self.stats.count('unreadable', len(unreadable))
+
+    def upload_meta_datas(self, datas, update=False):
+        article_ids = dict(
+            Article.objects.filter(
+                fileid__in=[data['article.fileid'] for data in datas]
+            ).values_list('fileid', 'id').order_by()
+        )
+
+        # the same article can be found in more than one domain
+        articles = {}
+        domain_ids = {}
+        for data in datas:
+            article, domain = self.get_meta_article(data)
+            articles[article.fileid] = article
+            domain_ids.setdefault(article.fileid, set()).add(domain.id)
+
+        new_articles = []
+        updated_articles = []
+        for fileid, article in articles.items():
+            article.id = article_ids.get(fileid)
+            if article.id is None:
+                new_articles.append(article)
+            elif update:
+                updated_articles.append(article)
+
+        if new_articles:
+            self.log('%s new articles' % len(new_articles))
+            Article.objects.bulk_create(new_articles)
+        # their year, journal or domains may change
+        updated_ids = [a.id for a in updated_articles]
+        if updated_ids:
+            self.aggregates.subtract(updated_ids)
+        self._update_articles(updated_articles)
+
+        # add the domains to the articles
+        ArticleDomain = Article.domains.through
+        pairs = set(
+            (article.id, domain_id)
+            for article in new_articles + updated_articles
+            for domain_id in domain_ids[article.fileid]
+        )
+        if updated_articles:
+            pairs -= set(
+                ArticleDomain.objects.filter(
+                    article_id__in=updated_ids
+                ).values_list('article_id', 'domain_id').order_by()
+            )
+        ArticleDomain.objects.bulk_create([
+            ArticleDomain(article_id=article_id, domain_id=domain_id)
+            for article_id, domain_id in pairs
+        ])
+
+        if updated_ids:
+            self.aggregates.add(updated_ids)
+
+    def _update_articles(self, articles):
+        # Django 2.0 has no bulk update,
+        # one UPDATE ... FROM (VALUES ...) statement for all the articles
+        if not articles:
+            return
+
+        from django.db import connection
 
-        article = Article.objects.filter(
-            fileid=data['article.fileid']
-        ).first()
+        params = []
+        for article in articles:
+            params.extend([
+                article.id, article.journal_id, article.lang_id,
+                article.label, article.pub_date
+            ])
+
+        with connection.cursor() as c:
+            # o is the row before the update
+            c.execute('''
+                UPDATE mdh_corpus_article AS a SET
+                journal_id = v.journal_id, lang_id = v.lang_id,
+                label = v.label, pub_date = v.pub_date
+                FROM (VALUES %s)
+                AS v (id, journal_id, lang_id, label, pub_date),
+                mdh_corpus_article AS o
+                WHERE a.id = v.id AND o.id = a.id
+                RETURNING a.id, a.journal_id, o.journal_id
+            ''' % ', '.join(
+                ['(%s, %s, %s, %s::varchar, %s::date)'] * len(articles)
+            ), params)
+            moved = [
+                (article_id, journal_id)
+                for article_id, journal_id, old_journal_id in c.fetchall()
+                if journal_id != old_journal_id
+            ]
+
+        self._move_article_terms(moved)
+
+    def _move_article_terms(self, articles):
+        '''Moves the trigrams of articles which changed journal,
+        in the same transaction. Article3Term.journal is a copy of
+        Article.journal and the key of the trigram partitions.
+        articles: [(article id, new journal id), ...]'''
+        if not articles:
+            return
 
-        if update or article is None:
-            try:
-                if self.read_meta_file(path, data):
-                    self.upload_meta(data, article)
-            except Exception:
-                print(data)
-                raise
+        from django.db import connection
+
+        self.ngram_tables.update(self.create_partitions(
+            set(a[1] for a in articles) - set(self.ngram_tables.keys())
+        ))
+
+        # rows deleted then inserted again through the parent table,
+        # which routes them to the partition of the new journal
+        with connection.cursor() as c:
+            c.execute('''
+                WITH moved AS (
+                    DELETE FROM {table} t
+                    USING (VALUES {values}) AS v (article_id, journal_id)
+                    WHERE t.article_id = v.article_id
+                    RETURNING t.article_id, v.journal_id,
+                    t.term1_id, t.term2_id, t.term3_id, t.freq
+                )
+                INSERT INTO {table}
+                (article_id, journal_id, term1_id, term2_id, term3_id, freq)
+                SELECT * FROM moved
+            '''.format(
+                table=Article3Term._meta.db_table,
+                values=', '.join(['(%s, %s)'] * len(articles)),
+            ), [value for article in articles for value in article])
+            rows = c.rowcount
+
+        print(
+            '%s articles moved to another journal, %s trigrams moved.'
+            % (len(articles), rows)
+        )
+
+    def _parse_front_matter(self, path):
+        '''Returns the <front> element of the XML file.
+        Stops parsing the file as soon as <front> is complete,
+        the body of the article is never read.
+        Falls back to the whole document if there is no <front>.'''
+        import xml.etree.ElementTree as ET
+
+        in_front = False
+        with open(path, 'rb') as f:
+            for event, elem in ET.iterparse(f, events=('start', 'end')):
+                if elem.tag == 'front':
+                    if event == 'end':
+                        return elem
+                    in_front = True
+                elif event == 'end' and not in_front:
+                    # not part of the front matter, free it
+                    elem.clear()
+
+        return ET.parse(path).getroot()
 
     def get_or_create(self, Amodel, label):
         # get or create a record in Amodel table
@@ -380,13 +1937,9 @@ class Command(KDLCommand):
 
         return ret, created
 
-    def upload_meta(self, data, article):
-
-        if article is None:
-            self.log('new article')
-            article = Article()
-
-        article.fileid = data['article.fileid']
+    def get_meta_article(self, data):
+        '''Returns an unsaved Article and its Domain
+        from the metadata read by read_meta_file()'''
 
         # update the journal
         journal, created = self.get_or_create(
@@ -408,28 +1961,30 @@ class Command(KDLCommand):
             Domain, data['domain.label'])
 
         # article
-        article.journal = journal
-        article.lang = language
-        article.label = data['article.label']
-        article.pub_date = date(
-            int(data['article.pub_date.year']),
-            int(data['article.pub_date.month']),
-            1
+        article = Article(
+            fileid=data['article.fileid'],
+            journal=journal,
+            lang=language,
+            label=data['article.label'],
+            pub_date=date(
+                int(data['article.pub_date.year']),
+                int(data['article.pub_date.month']),
+                1
+            )
         )
-        article.save()
-        article.domains.add(domain)
 
-        # update the article
+        return article, domain
 
     def read_meta_file(self, path, data):
         import xml.etree.ElementTree as ET
         try:
-            tree = ET.parse(path)
+            if self.options['full_xml']:
+                root = ET.parse(path).getroot()
+            else:
+                root = self._parse_front_matter(path)
         except ET.ParseError:
             return None
 
-        root = tree.getroot()
-
         data['domain.label'] = 'unknown'
         for match in re.findall(r'([^/]+?)\s+Corpus', path):
             data['domain.label'] = match.strip().lower()
@@ -487,3 +2042,34 @@ class Command(KDLCommand):
             data['article.pub_date.year'] = year
 
         return data
+
+
+# Command instance of a worker process, see add_ngramn_files_parallel()
+_worker_command = None
+
+
+def _init_worker(options, term_dict, ngram_tables=None):
+    global _worker_command
+    _worker_command = Command()
+    _worker_command.options = options
+    _worker_command.term_dict = term_dict
+    _worker_command.ngram_tables = ngram_tables or {}
+    _worker_command.is_worker = True
+    _worker_command._init_garbage_regs()
+
+
+def _add_ngramn_files_worker(args):
+    articles, n, update = args
+    command = _worker_command
+    # only the stats of this chunk, merged by the main process
+    command.stats = RunStats()
+    try:
+        c = command.add_ngramn_files(articles, n, update)
+    finally:
+        command.close_terms_connection()
+
+    return c, command.stats.to_dict()
+
+
+def _read_meta_file_worker(path):
+    return _worker_command._read_meta_file(path)
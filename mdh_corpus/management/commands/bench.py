@@ -0,0 +1,342 @@
+'''
+Benchmarks of the art command on a synthetic corpus,
+see _synthetic.py. Nothing is written to the project database.
+
+    # writes a synthetic corpus of 2000 articles
+    python manage.py bench generate /tmp/mdh-bench --articles 2000
+    # ingests it into a throwaway database and reports the throughput
+    python manage.py bench ingest /tmp/mdh-bench --workers 4
+    # times the trigram queries on 1000 then 10000 synthetic articles
+    python manage.py bench queries --scales 1000,10000
+'''
+
+import json
+import os
+import sys
+import time
+from django.conf import settings
+from tqdm import tqdm
+from ._kdlcommand import KDLCommand
+from ._synthetic import SyntheticCorpus
+
+# (art action, kind of source files, model counted after the action)
+INGESTION_PHASES = [
+    ('add_meta', 'metadata', 'Article'),
+    ('add_ngram3', 'ngram3', 'Article3Term'),
+    # nothing has changed, only checks the ingestion manifest
+    ('update_ngram3', 'ngram3', 'Article3Term'),
+]
+
+
+class Command(KDLCommand):
+    help = 'benchmarks'
+
+    def add_arguments(self, parser):
+        ret = super(Command, self).add_arguments(parser)
+        parser.add_argument(
+            '--articles', action='store', dest='articles',
+            type=int, default=1000,
+            help="Number of articles in the synthetic corpus.",
+        )
+        parser.add_argument(
+            '--journals', action='store', dest='journals',
+            type=int, default=10,
+            help="Number of journals in the synthetic corpus.",
+        )
+        parser.add_argument(
+            '--vocabulary', action='store', dest='vocabulary',
+            type=int, default=50000,
+            help="Number of distinct words in the synthetic corpus.",
+        )
+        parser.add_argument(
+            '--seed', action='store', dest='seed',
+            type=int, default=1,
+            help="Seed of the synthetic corpus generator.",
+        )
+        parser.add_argument(
+            '-w', '--workers', action='store', dest='workers',
+            type=int, default=1,
+            help="Passed to art: number of ingestion processes.",
+        )
+        parser.add_argument(
+            '--loader', action='store', dest='loader',
+            choices=['insert', 'copy'], default='insert',
+            help="Passed to art: how to stage Article3Term rows.",
+        )
+        parser.add_argument(
+            '--scales', action='store', dest='scales', default='100,1000',
+            help="Numbers of articles loaded for the query benchmark, "
+            "comma separated.",
+        )
+        parser.add_argument(
+            '--repeat', action='store', dest='repeat',
+            type=int, default=50,
+            help="Number of times each query is run (different terms).",
+        )
+        parser.add_argument(
+            '--partition', action='store_true', dest='partition',
+            help="Partition the trigram table by journal "
+            "before the query benchmark.",
+        )
+        parser.add_argument(
+            '-o', '--output', action='store', dest='output',
+            help="Also write the results to that JSON file.",
+        )
+
+        return ret
+
+    def action_generate(self):
+        '''Writes a synthetic corpus in the folder given as argument'''
+        path = self.get_folder_argument()
+        if not path:
+            return
+
+        corpus = SyntheticCorpus(
+            path,
+            articles=self.options['articles'],
+            journals=self.options['journals'],
+            vocabulary=self.options['vocabulary'],
+            seed=self.options['seed'],
+        )
+        size = 0
+        for paths in tqdm(corpus.generate(), total=corpus.articles):
+            size += sum(os.path.getsize(p) for p in paths if p)
+
+        print(
+            '%s articles written in %s (%.1f MB).'
+            % (corpus.articles, path, size / 1024.0 / 1024)
+        )
+
+    def action_ingest(self):
+        '''Runs the ingestion actions of art on the synthetic corpus
+        in the folder given as argument, against a throwaway database.
+        Reports files/s, rows/s and the peak RSS of each action.'''
+        from django.db import connection
+
+        path = self.get_folder_argument()
+        if not path:
+            return
+
+        files = self.count_files(path)
+        if not files['metadata']:
+            self.print_error(
+                'no metadata files in %s, see bench generate' % path
+            )
+            return
+
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False
+        )
+        try:
+            results = [
+                self.run_phase(path, action, files[kind], model)
+                for action, kind, model in INGESTION_PHASES
+            ]
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        self.print_results(results)
+
+        if self.options['output']:
+            with open(self.options['output'], 'wt') as f:
+                json.dump({
+                    'options': {
+                        key: self.options[key]
+                        for key in ['workers', 'loader']
+                    },
+                    'files': files,
+                    'results': results,
+                }, f, indent=2)
+
+    def action_queries(self):
+        '''Loads a synthetic dataset at each scale factor (--scales)
+        into a throwaway database and times a fixed workload of trigram
+        queries. Reports latency percentiles and plan summaries.'''
+        from django.core.management import call_command
+        from django.db import connection
+        from mdh_corpus.models import Article3Term
+        from .art import Command as ArtCommand
+        from ._querybench import QueryDataset, QueryWorkload
+
+        try:
+            scales = sorted(
+                int(scale) for scale in self.options['scales'].split(',')
+            )
+        except ValueError:
+            self.print_error('invalid --scales: %s' % self.options['scales'])
+            return
+
+        corpus = SyntheticCorpus(
+            None,
+            articles=scales[-1],
+            journals=self.options['journals'],
+            vocabulary=self.options['vocabulary'],
+            seed=self.options['seed'],
+        )
+
+        results = []
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False
+        )
+        try:
+            dataset = QueryDataset(corpus)
+            dataset.setup()
+            if self.options['partition']:
+                call_command('art', 'partition_ngrams')
+                ArtCommand().create_partitions(dataset.journal_ids)
+
+            workload = None
+            for scale in scales:
+                print('Loading %s articles...' % scale)
+                t0 = time.time()
+                dataset.load(scale)
+                dataset.analyze()
+                load_duration = time.time() - t0
+
+                # same parameters at all scales
+                if workload is None:
+                    workload = QueryWorkload(
+                        dataset, self.options['repeat'], self.options['seed']
+                    )
+
+                result = {
+                    'articles': dataset.loaded,
+                    'rows': Article3Term.objects.count(),
+                    'load_duration': load_duration,
+                    'queries': workload.run(),
+                }
+                self.print_query_results(result)
+                results.append(result)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        if self.options['output']:
+            with open(self.options['output'], 'wt') as f:
+                json.dump({
+                    'options': {
+                        key: self.options[key]
+                        for key in ['repeat', 'seed', 'partition']
+                    },
+                    'scales': results,
+                }, f, indent=2)
+
+    def print_query_results(self, result):
+        print('')
+        print(
+            '%s articles, %s trigram records (loaded in %.1f s.)' % (
+                result['articles'], result['rows'], result['load_duration']
+            )
+        )
+        print(
+            '%-16s %9s %9s %9s %9s  %s' % (
+                'query', 'p50 (ms)', 'p90', 'p99', 'max', 'plan'
+            )
+        )
+        for query in result['queries']:
+            print(
+                '%-16s %9.2f %9.2f %9.2f %9.2f  %s' % (
+                    query['query'], query['p50'], query['p90'],
+                    query['p99'], query['max'], query.get('plan', ''),
+                )
+            )
+
+    def run_phase(self, path, action, files, model):
+        '''Runs an art action in a child process.
+        Returns the measures as a dictionary.'''
+        from django.apps import apps
+        from django.db import connections
+
+        model = apps.get_model('mdh_corpus', model)
+        rows = model.objects.count()
+
+        # the child must not share the connections of the parent
+        connections.close_all()
+
+        print('%s...' % action)
+        t0 = time.time()
+        pid = os.fork()
+        if pid == 0:
+            self._run_child(path, action)
+        _, status, usage = os.wait4(pid, 0)
+        duration = time.time() - t0
+
+        rows = model.objects.count() - rows
+
+        return {
+            'action': action,
+            'ok': status == 0,
+            'files': files,
+            'duration': duration,
+            'files_per_second': files / (duration or 1),
+            'rows': rows,
+            'rows_per_second': rows / (duration or 1),
+            # in KB on Linux, largest of the child and its workers
+            'max_rss': usage.ru_maxrss,
+        }
+
+    def _run_child(self, path, action):
+        # Runs the art action and exits, never returns.
+        from django.core.management import call_command
+
+        code = 1
+        try:
+            if self.options['verbosity'] < 2:
+                devnull = os.open(os.devnull, os.O_WRONLY)
+                os.dup2(devnull, sys.stdout.fileno())
+                os.dup2(devnull, sys.stderr.fileno())
+
+            settings.MDH_SOURCE_PATH = path
+            call_command(
+                'art', action,
+                workers=self.options['workers'],
+                loader=self.options['loader'],
+                # never touch the files of the project
+                catalog=None, term_dict=None, term_index=None,
+            )
+            code = 0
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+
+    def print_results(self, results):
+        print('')
+        print(
+            '%-15s %7s %9s %9s %10s %10s %10s' % (
+                'action', 'files', 'seconds', 'files/s',
+                'rows', 'rows/s', 'RSS (MB)'
+            )
+        )
+        for result in results:
+            print(
+                '%-15s %7s %9.2f %9.1f %10s %10.0f %10.1f%s' % (
+                    result['action'],
+                    result['files'],
+                    result['duration'],
+                    result['files_per_second'],
+                    result['rows'],
+                    result['rows_per_second'],
+                    result['max_rss'] / 1024.0,
+                    '' if result['ok'] else ' FAILED',
+                )
+            )
+
+    def count_files(self, path):
+        '''Returns {'metadata': n, 'ngram3': n}, the number of
+        source files of each kind under path'''
+        ret = {'metadata': 0, 'ngram3': 0}
+        for dirpath, dirnames, filenames in os.walk(path):
+            for kind in ret:
+                if os.path.basename(dirpath) == kind:
+                    ret[kind] += len(filenames)
+
+        return ret
+
+    def get_folder_argument(self):
+        if not self.aargs:
+            self.print_error('please provide the path of the corpus folder')
+            return None
+
+        return self.aargs[0]
@@ -0,0 +1,26 @@
+# Generated by Django 2.0 on 2026-10-18 12:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mdh_corpus', '0017_auto_20180812_1541'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestedFile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=500, unique=True)),
+                ('kind', models.CharField(max_length=10)),
+                ('fileid', models.CharField(db_index=True, max_length=100)),
+                ('size', models.BigIntegerField()),
+                ('mtime', models.FloatField()),
+                ('sha1', models.CharField(max_length=40)),
+                ('ingested', models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 2.0 on 2026-10-18 15:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mdh_corpus', '0018_ingestedfile'),
+    ]
+
+    operations = [
+        # Article3Term is not managed by Django,
+        # AddField only changes the state.
+        migrations.AddField(
+            model_name='article3term',
+            name='journal',
+            field=models.ForeignKey(db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='mdh_corpus.Journal'),
+        ),
+        migrations.RunSQL(
+            'ALTER TABLE mdh_corpus_article3term ADD COLUMN journal_id integer NULL',
+            'ALTER TABLE mdh_corpus_article3term DROP COLUMN journal_id',
+        ),
+    ]
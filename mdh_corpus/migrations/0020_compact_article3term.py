@@ -0,0 +1,156 @@
+# Generated by Django 2.0 on 2026-10-18 16:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+import re
+
+TABLE = 'mdh_corpus_article3term'
+
+
+def get_partitions(cursor):
+    '''Returns [(partition name, journal id), ...] or None
+    if the table is not partitioned'''
+    cursor.execute(
+        'SELECT relkind FROM pg_class WHERE oid = %s::regclass', [TABLE]
+    )
+    if cursor.fetchone()[0] != 'p':
+        return None
+
+    cursor.execute('''
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = %s::regclass
+    ''', [TABLE])
+
+    return [
+        (name, int(re.sub(r'^.*_j(\d+)$', r'\1', name)))
+        for name, in cursor.fetchall()
+    ]
+
+
+def compact_article3term(apps, schema_editor):
+    '''Rewrites the table without the id column.
+    Duplicate trigrams are merged.'''
+    # the layout and the partitions are specific to PostgreSQL,
+    # other databases (e.g. the tests) keep the original table
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    new_table = TABLE + '_compact'
+    with schema_editor.connection.cursor() as c:
+        partitions = get_partitions(c)
+
+        # 4 x 4 bytes then 2 x 2 bytes: no alignment padding
+        c.execute('''
+            CREATE TABLE {new_table} (
+                article_id integer NOT NULL,
+                term1_id integer NOT NULL,
+                term2_id integer NOT NULL,
+                term3_id integer NOT NULL,
+                journal_id smallint NOT NULL,
+                freq smallint NOT NULL
+                CONSTRAINT {table}_freq_check CHECK (freq >= 0)
+            ) {partitioning}
+        '''.format(
+            new_table=new_table, table=TABLE,
+            partitioning='PARTITION BY LIST (journal_id)'
+            if partitions is not None else ''
+        ))
+        for name, journal_id in partitions or []:
+            c.execute(
+                'CREATE TABLE %s_compact PARTITION OF %s FOR VALUES IN (%s)'
+                % (name, new_table, journal_id)
+            )
+
+        c.execute('''
+            INSERT INTO {new_table}
+            SELECT t.article_id, t.term1_id, t.term2_id, t.term3_id,
+            a.journal_id, LEAST(SUM(t.freq), 32767)
+            FROM {table} t
+            JOIN mdh_corpus_article a ON a.id = t.article_id
+            GROUP BY t.article_id, t.term1_id, t.term2_id, t.term3_id,
+            a.journal_id
+        '''.format(new_table=new_table, table=TABLE))
+
+        c.execute('DROP TABLE %s' % TABLE)
+        c.execute('ALTER TABLE %s RENAME TO %s' % (new_table, TABLE))
+        for name, journal_id in partitions or []:
+            c.execute('ALTER TABLE %s_compact RENAME TO %s' % (name, name))
+
+        # the partition key has to be part of the primary key
+        c.execute(
+            'ALTER TABLE %s ADD PRIMARY KEY '
+            '(article_id, term1_id, term2_id, term3_id%s)'
+            % (TABLE, ', journal_id' if partitions is not None else '')
+        )
+        add_term_indexes_and_keys(c)
+
+
+def add_term_indexes_and_keys(cursor):
+    for column in ['term1_id', 'term2_id', 'term3_id']:
+        cursor.execute('CREATE INDEX ON %s (%s)' % (TABLE, column))
+    for column, target in [
+        ('article_id', 'mdh_corpus_article'),
+        ('term1_id', 'mdh_corpus_term'),
+        ('term2_id', 'mdh_corpus_term'),
+        ('term3_id', 'mdh_corpus_term'),
+    ]:
+        cursor.execute('''
+            ALTER TABLE {table} ADD FOREIGN KEY ({column})
+            REFERENCES {target} (id) DEFERRABLE INITIALLY DEFERRED
+        '''.format(table=TABLE, column=column, target=target))
+
+
+def restore_id(apps, schema_editor):
+    '''Restores the layout of 0019: id primary key, index on article_id
+    and nullable integer journal_id. The merged duplicates are not
+    split again.'''
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    with schema_editor.connection.cursor() as c:
+        partitions = get_partitions(c)
+        c.execute(
+            'ALTER TABLE %s DROP CONSTRAINT %s_pkey' % (TABLE, TABLE)
+        )
+        c.execute('ALTER TABLE %s ADD COLUMN id serial NOT NULL' % TABLE)
+        if partitions is None:
+            c.execute('ALTER TABLE %s ADD PRIMARY KEY (id)' % TABLE)
+            c.execute(
+                'ALTER TABLE %s ALTER COLUMN journal_id TYPE integer, '
+                'ALTER COLUMN journal_id DROP NOT NULL' % TABLE
+            )
+        else:
+            # the partition key has to be part of the primary key
+            # and its type can't change
+            c.execute(
+                'ALTER TABLE %s ADD PRIMARY KEY (id, journal_id)' % TABLE
+            )
+        c.execute('CREATE INDEX ON %s (article_id)' % TABLE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mdh_corpus', '0019_article3term_journal'),
+    ]
+
+    operations = [
+        # Article3Term is not managed by Django,
+        # the field operations only change the state.
+        migrations.AlterField(
+            model_name='article3term',
+            name='article',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='+', serialize=False, to='mdh_corpus.Article'),
+        ),
+        migrations.RemoveField(
+            model_name='article3term',
+            name='id',
+        ),
+        migrations.AlterField(
+            model_name='article3term',
+            name='journal',
+            field=models.ForeignKey(db_constraint=False, db_index=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='mdh_corpus.Journal'),
+        ),
+        migrations.RunPython(compact_article3term, restore_id),
+    ]
@@ -0,0 +1,84 @@
+# Generated by Django 2.0 on 2026-10-18 12:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mdh_corpus', '0020_compact_article3term'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AggregatedArticle',
+            fields=[
+                ('article', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='+', serialize=False, to='mdh_corpus.Article')),
+                ('freq', models.BigIntegerField()),
+                ('trigrams', models.IntegerField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TrigramDomain',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('freq', models.BigIntegerField()),
+                ('articles', models.IntegerField()),
+                ('domain', models.ForeignKey(db_constraint=False, db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='mdh_corpus.Domain')),
+                ('term1', models.ForeignKey(db_constraint=False, db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='mdh_corpus.Term')),
+                ('term2', models.ForeignKey(db_constraint=False, db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='mdh_corpus.Term')),
+                ('term3', models.ForeignKey(db_constraint=False, db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='mdh_corpus.Term')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TrigramJournal',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('freq', models.BigIntegerField()),
+                ('articles', models.IntegerField()),
+                ('journal', models.ForeignKey(db_constraint=False, db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='mdh_corpus.Journal')),
+                ('term1', models.ForeignKey(db_constraint=False, db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='mdh_corpus.Term')),
+                ('term2', models.ForeignKey(db_constraint=False, db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='mdh_corpus.Term')),
+                ('term3', models.ForeignKey(db_constraint=False, db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='mdh_corpus.Term')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TrigramTotal',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dimension', models.CharField(max_length=10)),
+                ('value', models.IntegerField()),
+                ('freq', models.BigIntegerField()),
+                ('articles', models.IntegerField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TrigramYear',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.SmallIntegerField()),
+                ('freq', models.BigIntegerField()),
+                ('articles', models.IntegerField()),
+                ('term1', models.ForeignKey(db_constraint=False, db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='mdh_corpus.Term')),
+                ('term2', models.ForeignKey(db_constraint=False, db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='mdh_corpus.Term')),
+                ('term3', models.ForeignKey(db_constraint=False, db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='mdh_corpus.Term')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='trigramtotal',
+            unique_together={('dimension', 'value')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='trigramyear',
+            unique_together={('term1', 'term2', 'term3', 'year')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='trigramjournal',
+            unique_together={('term1', 'term2', 'term3', 'journal')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='trigramdomain',
+            unique_together={('term1', 'term2', 'term3', 'domain')},
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 2.0 on 2026-10-18 17:25
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    '''
+    Index for the trigram lookups sorted by frequency
+    (keyset pagination on freq, article_id).
+    It replaces the index on term1_id.
+    '''
+
+    dependencies = [
+        ('mdh_corpus', '0021_trigram_aggregates'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            [
+                'CREATE INDEX mdh_corpus_article3term_trigram_freq '
+                'ON mdh_corpus_article3term '
+                '(term1_id, term2_id, term3_id, freq, article_id)',
+                'DROP INDEX IF EXISTS mdh_corpus_article3term_term1_id_idx',
+            ],
+            [
+                'CREATE INDEX mdh_corpus_article3term_term1_id_idx '
+                'ON mdh_corpus_article3term (term1_id)',
+                'DROP INDEX mdh_corpus_article3term_trigram_freq',
+            ],
+        ),
+    ]
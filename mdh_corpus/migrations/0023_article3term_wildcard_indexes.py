@@ -0,0 +1,39 @@
+# Generated by Django 2.0 on 2026-10-18 18:02
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    '''
+    Indexes for the wildcard trigram queries (see queries.py):
+    with the trigram_freq index, any combination of fixed terms
+    is a prefix of one of them. freq is included for index-only scans.
+    They replace the indexes on term2_id and term3_id.
+    '''
+
+    dependencies = [
+        ('mdh_corpus', '0022_article3term_trigram_freq_index'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            [
+                'CREATE INDEX mdh_corpus_article3term_t231_freq '
+                'ON mdh_corpus_article3term '
+                '(term2_id, term3_id, term1_id, freq)',
+                'CREATE INDEX mdh_corpus_article3term_t312_freq '
+                'ON mdh_corpus_article3term '
+                '(term3_id, term1_id, term2_id, freq)',
+                'DROP INDEX IF EXISTS mdh_corpus_article3term_term2_id_idx',
+                'DROP INDEX IF EXISTS mdh_corpus_article3term_term3_id_idx',
+            ],
+            [
+                'CREATE INDEX mdh_corpus_article3term_term2_id_idx '
+                'ON mdh_corpus_article3term (term2_id)',
+                'CREATE INDEX mdh_corpus_article3term_term3_id_idx '
+                'ON mdh_corpus_article3term (term3_id)',
+                'DROP INDEX mdh_corpus_article3term_t231_freq',
+                'DROP INDEX mdh_corpus_article3term_t312_freq',
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.0 on 2026-10-18 13:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mdh_corpus', '0023_article3term_wildcard_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ingestedfile',
+            name='xid',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import models, NotSupportedError
 
 # Create your models here.
 
@@ -43,25 +43,52 @@ class Term(models.Model):
     label = models.CharField(max_length=TERM_MAX_LEN, unique=True)
 
 
+class Article3TermQuerySet(models.QuerySet):
+    '''
+    Bulk deletes and updates can go through the primary key,
+    which would touch all the trigrams of the articles.
+    Use SQL on mdh_corpus_article3term instead (see art.py).
+    '''
+
+    def delete(self):
+        raise NotSupportedError(
+            'Article3Term rows cannot be deleted by the ORM'
+        )
+
+    def update(self, **kwargs):
+        raise NotSupportedError(
+            'Article3Term rows cannot be updated by the ORM'
+        )
+
+
 class Article3Term(models.Model):
     '''
     This table can be huge, with hundreds of millions of record.
     Every byte has to count.
-    Ideally we'd like to avoid Django .pk / .id field
-    because there's no use for it.
-    Natural PK = (article, term1, term2, term3)
-    but not really essential to enforce it.
+    There is no surrogate id, the primary key is the natural key
+    (article, term1, term2, term3), plus journal when the table is
+    partitioned (see art partition_ngrams).
     Unfortunately, Django doesn't allow models with composite PK.
     See https://code.djangoproject.com/ticket/373 (open since 2005!)
+    So Django is told that article is the primary key, which is false:
+    an article has many rows. Anything that writes by primary key
+    would write all the trigrams of the article. So save(), delete()
+    and the delete() and update() of querysets raise NotSupportedError.
+    Selects and bulk_create() work as usual. Deleting an Article or
+    a Term still cascades to its rows with a DELETE by foreign key,
+    as long as no delete signal is connected to this model.
+    Hence the relation is not visible from the Article side.
     '''
-    # Total: 20 bytes / records + indices => 40 B
+    # Total: 20 bytes / record, no padding + 24 bytes of tuple header.
+    # Indices: primary key + one per term.
+    # Fields are listed in the order of the columns in the table,
+    # the 2 bytes columns last.
     #
-    # 4 bytes
-    # id set by Django
-    # Remove it with:
-    # alter table mdh_corpus_article3term drop column id;
-    # 2 Bytes
-    article = models.ForeignKey(Article, on_delete=models.CASCADE)
+    # 4 Bytes
+    article = models.OneToOneField(
+        Article, on_delete=models.CASCADE, primary_key=True,
+        related_name='+'
+    )
     # 4 Bytes
     term1 = models.ForeignKey(Term, on_delete=models.CASCADE,
                               related_name='art_term1')
@@ -71,12 +98,160 @@ class Article3Term(models.Model):
     # 4 Bytes
     term3 = models.ForeignKey(Term, on_delete=models.CASCADE,
                               related_name='art_term3')
+    # 2 Bytes (smallint)
+    # Copy of article.journal, the partition key of the table
+    # (see art partition_ngrams). No constraint, no index.
+    journal = models.ForeignKey(
+        Journal, on_delete=models.DO_NOTHING,
+        db_constraint=False, db_index=False, related_name='+'
+    )
     # 2 Bytes
     freq = models.PositiveSmallIntegerField(default=0)
 
+    objects = Article3TermQuerySet.as_manager()
+
     class Meta:
         managed = False
 
+    def save(self, *args, **kwargs):
+        raise NotSupportedError(
+            'Article3Term rows cannot be saved by the ORM'
+        )
+
+    def delete(self, *args, **kwargs):
+        raise NotSupportedError(
+            'Article3Term rows cannot be deleted by the ORM'
+        )
+
+
+class AggregatedArticle(models.Model):
+    '''
+    Ledger of the articles counted in the trigram aggregates below,
+    with their totals. See _aggregates.py in mdh_corpus commands.
+    The trigrams and metadata of an article must not change
+    while it is in this table.
+    '''
+    article = models.OneToOneField(
+        Article, on_delete=models.CASCADE, primary_key=True,
+        related_name='+'
+    )
+    # sum of the frequencies of the trigrams of the article
+    freq = models.BigIntegerField()
+    # number of distinct trigrams in the article
+    trigrams = models.IntegerField()
+
+
+# Trigram aggregates, maintained by the art command.
+# No foreign key constraints: they would be checked for every record
+# written and the aggregates are emptied by the art reset actions.
+
+
+class TrigramYear(models.Model):
+    '''
+    Sum of the frequencies of a trigram in the articles published
+    in a year and number of those articles.
+    '''
+    term1 = models.ForeignKey(Term, on_delete=models.CASCADE,
+                              related_name='+', db_index=False,
+                              db_constraint=False)
+    term2 = models.ForeignKey(Term, on_delete=models.CASCADE,
+                              related_name='+', db_index=False,
+                              db_constraint=False)
+    term3 = models.ForeignKey(Term, on_delete=models.CASCADE,
+                              related_name='+', db_index=False,
+                              db_constraint=False)
+    year = models.SmallIntegerField()
+    freq = models.BigIntegerField()
+    articles = models.IntegerField()
+
+    class Meta:
+        unique_together = ('term1', 'term2', 'term3', 'year')
+
+
+class TrigramJournal(models.Model):
+    '''
+    Sum of the frequencies of a trigram in the articles of a journal
+    and number of those articles.
+    '''
+    term1 = models.ForeignKey(Term, on_delete=models.CASCADE,
+                              related_name='+', db_index=False,
+                              db_constraint=False)
+    term2 = models.ForeignKey(Term, on_delete=models.CASCADE,
+                              related_name='+', db_index=False,
+                              db_constraint=False)
+    term3 = models.ForeignKey(Term, on_delete=models.CASCADE,
+                              related_name='+', db_index=False,
+                              db_constraint=False)
+    journal = models.ForeignKey(Journal, on_delete=models.CASCADE,
+                                related_name='+', db_index=False,
+                                db_constraint=False)
+    freq = models.BigIntegerField()
+    articles = models.IntegerField()
+
+    class Meta:
+        unique_together = ('term1', 'term2', 'term3', 'journal')
+
+
+class TrigramDomain(models.Model):
+    '''
+    Sum of the frequencies of a trigram in the articles of a domain
+    and number of those articles.
+    '''
+    term1 = models.ForeignKey(Term, on_delete=models.CASCADE,
+                              related_name='+', db_index=False,
+                              db_constraint=False)
+    term2 = models.ForeignKey(Term, on_delete=models.CASCADE,
+                              related_name='+', db_index=False,
+                              db_constraint=False)
+    term3 = models.ForeignKey(Term, on_delete=models.CASCADE,
+                              related_name='+', db_index=False,
+                              db_constraint=False)
+    domain = models.ForeignKey(Domain, on_delete=models.CASCADE,
+                               related_name='+', db_index=False,
+                               db_constraint=False)
+    freq = models.BigIntegerField()
+    articles = models.IntegerField()
+
+    class Meta:
+        unique_together = ('term1', 'term2', 'term3', 'domain')
+
+
+class TrigramTotal(models.Model):
+    '''
+    Denominators of the trigram aggregates: sum of the frequencies of
+    all trigrams and number of articles for the whole corpus
+    (dimension='corpus', value=0) and for each year, journal id or
+    domain id (dimension='year', 'journal' or 'domain').
+    '''
+    dimension = models.CharField(max_length=10)
+    value = models.IntegerField()
+    freq = models.BigIntegerField()
+    articles = models.IntegerField()
+
+    class Meta:
+        unique_together = ('dimension', 'value')
+
+
+class IngestedFile(models.Model):
+    '''
+    Ingestion manifest, one record per source file ingested by
+    the art command. Used to skip the files which haven't changed
+    since their last ingestion without querying the other tables.
+    path is relative to settings.MDH_SOURCE_PATH.
+    '''
+    path = models.CharField(max_length=500, unique=True)
+    # 'meta' or 'ngram3'
+    kind = models.CharField(max_length=10)
+    fileid = models.CharField(max_length=100, db_index=True)
+    size = models.BigIntegerField()
+    mtime = models.FloatField()
+    sha1 = models.CharField(max_length=40)
+    ingested = models.DateTimeField()
+    # id of the transaction which recorded the file (txid_current()),
+    # tells art index_articles which articles have changed since
+    # its last run, even if that transaction committed later
+    xid = models.BigIntegerField(default=0)
+
 #
 # class Ngram1(models.Model):
 #     label = models.CharField(max_length=30, unique=True)
@@ -0,0 +1,496 @@
+'''
+Read-only queries on the corpus, used by the JSON views.
+
+Results are paginated with a cursor (keyset pagination) rather than
+an OFFSET: the cursor is the sort key of the last result returned
+and the next page starts right after it in the index, so deep pages
+are as fast as the first one.
+'''
+
+from datetime import date
+from django.db import connection
+from mdh_corpus.models import (
+    Article, Article3Term, AggregatedArticle, Domain, Journal, Term,
+    TrigramTotal, TrigramYear
+)
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+# period -> postgresql format of the publication date
+PERIODS = {
+    'year': 'YYYY',
+    'month': 'YYYY-MM',
+}
+MAX_SERIES = 10
+
+WILDCARD = '*'
+# Article3Term indexes for the wildcard queries: (name, term positions).
+# Any set of fixed positions is a prefix of one of them.
+TRIGRAM_INDEXES = [
+    ('mdh_corpus_article3term_trigram_freq', (1, 2, 3)),
+    ('mdh_corpus_article3term_t231_freq', (2, 3, 1)),
+    ('mdh_corpus_article3term_t312_freq', (3, 1, 2)),
+]
+
+
+class QueryError(ValueError):
+    '''Invalid query parameters'''
+    pass
+
+
+def get_term_ids(labels):
+    '''Returns the list of Term ids for a list of labels,
+    None for the unknown labels.'''
+    ids = dict(
+        Term.objects.filter(label__in=labels).values_list('label', 'id')
+    )
+
+    return [ids.get(label) for label in labels]
+
+
+def get_domain_id(label):
+    ret = Domain.objects.filter(label=label).values_list(
+        'id', flat=True
+    ).first()
+    if ret is None:
+        raise QueryError('Unknown domain: %s' % label)
+
+    return ret
+
+
+def parse_trigram(value):
+    '''Returns the list of 3 labels in a string separated by spaces'''
+    ret = (value or '').split()
+    if len(ret) != 3:
+        raise QueryError('A trigram is made of three terms')
+
+    return ret
+
+
+def parse_pattern(value):
+    '''Returns the list of 3 labels or None (WILDCARD) in a pattern
+    like "climate * change". At least one term must be given
+    and at least one must be a wildcard.'''
+    ret = [
+        None if label == WILDCARD else label
+        for label in parse_trigram(value)
+    ]
+    if ret == [None, None, None]:
+        raise QueryError('At least one term of the pattern must be given')
+    if None not in ret:
+        raise QueryError(
+            'At least one term of the pattern must be %s' % WILDCARD
+        )
+
+    return ret
+
+
+def parse_trigrams(values):
+    '''Returns a list of trigrams (lists of 3 labels)'''
+    if not values:
+        raise QueryError('At least one trigram is required')
+    if len(values) > MAX_SERIES:
+        raise QueryError('At most %s trigrams per query' % MAX_SERIES)
+
+    return [parse_trigram(value) for value in values]
+
+
+def parse_period(value):
+    ret = value or 'year'
+    if ret not in PERIODS:
+        raise QueryError(
+            'Invalid period: %s (%s)' % (ret, ', '.join(sorted(PERIODS)))
+        )
+
+    return ret
+
+
+def parse_date(value, end=False):
+    '''Parses YYYY, YYYY-MM or YYYY-MM-DD.
+    With end=True a partial date is the last day of the period.'''
+    if not value:
+        return None
+
+    try:
+        parts = [int(part) for part in value.split('-')]
+        if len(parts) == 1:
+            ret = date(parts[0], 12, 31) if end else date(parts[0], 1, 1)
+        elif len(parts) == 2:
+            ret = date(parts[0], parts[1], 1)
+            if end:
+                next_month = date(
+                    parts[0] + parts[1] // 12, parts[1] % 12 + 1, 1
+                )
+                ret = date.fromordinal(next_month.toordinal() - 1)
+        elif len(parts) == 3:
+            ret = date(*parts)
+        else:
+            raise ValueError()
+    except ValueError:
+        raise QueryError('Invalid date: %s' % value)
+
+    return ret
+
+
+def parse_int(value, name, default=None):
+    if value in [None, '']:
+        return default
+    try:
+        ret = int(value)
+    except ValueError:
+        raise QueryError('Invalid %s: %s' % (name, value))
+
+    return ret
+
+
+def parse_limit(value):
+    ret = parse_int(value, 'limit', DEFAULT_LIMIT)
+    if ret < 1:
+        raise QueryError('Invalid limit: %s' % value)
+
+    return min(ret, MAX_LIMIT)
+
+
+def parse_cursor(value, size=2):
+    '''Returns the list of <size> integers encoded in a cursor'''
+    if not value:
+        return None
+
+    try:
+        ret = [int(part) for part in value.split('.')]
+    except ValueError:
+        ret = []
+    if len(ret) != size:
+        raise QueryError('Invalid cursor: %s' % value)
+
+    return ret
+
+
+def format_cursor(values):
+    return '.'.join(str(value) for value in values)
+
+
+def get_trigram_articles(labels, journal_id=None, domain=None,
+                         date_from=None, date_to=None, cursor=None,
+                         limit=DEFAULT_LIMIT):
+    '''Returns the articles containing a trigram, most frequent first.
+    labels: the three Term labels
+    domain: a Domain label
+    date_from, date_to: publication dates, both included
+    cursor: the 'next' value returned with the previous page
+    Returns a dictionary: {'trigram', 'results', 'next'}.
+
+    Uses the (term1, term2, term3, freq, article) index of Article3Term:
+    equality on the terms then a backward scan from the cursor.'''
+    ret = {
+        'trigram': labels,
+        'results': [],
+        'next': None,
+    }
+
+    term_ids = get_term_ids(labels)
+    if None in term_ids:
+        return ret
+
+    conditions = [
+        't.term1_id = %s', 't.term2_id = %s', 't.term3_id = %s'
+    ]
+    params = list(term_ids)
+
+    if journal_id is not None:
+        # also selects the partition if the table is partitioned
+        conditions.append('t.journal_id = %s')
+        params.append(journal_id)
+    if domain:
+        conditions.append('''EXISTS (
+            SELECT 1 FROM {domains} d
+            WHERE d.article_id = t.article_id AND d.domain_id = %s
+        )'''.format(domains=Article.domains.through._meta.db_table))
+        params.append(get_domain_id(domain))
+    if date_from:
+        conditions.append('a.pub_date >= %s')
+        params.append(date_from)
+    if date_to:
+        conditions.append('a.pub_date <= %s')
+        params.append(date_to)
+    if cursor:
+        conditions.append('(t.freq, t.article_id) < (%s, %s)')
+        params.extend(cursor)
+
+    # one more row to know if there is a next page
+    params.append(limit + 1)
+
+    with connection.cursor() as c:
+        c.execute('''
+            SELECT t.freq, t.article_id, a.fileid, a.label, a.pub_date,
+            j.id, j.label
+            FROM {trigrams} t
+            JOIN {article} a ON a.id = t.article_id
+            JOIN {journal} j ON j.id = a.journal_id
+            WHERE {conditions}
+            ORDER BY t.freq DESC, t.article_id DESC
+            LIMIT %s
+        '''.format(
+            trigrams=Article3Term._meta.db_table,
+            article=Article._meta.db_table,
+            journal=Journal._meta.db_table,
+            conditions=' AND '.join(conditions),
+        ), params)
+        rows = c.fetchall()
+
+    for row in rows[:limit]:
+        ret['results'].append({
+            'freq': row[0],
+            'article': {
+                'id': row[1],
+                'fileid': row[2],
+                'label': row[3],
+                'pub_date': row[4].isoformat(),
+                'journal': {
+                    'id': row[5],
+                    'label': row[6],
+                },
+            },
+        })
+
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        ret['next'] = format_cursor([last[0], last[1]])
+
+    return ret
+
+
+def get_trigram_series(trigrams, period='year', journal_id=None,
+                       domain=None):
+    '''Returns the absolute and relative frequency of trigrams
+    per year or month of publication.
+    trigrams: list of trigrams, each a list of three Term labels
+    period: 'year' or 'month'
+    domain: a Domain label
+    Returns a dictionary:
+    {
+        'period', 'periods': [period label, ...],
+        'totals': {'freq': [...], 'articles': [...]},
+        'series': [{'trigram', 'freq', 'articles', 'relative'}, ...]
+    }
+    The lists are aligned on 'periods'. totals are the sum of the
+    frequencies of all the trigrams and the number of articles
+    in each period, relative = freq / totals.freq.
+
+    Yearly series for the whole corpus are read from the precomputed
+    TrigramYear and TrigramTotal. Otherwise only the Article3Term
+    records of the requested trigrams are read (with the trigram index)
+    and the totals are computed from the AggregatedArticle ledger,
+    one small record per article.
+    Only the articles in the aggregates are counted,
+    see the rebuild_aggregates action of the art command.'''
+    if domain:
+        domain = get_domain_id(domain)
+    precomputed = (period == 'year' and journal_id is None and not domain)
+
+    if precomputed:
+        totals = {
+            '%04d' % value: (freq, articles)
+            for value, freq, articles in TrigramTotal.objects.filter(
+                dimension='year'
+            ).values_list('value', 'freq', 'articles')
+        }
+    else:
+        totals = _get_period_totals(period, journal_id, domain)
+
+    periods = sorted(totals.keys())
+    ret = {
+        'period': period,
+        'periods': periods,
+        'totals': {
+            'freq': [totals[p][0] for p in periods],
+            'articles': [totals[p][1] for p in periods],
+        },
+        'series': [],
+    }
+
+    for labels in trigrams:
+        term_ids = get_term_ids(labels)
+        values = {}
+        if None not in term_ids:
+            if precomputed:
+                values = {
+                    '%04d' % year: (freq, articles)
+                    for year, freq, articles in TrigramYear.objects.filter(
+                        term1_id=term_ids[0], term2_id=term_ids[1],
+                        term3_id=term_ids[2]
+                    ).values_list('year', 'freq', 'articles')
+                }
+            else:
+                values = _get_trigram_periods(
+                    term_ids, period, journal_id, domain
+                )
+
+        series = {
+            'trigram': labels,
+            'freq': [],
+            'articles': [],
+            'relative': [],
+        }
+        for p in periods:
+            freq, articles = values.get(p, (0, 0))
+            series['freq'].append(freq)
+            series['articles'].append(articles)
+            series['relative'].append(
+                freq / totals[p][0] if totals[p][0] else 0
+            )
+        ret['series'].append(series)
+
+    return ret
+
+
+def _get_article_conditions(journal_id, domain_id):
+    # Returns (conditions, params) on the article (a)
+    conditions = ['TRUE']
+    params = []
+    if journal_id is not None:
+        conditions.append('a.journal_id = %s')
+        params.append(journal_id)
+    if domain_id:
+        conditions.append('''EXISTS (
+            SELECT 1 FROM {domains} d
+            WHERE d.article_id = a.id AND d.domain_id = %s
+        )'''.format(domains=Article.domains.through._meta.db_table))
+        params.append(domain_id)
+
+    return ' AND '.join(conditions), params
+
+
+def _get_period_totals(period, journal_id, domain_id):
+    # Returns {period label: (freq, articles)} from the ledger
+    conditions, params = _get_article_conditions(journal_id, domain_id)
+    with connection.cursor() as c:
+        c.execute('''
+            SELECT to_char(a.pub_date, %s), SUM(l.freq), COUNT(*)
+            FROM {ledger} l
+            JOIN {article} a ON a.id = l.article_id
+            WHERE {conditions}
+            GROUP BY 1
+        '''.format(
+            ledger=AggregatedArticle._meta.db_table,
+            article=Article._meta.db_table,
+            conditions=conditions,
+        ), [PERIODS[period]] + params)
+
+        return {row[0]: (int(row[1]), row[2]) for row in c.fetchall()}
+
+
+def _get_trigram_periods(term_ids, period, journal_id, domain_id):
+    # Returns {period label: (freq, articles)} for one trigram
+    conditions, params = _get_article_conditions(journal_id, domain_id)
+    if journal_id is not None:
+        # also selects the partition if the table is partitioned
+        conditions += ' AND t.journal_id = %s'
+        params.append(journal_id)
+    with connection.cursor() as c:
+        # the join on the ledger keeps the same articles as the totals
+        c.execute('''
+            SELECT to_char(a.pub_date, %s), SUM(t.freq), COUNT(*)
+            FROM {trigrams} t
+            JOIN {ledger} l ON l.article_id = t.article_id
+            JOIN {article} a ON a.id = t.article_id
+            WHERE t.term1_id = %s AND t.term2_id = %s AND t.term3_id = %s
+            AND {conditions}
+            GROUP BY 1
+        '''.format(
+            trigrams=Article3Term._meta.db_table,
+            ledger=AggregatedArticle._meta.db_table,
+            article=Article._meta.db_table,
+            conditions=conditions,
+        ), [PERIODS[period]] + list(term_ids) + params)
+
+        return {row[0]: (int(row[1]), row[2]) for row in c.fetchall()}
+
+
+def get_wildcard_plan(pattern):
+    '''Returns (index name, fixed positions, free positions)
+    for a pattern (list of 3 labels or None).
+    The fixed positions are a prefix of the index, the free positions
+    follow in the order of the index so the records of a group
+    are contiguous in the scan and can be aggregated on the fly.'''
+    fixed = [i + 1 for i, label in enumerate(pattern) if label is not None]
+    if len(fixed) == 3:
+        raise QueryError(
+            'At least one term of the pattern must be %s' % WILDCARD
+        )
+    for name, positions in TRIGRAM_INDEXES:
+        if sorted(positions[:len(fixed)]) == fixed:
+            return name, fixed, list(positions[len(fixed):])
+
+    # not reached, all the combinations are covered by TRIGRAM_INDEXES
+    raise QueryError('No index for this pattern')
+
+
+def get_wildcard_trigrams(pattern, journal_id=None, limit=DEFAULT_LIMIT):
+    '''Returns the most frequent trigrams matching a pattern.
+    pattern: list of 3 Term labels, None for a free position
+    Returns a dictionary:
+    {'pattern', 'results': [{'trigram', 'freq', 'articles'}]}
+    freq is the sum of the frequencies of the trigram in all the
+    (selected) articles, articles the number of those articles.
+
+    The records are found with the index of get_wildcard_plan(),
+    which also contains freq, so without journal_id PostgreSQL can
+    read them from the index alone (index-only scan). journal_id is
+    not in the index: on a partitioned table only that partition is
+    read, otherwise the journal is checked in the table.
+    All the records matching the fixed terms are aggregated before
+    the limit applies, so the cost grows with the number of records
+    of the fixed terms, not with the limit.'''
+    fixed, free = get_wildcard_plan(pattern)[1:]
+    ret = {
+        'pattern': [label or WILDCARD for label in pattern],
+        'results': [],
+    }
+
+    term_ids = get_term_ids([pattern[i - 1] for i in fixed])
+    if None in term_ids:
+        return ret
+
+    conditions = ['term%s_id = %%s' % i for i in fixed]
+    params = list(term_ids)
+    if journal_id is not None:
+        conditions.append('journal_id = %s')
+        params.append(journal_id)
+    params.append(limit)
+
+    groups = ', '.join('term%s_id' % i for i in free)
+    with connection.cursor() as c:
+        c.execute('''
+            SELECT {groups}, SUM(freq), COUNT(*)
+            FROM {trigrams}
+            WHERE {conditions}
+            GROUP BY {groups}
+            ORDER BY {freq} DESC, {groups}
+            LIMIT %s
+        '''.format(
+            groups=groups,
+            trigrams=Article3Term._meta.db_table,
+            conditions=' AND '.join(conditions),
+            freq=len(free) + 1,
+        ), params)
+        rows = c.fetchall()
+
+    labels = dict(
+        Term.objects.filter(
+            id__in={term_id for row in rows for term_id in row[:len(free)]}
+        ).values_list('id', 'label')
+    )
+
+    for row in rows:
+        trigram = list(pattern)
+        for i, term_id in zip(free, row):
+            trigram[i - 1] = labels.get(term_id)
+        ret['results'].append({
+            'trigram': trigram,
+            'freq': int(row[-2]),
+            'articles': row[-1],
+        })
+
+    return ret
@@ -0,0 +1,248 @@
+'''
+In-memory prefix index of the Term labels for autocomplete,
+suggestions ranked by corpus frequency.
+
+The index is written to a file (settings.MDH_TERM_INDEX_PATH)
+by the art command after ingestion:
+
+    python manage.py art build_term_index
+
+Each web worker loads it at startup (see mdh/wsgi.py) and reloads it
+when the file changes, so suggestions never touch the database.
+Without MDH_TERM_INDEX_PATH the index is read from the database
+by the first suggestion request of each worker and never refreshed.
+
+The labels are kept in a sorted list: the labels starting with a prefix
+are a contiguous range found by bisection. For the short prefixes,
+which match many labels, the most frequent ones are precomputed.
+
+File format:
+    header line: 'mdh-term-index <count>'
+    <count> frequencies, 8 bytes each, little-endian
+    <count> labels, utf-8, separated by new lines, sorted by key
+'''
+
+from bisect import bisect_left
+import logging
+import os
+import time
+import numpy as np
+
+logger = logging.getLogger('mdh')
+
+FILE_SIGNATURE = 'mdh-term-index'
+
+# max number of suggestions returned by suggest()
+MAX_SUGGESTIONS = 50
+# the top suggestions are precomputed for prefixes matching more labels
+PRECOMPUTE_THRESHOLD = 256
+# seconds between two checks of the modification time of the file
+CHECK_INTERVAL = 2
+
+# above any character in a label
+LAST_CHAR = '\U0010ffff'
+
+
+class TermPrefixIndex(object):
+
+    def __init__(self, labels, freqs):
+        '''labels: list of Term labels
+        freqs: their corpus frequencies'''
+        keys = [get_key(label) for label in labels]
+        order = sorted(range(len(labels)), key=lambda i: (keys[i], labels[i]))
+
+        self.keys = [keys[i] for i in order]
+        self.labels = [labels[i] for i in order]
+        self.freqs = np.asarray(freqs, dtype='int64')[order] \
+            if len(order) else np.zeros(0, dtype='int64')
+        # prefix -> positions of its top suggestions
+        self.top = {}
+        self._precompute()
+
+    def __len__(self):
+        return len(self.labels)
+
+    def suggest(self, prefix, limit=10):
+        '''Returns [(label, freq), ...] of the most frequent labels
+        starting with prefix (case insensitive), most frequent first.'''
+        limit = min(limit, MAX_SUGGESTIONS)
+        key = get_key(prefix)
+
+        positions = self.top.get(key)
+        if positions is None:
+            lo, hi = self.get_range(key)
+            positions = self._get_top(lo, hi, limit)
+
+        return [
+            (self.labels[i], int(self.freqs[i])) for i in positions[:limit]
+        ]
+
+    def get_range(self, key):
+        '''Returns (lo, hi), the positions of the keys starting with key'''
+        lo = bisect_left(self.keys, key)
+        hi = bisect_left(self.keys, key + LAST_CHAR, lo)
+
+        return lo, hi
+
+    def _get_top(self, lo, hi, limit):
+        # positions of the <limit> highest frequencies in [lo, hi),
+        # ties in label order
+        freqs = self.freqs[lo:hi]
+        if len(freqs) > limit:
+            # the lowest frequency selected, only the first labels
+            # with that frequency are selected
+            kth = -np.partition(-freqs, limit - 1)[limit - 1]
+            selected = np.flatnonzero(freqs > kth)
+            selected = np.concatenate([
+                selected,
+                np.flatnonzero(freqs == kth)[:limit - len(selected)]
+            ])
+        else:
+            selected = np.arange(len(freqs))
+        selected = selected[np.lexsort((selected, -freqs[selected]))]
+
+        return (selected + lo).tolist()
+
+    def _precompute(self):
+        # walks down the prefix tree as long as the ranges are large
+        stack = [(0, len(self.keys), 0)]
+        while stack:
+            lo, hi, depth = stack.pop()
+            self.top[self.keys[lo][:depth] if depth else ''] = \
+                self._get_top(lo, hi, MAX_SUGGESTIONS)
+
+            i = lo
+            while i < hi:
+                if len(self.keys[i]) <= depth:
+                    i += 1
+                    continue
+                prefix = self.keys[i][:depth + 1]
+                j = bisect_left(self.keys, prefix + LAST_CHAR, i, hi)
+                if j - i > PRECOMPUTE_THRESHOLD:
+                    stack.append((i, j, depth + 1))
+                i = j
+
+    @classmethod
+    def read_terms(cls):
+        '''Returns (labels, freqs) of all the Term records.
+        The frequency of a term is the frequency of the trigrams
+        it starts, from the aggregates (see art rebuild_aggregates).'''
+        from django.db import connection
+        from mdh_corpus.models import Term, TrigramJournal
+
+        with connection.cursor() as c:
+            c.execute('''
+                SELECT t.label, COALESCE(f.freq, 0)
+                FROM {term} t
+                LEFT JOIN (
+                    SELECT term1_id, SUM(freq) AS freq
+                    FROM {aggregate}
+                    GROUP BY term1_id
+                ) f ON f.term1_id = t.id
+            '''.format(
+                term=Term._meta.db_table,
+                aggregate=TrigramJournal._meta.db_table,
+            ))
+            rows = c.fetchall()
+
+        return [row[0] for row in rows], [int(row[1]) for row in rows]
+
+    @classmethod
+    def from_database(cls):
+        return cls(*cls.read_terms())
+
+    def save(self, path):
+        # write to a temporary file first so a concurrent load()
+        # never reads a partial file
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(
+                ('%s %s\n' % (FILE_SIGNATURE, len(self))).encode('ascii')
+            )
+            self.freqs.astype('<i8').tofile(f)
+            f.write('\n'.join(self.labels).encode('utf-8'))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        '''Returns the index saved in a file, None if the file
+        doesn't exist or is not valid.'''
+        if not os.path.exists(path):
+            return None
+
+        with open(path, 'rb') as f:
+            header = f.readline().decode('ascii').split()
+            if len(header) != 2 or header[0] != FILE_SIGNATURE:
+                return None
+            count = int(header[1])
+
+            freqs = np.fromfile(f, dtype='<i8', count=count)
+            labels = f.read().decode('utf-8').split('\n') if count else []
+
+        if len(labels) != count or len(freqs) != count:
+            return None
+
+        return cls(labels, freqs)
+
+
+def get_key(label):
+    '''Returns the key used to sort and match a label'''
+    ret = label.lower()
+    # shares the string of the (mostly lowercase) labels
+    return label if ret == label else ret
+
+
+# the index of this process, see get_term_index()
+_term_index = {
+    'index': None,
+    'mtime': None,
+    'checked': 0,
+}
+
+
+def get_term_index():
+    '''Returns the TermPrefixIndex of this process.
+    Reloaded if settings.MDH_TERM_INDEX_PATH has changed since
+    the last check (at most every CHECK_INTERVAL seconds).'''
+    from django.conf import settings
+
+    path = settings.MDH_TERM_INDEX_PATH
+    cache = _term_index
+    if not path:
+        if cache['index'] is None:
+            cache['index'] = TermPrefixIndex.from_database()
+        return cache['index']
+
+    now = time.time()
+    if cache['index'] is None or now - cache['checked'] > CHECK_INTERVAL:
+        cache['checked'] = now
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            mtime = None
+        if cache['index'] is None or mtime != cache['mtime']:
+            index = TermPrefixIndex.load(path) if mtime else None
+            if index is None and cache['index'] is None:
+                # no file yet
+                index = TermPrefixIndex([], [])
+            if index is not None:
+                cache['index'] = index
+            cache['mtime'] = mtime
+
+    return cache['index']
+
+
+def preload_term_index():
+    '''Loads the index file of this process before the first request.
+    Without MDH_TERM_INDEX_PATH nothing is loaded: reading all the
+    Terms from the database is left to the first suggestion request.
+    Errors are logged, the first request will try again.'''
+    from django.conf import settings
+
+    if not settings.MDH_TERM_INDEX_PATH:
+        return
+
+    try:
+        get_term_index()
+    except Exception:
+        logger.exception('Term index could not be loaded')
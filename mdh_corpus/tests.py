@@ -1,3 +1,841 @@
-# from django.test import TestCase
+from datetime import date
+import csv
+import json
+import os
+import struct
+import tempfile
+import numpy as np
+from django.db.utils import IntegrityError, NotSupportedError
+from django.test import SimpleTestCase, TestCase
+from mdh_corpus.columns import TrigramColumns
+from mdh_corpus.management.commands._catalog import (
+    FileCatalog, get_file_kind, get_fileid
+)
+from mdh_corpus.management.commands._columns import (
+    BinaryCopyColumns, COPY_SIGNATURE
+)
+from mdh_corpus.management.commands._kdlcommand import KDLCommand
+from mdh_corpus.management.commands._stats import RunStats
+from mdh_corpus.management.commands._termdict import TermDictionary
+from mdh_corpus.management.commands.art import Command as ArtCommand
+from mdh_corpus import queries
+from mdh_corpus.models import (
+    Article, Article3Term, Journal, Term, TERM_MAX_LEN
+)
+from mdh_corpus.terms import TermPrefixIndex
 
-# Create your tests here.
+
+class TempDirMixin(object):
+
+    def setUp(self):
+        super(TempDirMixin, self).setUp()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+
+    def write_file(self, rel_path, content):
+        '''Writes <content> (str or bytes) to a file
+        in the temporary folder. Returns its path.'''
+        path = os.path.join(self.tmp, rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        with open(path, 'wb') as f:
+            f.write(content)
+
+        return path
+
+
+class CommitInBatchesTestCase(TestCase):
+
+    def get_command(self, **options):
+        command = KDLCommand()
+        command.options = options
+        return command
+
+    def run_batches(self, items, fail_once, **options):
+        '''Returns the items processed, process() raises an
+        IntegrityError the first time it gets <fail_once>'''
+        processed = []
+        failed = []
+
+        command = self.get_command(**options)
+
+        def process(item):
+            command.stats.count('items')
+            if item == fail_once and not failed:
+                failed.append(item)
+                raise IntegrityError('duplicate key')
+            processed.append(item)
+
+        command.commit_in_batches(items, process)
+        self.stats = command.stats
+
+        return processed
+
+    def test_failure_in_the_middle(self):
+        processed = self.run_batches(iter(range(10)), 2)
+        self.assertEqual(processed, list(range(10)))
+
+    def test_failure_in_the_middle_of_a_batch(self):
+        processed = self.run_batches(iter(range(10)), 2, commit_every=4)
+        # 0 and 1 are processed again with 2 after the rollback
+        self.assertEqual(sorted(set(processed)), list(range(10)))
+        self.assertEqual(processed[-7:], list(range(3, 10)))
+        # the counts of the rolled back transaction are discarded
+        self.assertEqual(self.stats.get('items'), 10)
+        self.assertEqual(self.stats.get('retries'), 1)
+
+
+class Article3TermTestCase(SimpleTestCase):
+
+    def test_no_write_by_primary_key(self):
+        # article is not really the primary key
+        rows = Article3Term.objects.filter(article_id=1)
+        with self.assertRaises(NotSupportedError):
+            rows.delete()
+        with self.assertRaises(NotSupportedError):
+            rows.update(freq=1)
+        row = Article3Term(article_id=1, term1_id=1, term2_id=2,
+                           term3_id=3, journal_id=1, freq=1)
+        with self.assertRaises(NotSupportedError):
+            row.save()
+        with self.assertRaises(NotSupportedError):
+            row.delete()
+
+
+class WildcardPatternTestCase(SimpleTestCase):
+
+    def test_parse_pattern(self):
+        self.assertEqual(
+            queries.parse_pattern(' climate  *  change '),
+            ['climate', None, 'change']
+        )
+        for value in ['', 'climate *', '* * *', 'climate change policy',
+                      'a * b c']:
+            with self.assertRaises(queries.QueryError, msg=value):
+                queries.parse_pattern(value)
+
+    def test_get_wildcard_plan(self):
+        for pattern, fixed, free in [
+            (['a', None, None], [1], [2, 3]),
+            ([None, 'b', None], [2], [3, 1]),
+            ([None, None, 'c'], [3], [1, 2]),
+            (['a', 'b', None], [1, 2], [3]),
+            ([None, 'b', 'c'], [2, 3], [1]),
+            (['a', None, 'c'], [1, 3], [2]),
+        ]:
+            index, plan_fixed, plan_free = queries.get_wildcard_plan(pattern)
+            self.assertEqual((plan_fixed, plan_free), (fixed, free))
+            positions = list(dict(queries.TRIGRAM_INDEXES)[index])
+            # fixed terms first, in any order
+            self.assertEqual(sorted(positions[:len(fixed)]), fixed)
+            self.assertEqual(positions[len(fixed):], free)
+
+    def test_no_wildcard(self):
+        with self.assertRaises(queries.QueryError):
+            queries.get_wildcard_trigrams(['a', 'b', 'c'])
+
+
+class RunStatsTestCase(TempDirMixin, SimpleTestCase):
+
+    def get_stats(self):
+        ret = RunStats()
+        with ret.timer('parse'):
+            pass
+        ret.add_time('load', 1.5, 3)
+        ret.count('rows', 3)
+        ret.count('rows')
+
+        return ret
+
+    def test_counters_and_timers(self):
+        self.assertFalse(RunStats())
+        stats = self.get_stats()
+        self.assertTrue(stats)
+        self.assertEqual(stats.get('rows'), 4)
+        self.assertEqual(stats.get('missing'), 0)
+        self.assertEqual(stats.get_time('load'), 1.5)
+        self.assertEqual(stats.get_time('missing'), 0)
+        self.assertEqual(stats.timers['parse'][1], 1)
+
+    def test_merge(self):
+        stats = RunStats()
+        for i in range(2):
+            # through JSON, like the stats of a worker process
+            stats.merge(json.loads(json.dumps(self.get_stats().to_dict())))
+        self.assertEqual(stats.get('rows'), 8)
+        self.assertEqual(stats.timers['load'], [3.0, 6])
+        self.assertIn('rows: 8', stats.get_summary())
+        self.assertTrue(stats.get_summary().startswith('load 3.00 s.'))
+
+    def test_set_counters(self):
+        stats = self.get_stats()
+        counters = stats.get_counters()
+        stats.count('rows', 10)
+        stats.count('retries')
+        self.assertEqual(counters, {'rows': 4})
+        stats.set_counters(counters)
+        self.assertEqual(stats.get('rows'), 4)
+        self.assertEqual(stats.get('retries'), 0)
+        # a copy, not the saved dictionary
+        stats.count('rows')
+        self.assertEqual(counters, {'rows': 4})
+
+    def test_is_due(self):
+        stats = RunStats()
+        self.assertFalse(stats.is_due(0))
+        self.assertFalse(stats.is_due(None))
+        self.assertFalse(stats.is_due(3600))
+        stats.last_summary = 0
+        self.assertTrue(stats.is_due(1))
+        self.assertFalse(stats.is_due(1))
+
+    def test_export(self):
+        stats = self.get_stats()
+
+        path = os.path.join(self.tmp, 'stats.json')
+        stats.export(path, action='add_ngram3', duration=2.5)
+        with open(path, 'rt') as f:
+            data = json.load(f)
+        self.assertEqual(data['action'], 'add_ngram3')
+        self.assertEqual(data['counters'], {'rows': 4})
+        self.assertEqual(data['timers']['load'], {'seconds': 1.5, 'calls': 3})
+
+        path = os.path.join(self.tmp, 'stats.csv')
+        stats.export(path, action='add_ngram3')
+        with open(path, 'rt', newline='') as f:
+            rows = list(csv.reader(f))
+        self.assertEqual(rows[0], ['kind', 'name', 'value', 'calls'])
+        self.assertIn(['info', 'action', 'add_ngram3', ''], rows)
+        self.assertIn(['timer', 'load', '1.5', '3'], rows)
+        self.assertIn(['counter', 'rows', '4', ''], rows)
+
+
+class TermDictionaryTestCase(TempDirMixin, TestCase):
+
+    def setUp(self):
+        super(TermDictionaryTestCase, self).setUp()
+        self.path = os.path.join(self.tmp, 'terms.dict')
+        Term.objects.bulk_create(
+            Term(label=label) for label in ['digital', 'humanities', 'caf\xe9']
+        )
+        self.ids = dict(Term.objects.values_list('label', 'id'))
+
+    def test_sync_and_resolve(self):
+        terms = TermDictionary(self.path)
+        self.assertFalse(terms.load())
+        self.assertEqual(terms.sync(), 3)
+        self.assertEqual(len(terms), 3)
+        self.assertEqual(
+            terms.resolve(['digital', 'unknown', 'caf\xe9']),
+            ({'digital': self.ids['digital'], 'caf\xe9': self.ids['caf\xe9']},
+             ['unknown'])
+        )
+        # nothing new
+        self.assertEqual(terms.sync(), 0)
+
+        # only the new terms are read
+        Term.objects.create(label='research')
+        self.assertEqual(terms.sync(), 1)
+        self.assertIn('research', terms.terms)
+
+        # the counts differ, the dictionary is rebuilt
+        Term.objects.filter(label='humanities').delete()
+        self.assertEqual(terms.sync(), 3)
+        self.assertNotIn('humanities', terms.terms)
+
+    def test_save_and_load(self):
+        terms = TermDictionary(self.path)
+        terms.sync()
+        terms.save()
+
+        loaded = TermDictionary(self.path)
+        self.assertTrue(loaded.load())
+        self.assertEqual(loaded.terms, self.ids)
+        self.assertEqual(loaded.max_id, max(self.ids.values()))
+        self.assertEqual(loaded.sync(), 0)
+
+    def test_empty(self):
+        terms = TermDictionary(self.path)
+        terms.save()
+
+        loaded = TermDictionary(self.path)
+        self.assertTrue(loaded.load())
+        self.assertEqual(len(loaded), 0)
+        self.assertEqual(loaded.resolve(['digital']), ({}, ['digital']))
+
+    def test_invalid_file(self):
+        for content in [b'not a dictionary\n', b'mdh-term-index 0\n']:
+            self.write_file('terms.dict', content)
+            self.assertFalse(TermDictionary(self.path).load())
+
+        # fewer labels than ids
+        self.write_file(
+            'terms.dict',
+            b'mdh-terms 2 2\n' + struct.pack('=II', 1, 2) + b'label'
+        )
+        self.assertFalse(TermDictionary(self.path).load())
+
+
+class NgramFileTestCase(TempDirMixin, SimpleTestCase):
+
+    def iter_rows(self, content):
+        path = self.write_file('a1-ngram3.txt', content)
+
+        return list(ArtCommand()._iter_ngram_rows(path))
+
+    def test_rows(self):
+        long_token = 'x' * (TERM_MAX_LEN + 10)
+        rows = self.iter_rows(
+            'digital humanities research\t12\n'
+            'only two\t3\n'
+            '\n'
+            'caf\xe9 au lait\t1\n'
+            '%s b c\t2\n'
+            # no new line at the end of the file
+            ' padded  tokens \t7' % long_token
+        )
+        self.assertEqual(rows, [
+            ('digital', 'humanities', 'research', 12),
+            ('caf\xe9', 'au', 'lait', 1),
+            ('x' * TERM_MAX_LEN, 'b', 'c', 2),
+            # like the former csv parser, two spaces make an empty token
+            ('padded', '', 'tokens', 7),
+        ])
+
+    def test_trailing_new_line(self):
+        self.assertEqual(
+            self.iter_rows('a b c\t1\r\nd e f\t2\r\n'),
+            [('a', 'b', 'c', 1), ('d', 'e', 'f', 2)]
+        )
+
+    def test_empty_file(self):
+        self.assertEqual(self.iter_rows(''), [])
+
+
+class MetaFileTestCase(TempDirMixin, SimpleTestCase):
+
+    front = '''<front>
+        <journal-meta>
+            <journal-title>Journal of Physics</journal-title>
+            <issn pub-type="epub">1539297X</issn>
+        </journal-meta>
+        <article-meta>
+            <title-group><article-title>On <i>things</i></article-title>
+            </title-group>
+            <pub-date><month>March</month><year>2010</year></pub-date>
+            <custom-meta-group><custom-meta>
+                <meta-name>lang</meta-name><meta-value>en</meta-value>
+            </custom-meta></custom-meta-group>
+        </article-meta>
+    </front>'''
+
+    def get_command(self, full_xml=False):
+        ret = ArtCommand()
+        ret.options = {'full_xml': full_xml}
+
+        return ret
+
+    def test_parse_front_matter(self):
+        # the body is not well-formed but it is never parsed
+        path = self.write_file(
+            'a1.xml',
+            '<article>%s<body><p>unclosed</body></article>' % self.front
+        )
+        front = self.get_command()._parse_front_matter(path)
+        self.assertEqual(front.tag, 'front')
+        self.assertEqual(
+            front.find('.//journal-title').text, 'Journal of Physics'
+        )
+
+    def test_parse_without_front(self):
+        path = self.write_file('a1.xml', '<article><p>text</p></article>')
+        root = self.get_command()._parse_front_matter(path)
+        self.assertEqual(root.tag, 'article')
+        self.assertEqual(root.find('p').text, 'text')
+
+    def test_read_meta_file(self):
+        path = self.write_file(
+            'Physics Corpus/Journal 2010/metadata/a1.xml',
+            '<article>%s<body/></article>' % self.front
+        )
+        for full_xml in [False, True]:
+            data = self.get_command(full_xml).read_meta_file(
+                path, {'article.fileid': 'a1'}
+            )
+            self.assertEqual(data['article.fileid'], 'a1')
+            self.assertEqual(data['domain.label'], 'physics')
+            self.assertEqual(data['journal.label'], 'Journal of Physics')
+            self.assertEqual(data['journal.epub'], '1539297X')
+            self.assertEqual(data['journal.ppub'], None)
+            self.assertEqual(data['article.label'], 'On things')
+            self.assertEqual(data['article.pub_date.month'], 3)
+            self.assertEqual(data['article.pub_date.year'], '2010')
+            self.assertEqual(data['language.label'], 'en')
+
+    def test_read_invalid_meta_file(self):
+        path = self.write_file('a1.xml', '<article><front>')
+        for full_xml in [False, True]:
+            self.assertIsNone(
+                self.get_command(full_xml).read_meta_file(path, {})
+            )
+
+
+class FileCatalogTestCase(TempDirMixin, SimpleTestCase):
+
+    def setUp(self):
+        super(FileCatalogTestCase, self).setUp()
+        self.root = os.path.join(self.tmp, 'source')
+        self.journal = os.path.join(self.root, 'Physics Corpus', 'J1 2010')
+        self.files = [
+            self.write_file(os.path.join(self.journal, rel_path), content)
+            for rel_path, content in [
+                ('metadata/a1.xml', '<article/>'),
+                ('metadata/a2.xml', '<article/>'),
+                ('ngram3/a1-ngram3.txt', 'a b c\t1\n'),
+            ]
+        ]
+        self.path = os.path.join(self.tmp, 'catalog.json.gz')
+
+    def get_catalog(self, rescan=False, root=None):
+        ret = FileCatalog(self.path, root or self.root)
+        ret.load()
+        counts = ret.refresh(rescan=rescan)
+        ret.save()
+
+        return ret, counts
+
+    def test_kind_and_fileid(self):
+        self.assertEqual(get_file_kind('a1.xml'), 'meta')
+        self.assertEqual(get_file_kind('a1-ngram3.txt'), 'ngram3')
+        self.assertEqual(get_file_kind('a1.txt'), '')
+        self.assertEqual(get_fileid('a1.xml'), 'a1')
+        self.assertEqual(get_fileid('a1-ngram3.txt'), 'a1')
+        self.assertEqual(get_fileid('a.b-1.xml'), 'a.b-1')
+
+    def test_files(self):
+        catalog, counts = self.get_catalog()
+        # root, Physics Corpus, J1 2010, metadata, ngram3
+        self.assertEqual(counts, (5, 0))
+
+        walked = sorted(
+            os.path.join(dirpath, name)
+            for dirpath, dirnames, names in os.walk(self.root)
+            for name in names
+        )
+        files = list(catalog.iter_files())
+        self.assertEqual(sorted(f[0] for f in files), walked)
+
+        path = self.files[2]
+        stat = os.stat(path)
+        expected = ('ngram3', 'a1', stat.st_size, stat.st_mtime)
+        self.assertIn((path,) + expected, files)
+        self.assertEqual(catalog.get_file(path), expected)
+        self.assertIsNone(
+            catalog.get_file(os.path.join(self.journal, 'metadata/a3.xml'))
+        )
+        self.assertIsNone(catalog.get_file('/elsewhere/a1.xml'))
+
+    def test_refresh(self):
+        self.get_catalog()
+
+        catalog, counts = self.get_catalog()
+        self.assertEqual(counts, (0, 5))
+
+        # a new file changes the mtime of its folder only
+        path = self.write_file(
+            os.path.join(self.journal, 'metadata/a3.xml'), '<article/>'
+        )
+        folder = os.path.dirname(path)
+        os.utime(folder, (0, os.stat(folder).st_mtime + 10))
+        catalog, counts = self.get_catalog()
+        self.assertEqual(counts, (1, 4))
+        self.assertEqual(catalog.get_file(path)[:2], ('meta', 'a3'))
+
+        catalog, counts = self.get_catalog(rescan=True)
+        self.assertEqual(counts, (5, 0))
+
+    def test_other_root(self):
+        self.get_catalog()
+        catalog = FileCatalog(self.path, self.journal)
+        self.assertFalse(catalog.load())
+        self.assertEqual(catalog.dirs, {})
+
+
+def get_copy_stream(records, sizes, extension=b''):
+    '''Returns the output of a binary COPY TO STDOUT of <records>'''
+    ret = COPY_SIGNATURE + struct.pack('>ii', 0, len(extension)) + extension
+    for record in records:
+        ret += struct.pack('>h', len(record))
+        for value, size in zip(record, sizes):
+            ret += struct.pack('>i', size)
+            ret += value.to_bytes(size, 'big', signed=True)
+
+    return ret + b'\xff\xff'
+
+
+class BinaryCopyColumnsTestCase(TempDirMixin, SimpleTestCase):
+
+    records = [(1, 20, 300), (4, -5, 70000), (2 ** 31 - 1, 32767, -1)]
+    sizes = [4, 2, 8]
+    dtypes = ['int32', 'int16', 'int64']
+
+    def copy(self, stream, block_size, rows=None):
+        '''Writes <stream> in blocks of <block_size> bytes.
+        Returns the columns.'''
+        paths = [
+            os.path.join(self.tmp, 'f%s.npy' % i) for i in range(3)
+        ]
+        writer = BinaryCopyColumns(
+            paths, self.sizes, self.dtypes,
+            len(self.records) if rows is None else rows
+        )
+        for i in range(0, len(stream), block_size):
+            writer.write(stream[i:i + block_size])
+        writer.close()
+
+        return [np.load(path) for path in paths]
+
+    def test_copy(self):
+        stream = get_copy_stream(self.records, self.sizes, b'ext')
+        # blocks smaller than the header, not aligned on the records
+        for block_size in [1, 7, 1 << 16]:
+            columns = self.copy(stream, block_size)
+            for i, column in enumerate(columns):
+                self.assertEqual(column.dtype, np.dtype(self.dtypes[i]))
+                self.assertEqual(
+                    column.tolist(), [record[i] for record in self.records]
+                )
+
+    def test_no_rows(self):
+        columns = self.copy(get_copy_stream([], self.sizes), 5, rows=0)
+        self.assertEqual([len(column) for column in columns], [0, 0, 0])
+
+    def test_invalid_stream(self):
+        stream = get_copy_stream(self.records, self.sizes)
+        with self.assertRaises(ValueError):
+            self.copy(b'COPY' + stream[4:], 100)
+        # truncated
+        with self.assertRaises(ValueError):
+            self.copy(stream[:-10], 100)
+        # fewer records than announced
+        with self.assertRaises(ValueError):
+            self.copy(stream, 100, rows=4)
+
+
+class TrigramColumnsTestCase(TempDirMixin, SimpleTestCase):
+
+    def setUp(self):
+        super(TrigramColumnsTestCase, self).setUp()
+        columns = {
+            'article_id': [1, 1, 2, 3],
+            'term1': [10, 10, 11, 10],
+            'term2': [20, 21, 20, 20],
+            'term3': [30, 30, 30, 31],
+            'freq': [5, 1, 2, 3],
+            'articles_id': [1, 2, 3],
+            'articles_journal': [7, 7, 8],
+            'articles_year': [2001, 2002, 2002],
+        }
+        for name, values in columns.items():
+            np.save(os.path.join(self.tmp, name + '.npy'), np.array(values))
+        self.write_file('columns.json', json.dumps({'rows': 4}))
+        self.write_file('terms.csv', ''.join(
+            '%s\t%s\n' % term for term in [
+                (10, 'digital'), (11, 'data'), (20, 'humanities'),
+                (21, 'history'), (30, 'research'), (31, 'methods'),
+            ]
+        ))
+        self.columns = TrigramColumns(self.tmp)
+
+    def assertMask(self, mask, expected):
+        self.assertEqual(mask.tolist(), expected)
+
+    def test_match(self):
+        columns = self.columns
+        self.assertEqual(len(columns), 4)
+        self.assertMask(columns.match(), [True] * 4)
+        self.assertMask(columns.match('digital'), [True, True, False, True])
+        self.assertMask(
+            columns.match('digital', 'humanities'), [True, False, False, True]
+        )
+        self.assertMask(
+            columns.match(['digital', 11], 'humanities'),
+            [True, False, True, True]
+        )
+        self.assertMask(columns.match('unknown'), [False] * 4)
+        self.assertMask(
+            columns.match(articles=[2, 3]), [False, False, True, True]
+        )
+        self.assertMask(
+            columns.match(term3=30, mask=columns.match(articles=[1, 3])),
+            [True, True, False, False]
+        )
+
+    def test_labels(self):
+        self.assertEqual(
+            self.columns.get_labels([10, 31, 99]),
+            ['digital', 'methods', None]
+        )
+
+    def test_group_sum(self):
+        columns = self.columns
+        years, freqs = columns.group_sum('year', columns.match('digital'))
+        self.assertEqual(years.tolist(), [2001, 2002])
+        self.assertEqual(freqs.tolist(), [6, 3])
+
+        journals, counts = columns.group_sum('journal', weights=None)
+        self.assertEqual(journals.tolist(), [7, 8])
+        self.assertEqual(counts.tolist(), [3, 1])
+
+        keys, freqs = columns.group_sum(['term1', 'year'])
+        self.assertEqual(keys.tolist(), [[10, 2001], [10, 2002], [11, 2002]])
+        self.assertEqual(freqs.tolist(), [6, 3, 2])
+
+    def test_top(self):
+        terms, freqs = self.columns.top('term2', limit=1)
+        self.assertEqual(terms.tolist(), [20])
+        self.assertEqual(freqs.tolist(), [10])
+
+
+class TermPrefixIndexTestCase(TempDirMixin, SimpleTestCase):
+
+    def get_index(self):
+        return TermPrefixIndex(
+            ['Digital', 'digits', 'dig', 'data', 'Zebra'], [5, 9, 5, 1, 3]
+        )
+
+    def test_suggest(self):
+        index = self.get_index()
+        self.assertEqual(len(index), 5)
+        # ties in label order
+        self.assertEqual(
+            index.suggest('dig'),
+            [('digits', 9), ('dig', 5), ('Digital', 5)]
+        )
+        self.assertEqual(index.suggest('DIG', limit=1), [('digits', 9)])
+        self.assertEqual(index.suggest('digi'), [('digits', 9),
+                                                 ('Digital', 5)])
+        self.assertEqual(index.suggest('z'), [('Zebra', 3)])
+        self.assertEqual(index.suggest('x'), [])
+        self.assertEqual(
+            [label for label, freq in index.suggest('')],
+            ['digits', 'dig', 'Digital', 'Zebra', 'data']
+        )
+
+    def test_precomputed(self):
+        # enough labels for the top of the short prefixes to be precomputed
+        labels = ['a%03d' % i for i in range(600)] + ['b', 'A1']
+        freqs = [i % 7 for i in range(600)] + [100, 6]
+        index = TermPrefixIndex(labels, freqs)
+        self.assertIn('a', index.top)
+        self.assertNotIn('a0', index.top)
+
+        def expected(prefix, limit):
+            matches = [
+                (label, freq) for label, freq in zip(labels, freqs)
+                if label.lower().startswith(prefix)
+            ]
+            matches.sort(key=lambda m: (-m[1], m[0].lower(), m[0]))
+            return matches[:limit]
+
+        for prefix, limit in [('', 10), ('a', 20), ('a', 50), ('a0', 8),
+                              ('a59', 5)]:
+            self.assertEqual(
+                index.suggest(prefix, limit), expected(prefix, limit),
+                prefix
+            )
+
+    def test_save_and_load(self):
+        path = os.path.join(self.tmp, 'terms.idx')
+        index = self.get_index()
+        index.save(path)
+
+        loaded = TermPrefixIndex.load(path)
+        self.assertEqual(loaded.labels, index.labels)
+        self.assertEqual(loaded.freqs.tolist(), index.freqs.tolist())
+        self.assertEqual(loaded.suggest('d'), index.suggest('d'))
+
+        TermPrefixIndex([], []).save(path)
+        self.assertEqual(len(TermPrefixIndex.load(path)), 0)
+
+    def test_invalid_file(self):
+        path = os.path.join(self.tmp, 'terms.idx')
+        self.assertIsNone(TermPrefixIndex.load(path))
+
+        # more frequencies announced than labels
+        self.get_index().save(path)
+        with open(path, 'rb') as f:
+            content = f.read()
+        self.write_file(
+            'terms.idx', content.replace(b' 5\n', b' 6\n', 1)
+        )
+        self.assertIsNone(TermPrefixIndex.load(path))
+        self.write_file('terms.idx', b'mdh-terms 1 1\n')
+        self.assertIsNone(TermPrefixIndex.load(path))
+
+
+class QueryParametersTestCase(SimpleTestCase):
+
+    def assertInvalid(self, function, *values):
+        for value in values:
+            with self.assertRaises(queries.QueryError, msg=value):
+                function(value)
+
+    def test_trigrams(self):
+        self.assertEqual(queries.parse_trigram(' a  b c '), ['a', 'b', 'c'])
+        self.assertInvalid(queries.parse_trigram, None, '', 'a b', 'a b c d')
+        self.assertEqual(
+            queries.parse_trigrams(['a b c', 'd e f']),
+            [['a', 'b', 'c'], ['d', 'e', 'f']]
+        )
+        self.assertInvalid(
+            queries.parse_trigrams, [], ['a b c'] * (queries.MAX_SERIES + 1)
+        )
+
+    def test_period(self):
+        self.assertEqual(queries.parse_period(None), 'year')
+        self.assertEqual(queries.parse_period('month'), 'month')
+        self.assertInvalid(queries.parse_period, 'week')
+
+    def test_date(self):
+        parse_date = queries.parse_date
+        self.assertIsNone(parse_date(''))
+        self.assertEqual(parse_date('2010'), date(2010, 1, 1))
+        self.assertEqual(parse_date('2010', end=True), date(2010, 12, 31))
+        self.assertEqual(parse_date('2010-02'), date(2010, 2, 1))
+        self.assertEqual(parse_date('2010-02', end=True), date(2010, 2, 28))
+        self.assertEqual(parse_date('2012-02', end=True), date(2012, 2, 29))
+        self.assertEqual(parse_date('2010-12', end=True), date(2010, 12, 31))
+        self.assertEqual(
+            parse_date('2010-02-03', end=True), date(2010, 2, 3)
+        )
+        self.assertInvalid(
+            parse_date, 'abc', '2010-13', '2010-02-30', '2010-1-1-1', '-1'
+        )
+
+    def test_int_and_limit(self):
+        self.assertEqual(queries.parse_int('', 'journal', 5), 5)
+        self.assertEqual(queries.parse_int('-3', 'journal'), -3)
+        with self.assertRaises(queries.QueryError):
+            queries.parse_int('3a', 'journal')
+        self.assertEqual(queries.parse_limit(None), queries.DEFAULT_LIMIT)
+        self.assertEqual(queries.parse_limit('7'), 7)
+        self.assertEqual(queries.parse_limit('100000'), queries.MAX_LIMIT)
+        self.assertInvalid(queries.parse_limit, '0', '-1', 'x')
+
+    def test_cursor(self):
+        self.assertIsNone(queries.parse_cursor(None))
+        self.assertEqual(queries.parse_cursor('12.345'), [12, 345])
+        self.assertEqual(
+            queries.parse_cursor(queries.format_cursor([3, 4, 5]), size=3),
+            [3, 4, 5]
+        )
+        self.assertInvalid(queries.parse_cursor, '12', '1.2.3', 'a.b', '.')
+
+
+class TrigramQueriesTestCase(TestCase):
+
+    def setUp(self):
+        journals = [
+            Journal.objects.create(label=label) for label in ['J1', 'J2']
+        ]
+        # (journal, freq of the trigram, freq of another trigram)
+        self.articles = []
+        for i, (journal, freq, other) in enumerate([
+            (0, 3, 1), (0, 5, 0), (1, 3, 2), (1, 1, 0), (0, 5, 4), (1, 3, 0)
+        ]):
+            article = Article.objects.create(
+                fileid='a%s' % i, journal=journals[journal],
+                pub_date=date(2010 + i, 1, 1)
+            )
+            self.articles.append((article, freq, other))
+        self.journal_id = journals[1].id
+
+        terms = {}
+        for label in ['digital', 'humanities', 'research', 'methods']:
+            terms[label] = Term.objects.create(label=label)
+
+        rows = []
+        for article, freq, other in self.articles:
+            for term3, value in [('research', freq), ('methods', other)]:
+                if value:
+                    rows.append(Article3Term(
+                        article=article, journal_id=article.journal_id,
+                        term1=terms['digital'], term2=terms['humanities'],
+                        term3=terms[term3], freq=value
+                    ))
+        Article3Term.objects.bulk_create(rows)
+
+    def get_pages(self, **kwargs):
+        '''Returns the pages of results, following the cursors'''
+        ret = []
+        cursor = None
+        while True:
+            page = queries.get_trigram_articles(
+                ['digital', 'humanities', 'research'],
+                cursor=cursor, limit=2, **kwargs
+            )
+            ret.append([
+                (result['article']['id'], result['freq'])
+                for result in page['results']
+            ])
+            if page['next'] is None:
+                return ret
+            cursor = queries.parse_cursor(page['next'])
+
+    def get_expected(self, selected=lambda article: True):
+        return sorted(
+            [
+                (article.id, freq) for article, freq, other in self.articles
+                if selected(article)
+            ],
+            key=lambda result: (-result[1], -result[0])
+        )
+
+    def test_keyset_pagination(self):
+        pages = self.get_pages()
+        self.assertEqual([len(page) for page in pages], [2, 2, 2])
+        self.assertEqual(sum(pages, []), self.get_expected())
+
+    def test_filters(self):
+        pages = self.get_pages(journal_id=self.journal_id)
+        self.assertEqual(sum(pages, []), self.get_expected(
+            lambda article: article.journal_id == self.journal_id
+        ))
+
+        pages = self.get_pages(date_from=date(2012, 1, 1))
+        self.assertEqual(sum(pages, []), self.get_expected(
+            lambda article: article.pub_date >= date(2012, 1, 1)
+        ))
+
+    def test_unknown_term(self):
+        page = queries.get_trigram_articles(['digital', 'humanities', 'x'])
+        self.assertEqual(page['results'], [])
+        self.assertIsNone(page['next'])
+
+    def test_wildcard(self):
+        ret = queries.get_wildcard_trigrams(['digital', None, None])
+        self.assertEqual(ret['pattern'], ['digital', '*', '*'])
+        self.assertEqual(ret['results'], [
+            {
+                'trigram': ['digital', 'humanities', 'research'],
+                'freq': 20, 'articles': 6,
+            },
+            {
+                'trigram': ['digital', 'humanities', 'methods'],
+                'freq': 7, 'articles': 3,
+            },
+        ])
+
+        ret = queries.get_wildcard_trigrams(
+            [None, 'humanities', None], journal_id=self.journal_id, limit=1
+        )
+        self.assertEqual(ret['results'], [{
+            'trigram': ['digital', 'humanities', 'research'],
+            'freq': 7, 'articles': 3,
+        }])
+
+        ret = queries.get_wildcard_trigrams(['x', None, 'research'])
+        self.assertEqual(ret['results'], [])
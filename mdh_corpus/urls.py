@@ -0,0 +1,21 @@
+from django.urls import path
+from mdh_corpus import views
+
+urlpatterns = [
+    path(
+        'trigram/articles/', views.trigram_articles,
+        name='trigram_articles'
+    ),
+    path(
+        'trigram/series/', views.trigram_series,
+        name='trigram_series'
+    ),
+    path(
+        'trigram/wildcard/', views.trigram_wildcard,
+        name='trigram_wildcard'
+    ),
+    path(
+        'terms/suggest/', views.term_suggestions,
+        name='term_suggestions'
+    ),
+]
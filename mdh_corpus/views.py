@@ -1,3 +1,85 @@
-# from django.shortcuts import render
+from django.http import JsonResponse
+from django.views.decorators.http import require_GET
+from mdh_corpus import queries
+from mdh_corpus.terms import get_term_index
 
-# Create your views here.
+
+def json_query(view):
+    '''Decorator for the JSON API views: GET only,
+    invalid parameters return a 400 response with an error message.'''
+    @require_GET
+    def wrapper(request, *args, **kwargs):
+        try:
+            ret = view(request, *args, **kwargs)
+        except queries.QueryError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+
+        return JsonResponse(ret)
+
+    return wrapper
+
+
+@json_query
+def trigram_articles(request):
+    '''Articles containing a trigram, most frequent first.
+    ?trigram=t1 t2 t3 [&journal=id] [&domain=label]
+    [&from=YYYY[-MM[-DD]]] [&to=YYYY[-MM[-DD]]]
+    [&limit=n] [&cursor=next value of the previous page]'''
+    params = request.GET
+
+    return queries.get_trigram_articles(
+        queries.parse_trigram(params.get('trigram')),
+        journal_id=queries.parse_int(params.get('journal'), 'journal'),
+        domain=params.get('domain'),
+        date_from=queries.parse_date(params.get('from')),
+        date_to=queries.parse_date(params.get('to'), end=True),
+        cursor=queries.parse_cursor(params.get('cursor')),
+        limit=queries.parse_limit(params.get('limit')),
+    )
+
+
+@json_query
+def trigram_series(request):
+    '''Frequency of one or more trigrams per year or month.
+    ?trigram=t1 t2 t3 [&trigram=...] [&period=year|month]
+    [&journal=id] [&domain=label]'''
+    params = request.GET
+
+    return queries.get_trigram_series(
+        queries.parse_trigrams(params.getlist('trigram')),
+        period=queries.parse_period(params.get('period')),
+        journal_id=queries.parse_int(params.get('journal'), 'journal'),
+        domain=params.get('domain'),
+    )
+
+
+@json_query
+def trigram_wildcard(request):
+    '''Most frequent trigrams matching a pattern.
+    ?pattern=t1 * t3 (* for any term) [&journal=id] [&limit=n]'''
+    params = request.GET
+
+    return queries.get_wildcard_trigrams(
+        queries.parse_pattern(params.get('pattern')),
+        journal_id=queries.parse_int(params.get('journal'), 'journal'),
+        limit=queries.parse_limit(params.get('limit')),
+    )
+
+
+@json_query
+def term_suggestions(request):
+    '''Most frequent terms starting with a prefix, from the in-memory
+    index (no database query).
+    ?prefix=abc [&limit=n]'''
+    params = request.GET
+    prefix = params.get('prefix', '')
+
+    return {
+        'prefix': prefix,
+        'results': [
+            {'label': label, 'freq': freq}
+            for label, freq in get_term_index().suggest(
+                prefix, queries.parse_limit(params.get('limit', 10))
+            )
+        ],
+    }